@@ -49,6 +49,9 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    # ほかのミドルウェアの分も含めて計るため、できるだけ外側に置く
+    'product.middleware.MetricsMiddleware',
+    'product.profiling.ProfilingMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -61,7 +64,8 @@ ROOT_URLCONF = 'config.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # 描画時間を計測するため DjangoTemplates を拡張したもの
+        'BACKEND': 'product.template_backend.InstrumentedDjangoTemplates',
         'DIRS': [BASE_DIR / 'config/templates'],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -129,8 +133,73 @@ STATIC_ROOT = BASE_DIR / 'staticfiles'
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# 複数プロセスで動かす場合は redis:// や dbcache:// などの共有キャッシュを指定する（production.py では必須）
+CACHES = {
+    'default': env.cache('CACHE_URL', default='locmemcache://'),
+}
+
+# カートの保存先
+# - product.cart.DatabaseCartStorage: Cart / CartItem テーブル（既定）
+# - product.cart.SessionCartStorage: セッションのみ。注文確定時だけ DB に書き込む
+#   SESSION_ENGINE に signed_cookies か cache を指定すれば、閲覧・カート操作で DB に一切書き込まない
+CART_STORAGE = env('CART_STORAGE', default='product.cart.DatabaseCartStorage')
+
+SESSION_ENGINE = env('SESSION_ENGINE', default='django.contrib.sessions.backends.db')
+
+# manage.py purge_carts で、最終操作からこの日数が経ったカートを消す（既定はセッションの有効期限 + 1日）
+CART_RETENTION_DAYS = env.int('CART_RETENTION_DAYS', default=15)
+
+# カートに入れた数量を在庫から仮押さえしておく時間（分）。期限が過ぎた仮押さえはほかの人に譲る
+STOCK_RESERVATION_MINUTES = env.int('STOCK_RESERVATION_MINUTES', default=15)
+
+# 注文できる数がこれ以下になったら「残りわずか」と表示する
+LOW_STOCK_THRESHOLD = env.int('LOW_STOCK_THRESHOLD', default=5)
+
+PRODUCT_LIST_PAGE_SIZE = env.int('PRODUCT_LIST_PAGE_SIZE', default=20)
+
+ORDER_LIST_PAGE_SIZE = env.int('ORDER_LIST_PAGE_SIZE', default=50)
+
+# 受注一覧の件数表示で、これより多いときは概算にする（COUNT(*) をしない）
+ORDER_LIST_COUNT_CAP = env.int('ORDER_LIST_COUNT_CAP', default=1000)
+
+PRODUCT_SEARCH_LIMIT = env.int('PRODUCT_SEARCH_LIMIT', default=50)
+
+PRODUCT_AUTOCOMPLETE_LIMIT = env.int('PRODUCT_AUTOCOMPLETE_LIMIT', default=10)
+
+# 売上集計・おすすめ・注文の差分出力（export_orders）で、作成からこの秒数が経っていない注文は次回に回す
+SALES_ROLLUP_LAG_SECONDS = env.int('SALES_ROLLUP_LAG_SECONDS', default=60)
+
+# 商品詳細に出す「よく一緒に購入されている商品」の件数（manage.py update_recommendations が作る）
+RECOMMENDATION_TOP_K = env.int('RECOMMENDATION_TOP_K', default=4)
+
+# 商品一覧・詳細の ETag に混ぜる値。テンプレートを変えたデプロイでは変えること（古い HTML に 304 を返さないように）
+CONDITIONAL_GET_SALT = env('CONDITIONAL_GET_SALT', default='')
+
+# 商品画像から作る派生画像（WebP / JPEG）の幅
+PRODUCT_IMAGE_WIDTHS = env.list('PRODUCT_IMAGE_WIDTHS', cast=int, default=[320, 640, 960])
+
+# リクエストの計測（product/middleware.py）。管理用の Basic 認証を付けたリクエストにだけ、
+# Server-Timing ヘッダーで DB・テンプレートの時間の内訳を返す
+METRICS_SERVER_TIMING = env.bool('METRICS_SERVER_TIMING', default=True)
+
+# 各プロセスの集計をキャッシュに書き出す間隔（秒）。manage/metrics/ は全プロセスの分を合算して返す
+METRICS_PUBLISH_INTERVAL = env.int('METRICS_PUBLISH_INTERVAL', default=10)
+
+# N 件に1件のリクエストをスタックサンプラーで計測する（0 なら無効）。結果は manage/profiles/ で見られる
+# 管理用の Basic 認証と X-Profile ヘッダーを付けたリクエストは、この設定に関係なく計測する
+PROFILE_SAMPLE_RATE = env.int('PROFILE_SAMPLE_RATE', default=0)
+
+# スタックサンプラーがスタックを取る間隔（ミリ秒）
+PROFILE_SAMPLE_INTERVAL_MS = env.int('PROFILE_SAMPLE_INTERVAL_MS', default=5)
+
+# 計測結果を何件まで残すか（古いものから上書き）
+PROFILE_BUFFER_SIZE = env.int('PROFILE_BUFFER_SIZE', default=20)
+
 MEDIA_URL = '/media/'
 
+# アップロードされたファイルは内容のハッシュで名付け、同じ内容は1つだけ保存する（product/storage.py）
+DEFAULT_FILE_STORAGE = 'product.storage.ContentAddressedFileSystemStorage'
+
 MEDIA_ROOT = BASE_DIR / 'media'
 
 CLOUDINARY_STORAGE = {
@@ -152,3 +221,6 @@ EMAIL_HOST_USER = env('EMAIL_HOST_USER')
 
 EMAIL_HOST_PASSWORD = env('EMAIL_HOST_PASSWORD')
 
+# SMTP の接続・送信の待ち時間の上限（秒）。send_outbox の --lease より十分短くすること
+EMAIL_TIMEOUT = env.int('EMAIL_TIMEOUT', default=30)
+
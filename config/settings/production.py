@@ -3,24 +3,44 @@ import dj_database_url
 import os
 import logging
 
+from django.core.exceptions import ImproperlyConfigured
+
 
 DEBUG = False
 
 ALLOWED_HOSTS = [os.environ.get('HOST_NAME', 'hc-ec-site.herokuapp.com')]
 
+# ASGI（uvicorn）で動かすときは 0 にする。ASGI ではリクエストごとに別のスレッドで接続するので、
+# 接続を使い回せずに溜まっていく（使い回しは PgBouncer などの接続プーラーに任せる）
 DATABASES = {
-    'default': dj_database_url.config(conn_max_age=600, ssl_require=True, conn_health_checks=True)
+    'default': dj_database_url.config(
+        conn_max_age=int(os.environ.get('DB_CONN_MAX_AGE', 600)), ssl_require=True, conn_health_checks=True,
+    )
 }
 
-MIDDLEWARE.insert(1, 'whitenoise.middleware.WhiteNoiseMiddleware')
+# WhiteNoise のミドルウェアは同期のみ。ASGI で動かすときは静的ファイルを CDN などから配信して SERVE_STATIC=false にする
+# （残すと、内側の async のミドルウェアとビューのためにリクエストごとにスレッドを1つ使う）
+if os.environ.get('SERVE_STATIC', 'true').lower() != 'false':
+    MIDDLEWARE.insert(1, 'whitenoise.middleware.WhiteNoiseMiddleware')
 
 STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
 
+# 商品カード・オートコンプリート・ETag のバージョンはキャッシュに置くので、gunicorn のワーカーや Procfile の
+# worker などのプロセスの間で共有できるキャッシュが必須（プロセスごとのキャッシュでは、ほかのプロセスでの変更が見えず、
+# 古いカードを出したり、変わったページに 304 を返したりする）
+if CACHES['default']['BACKEND'] in (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.filebased.FileBasedCache',
+):
+    raise ImproperlyConfigured(
+        '本番では CACHE_URL に、プロセスの間で共有できるキャッシュ（dbcache://django_cache や redis:// など）を指定してください。'
+    )
+
 CLOUDINARY_CLOUD_NAME = os.environ.get('CLOUDINARY_CLOUD_NAME')
 CLOUDINARY_API_KEY = os.environ.get('CLOUDINARY_API_KEY')
 CLOUDINARY_API_SECRET = os.environ.get('CLOUDINARY_API_SECRET')
 
-DEFAULT_FILE_STORAGE = 'cloudinary_storage.storage.MediaCloudinaryStorage'
+DEFAULT_FILE_STORAGE = 'product.storage.ContentAddressedCloudinaryStorage'
 
 
 LOGGING = {
@@ -1,7 +1,12 @@
 from django.contrib import admin
-from .models import Product, Order, OrderItem
+from .models import (Product, Order, OrderItem, EmailOutbox, SalesHourly, ProductSalesDaily,
+                     ProductRecommendation)
 
 # Register your models here.
 admin.site.register(Product)
 admin.site.register(Order)
 admin.site.register(OrderItem)
+admin.site.register(EmailOutbox)
+admin.site.register(SalesHourly)
+admin.site.register(ProductSalesDaily)
+admin.site.register(ProductRecommendation)
@@ -0,0 +1,32 @@
+import base64
+import binascii
+from functools import wraps
+
+from django.http import HttpResponse
+
+
+def has_basic_auth(request) -> bool:
+    """Authorization ヘッダーが管理用の資格情報（Basic 認証）を持っているか。"""
+    auth_header = request.META.get('HTTP_AUTHORIZATION')
+    if not auth_header:
+        return False
+    try:
+        auth_type, auth_string = auth_header.split(' ', 1)
+        auth_decoded = base64.b64decode(auth_string).decode('utf-8')
+        username, password = auth_decoded.split(':', 1)
+    except (ValueError, binascii.Error, UnicodeDecodeError):
+        return False
+    return auth_type.lower() == 'basic' and username == 'admin' and password == 'pw'
+
+
+def basic_auth_required(func):
+    @wraps(func)
+    def wrapper(request, *args, **kwargs):
+        if has_basic_auth(request):
+            return func(request, *args, **kwargs)
+
+        response = HttpResponse("Unauthorized", status=401)
+        response['WWW-Authenticate'] = 'Basic realm="Main"'
+        return response
+
+    return wrapper
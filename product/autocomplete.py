@@ -0,0 +1,81 @@
+import threading
+from bisect import bisect_left
+from typing import List, Tuple
+
+from .catalog import get_catalog_version
+from .models import Product
+from .search import normalize
+
+
+class PrefixIndex:
+    """
+    商品名の前方一致用のソート済み配列。
+    商品名全体と、空白で区切られた各単語の先頭をキーとして持つので、
+    「パンツ」で「デニム パンツ」も引ける。
+    """
+
+    def __init__(self, entries: List[Tuple[int, str]]):
+        self.names = [name for _, name in entries]
+        self.product_ids = [pk for pk, _ in entries]
+
+        keys = []
+        for position, (_, name) in enumerate(entries):
+            normalized = normalize(name).strip()
+            words = normalized.split()
+            starts = {normalized}
+            starts.update(' '.join(words[i:]) for i in range(1, len(words)))
+            keys.extend((key, position) for key in starts if key)
+        keys.sort()
+
+        self.keys = [key for key, _ in keys]
+        self.positions = [position for _, position in keys]
+
+    def __len__(self):
+        return len(self.product_ids)
+
+    def lookup(self, prefix: str, limit: int = 10) -> List[Tuple[int, str]]:
+        prefix = normalize(prefix).strip()
+        if not prefix:
+            return []
+
+        results = []
+        seen = set()
+        i = bisect_left(self.keys, prefix)
+        while i < len(self.keys) and self.keys[i].startswith(prefix) and len(results) < limit:
+            position = self.positions[i]
+            if position not in seen:
+                seen.add(position)
+                results.append((self.product_ids[position], self.names[position]))
+            i += 1
+        return results
+
+
+_lock = threading.Lock()
+_index = None
+_index_version = None
+
+
+def build_index() -> PrefixIndex:
+    return PrefixIndex(list(Product.objects.order_by('pk').values_list('pk', 'name')))
+
+
+def get_index() -> PrefixIndex:
+    """
+    プロセスごとのインデックスを返す。
+    初回アクセス時、またはカタログのバージョンが進んでいたときだけ DB から作り直す。
+    """
+    global _index, _index_version
+
+    version = get_catalog_version()
+    if _index is not None and _index_version == version:
+        return _index
+
+    with _lock:
+        if _index is None or _index_version != version:
+            _index = build_index()
+            _index_version = version
+    return _index
+
+
+def suggest(prefix: str, limit: int = 10) -> List[Tuple[int, str]]:
+    return get_index().lookup(prefix, limit)
@@ -0,0 +1,175 @@
+"""
+WSGI と ASGI で、同時接続をどれだけ処理できるかの比較（manage.py bench_concurrency）。
+
+同じプロセスの中で、本番と同じハンドラー（WSGIHandler / ASGIHandler）にリクエストを直接渡す。
+ミドルウェア・ビュー・テンプレートは本番と同じものを通る。
+- WSGI: gunicorn の同期ワーカーと同じく、同時に処理できるのは workers 件まで。残りの接続は空くまで待つ
+- ASGI: uvicorn と同じく、1つのイベントループがすべての接続を受け付ける
+どちらも connections 個のクライアントがそれぞれ順にリクエストを送り、待ち時間も含めた応答時間を測る。
+
+db_latency_ms を指定すると、クエリごとにその時間だけ待たせる（ネットワーク越しの DB を模す）。
+ASGI の async ビューは待っている間にほかの接続を処理できるので、差はこのときに出る。
+"""
+import asyncio
+import io
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Sequence
+
+from django.core.handlers.asgi import ASGIHandler
+from django.core.handlers.wsgi import WSGIHandler
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.urls import reverse
+
+from .models import Product
+from .stress import latency_percentiles, request_host
+
+
+def default_paths(products: int = 5) -> List[str]:
+    """一覧・詳細・カートのページ（async ビュー）。"""
+    product_ids = Product.objects.order_by('-pk').values_list('pk', flat=True)[:products]
+    return [
+        reverse('product:product_list'),
+        *(reverse('product:product_detail', args=[pk]) for pk in product_ids),
+        reverse('product:cart_detail'),
+    ]
+
+
+class InFlight:
+    """ハンドラーの中にいるリクエストの数と、その最大値。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.current = 0
+        self.peak = 0
+
+    @contextmanager
+    def track(self):
+        with self._lock:
+            self.current += 1
+            self.peak = max(self.peak, self.current)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.current -= 1
+
+
+@contextmanager
+def simulated_db_latency(seconds: float):
+    """以降に開く DB 接続で、クエリごとに seconds 秒待たせる。"""
+    def slow(execute, sql, params, many, context):
+        time.sleep(seconds)
+        return execute(sql, params, many, context)
+
+    def install(sender, connection, **kwargs):
+        connection.execute_wrappers.append(slow)
+
+    if not seconds:
+        yield
+        return
+    connection_created.connect(install, dispatch_uid='bench_db_latency')
+    try:
+        yield
+    finally:
+        connection_created.disconnect(dispatch_uid='bench_db_latency')
+
+
+def _report(latencies: List[float], statuses: List[int], elapsed: float, peak: int) -> dict:
+    return {
+        'requests': len(latencies),
+        'elapsed_s': round(elapsed, 3),
+        'requests_per_s': round(len(latencies) / elapsed, 1),
+        'errors': sum(1 for status in statuses if status >= 500),
+        'peak_in_flight': peak,
+        'latency': latency_percentiles(latencies),
+    }
+
+
+def run_wsgi(paths: Sequence[str], connections_count: int, requests: int, workers: int) -> dict:
+    handler = WSGIHandler()
+    host = request_host()
+    capacity = threading.BoundedSemaphore(workers)
+    in_flight = InFlight()
+    latencies: List[float] = []
+    statuses: List[int] = []
+
+    def client(offset: int):
+        for i in range(offset, requests, connections_count):
+            path = paths[i % len(paths)]
+            environ = {
+                'REQUEST_METHOD': 'GET', 'PATH_INFO': path, 'QUERY_STRING': '', 'SCRIPT_NAME': '',
+                'SERVER_NAME': host, 'SERVER_PORT': '80', 'HTTP_HOST': host, 'SERVER_PROTOCOL': 'HTTP/1.1',
+                'wsgi.url_scheme': 'http', 'wsgi.input': io.BytesIO(), 'wsgi.errors': io.StringIO(),
+            }
+            status = []
+            started = time.perf_counter()
+            # 同期ワーカー1つは1リクエストずつしか処理できない
+            with capacity, in_flight.track():
+                response = handler(environ, lambda line, headers, exc_info=None: status.append(line))
+                for _ in response:
+                    pass
+                response.close()
+            latencies.append(time.perf_counter() - started)
+            statuses.append(int(status[0].split()[0]))
+        connections.close_all()
+
+    threads = [threading.Thread(target=client, args=(offset,)) for offset in range(connections_count)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return _report(latencies, statuses, time.perf_counter() - started, in_flight.peak)
+
+
+def run_asgi(paths: Sequence[str], connections_count: int, requests: int) -> dict:
+    handler = ASGIHandler()
+    host = request_host()
+    in_flight = InFlight()
+    latencies: List[float] = []
+    statuses: List[int] = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def client(offset: int):
+        for i in range(offset, requests, connections_count):
+            path = paths[i % len(paths)]
+            scope = {
+                'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET',
+                'scheme': 'http', 'path': path, 'raw_path': path.encode(), 'query_string': b'', 'root_path': '',
+                'headers': [(b'host', host.encode())], 'client': ('127.0.0.1', 0), 'server': (host, 80),
+            }
+            status = []
+
+            async def send(message):
+                if message['type'] == 'http.response.start':
+                    status.append(message['status'])
+
+            started = time.perf_counter()
+            with in_flight.track():
+                await handler(scope, receive, send)
+            latencies.append(time.perf_counter() - started)
+            statuses.append(status[0])
+
+    async def main():
+        await asyncio.gather(*(client(offset) for offset in range(connections_count)))
+
+    started = time.perf_counter()
+    asyncio.run(main())
+    return _report(latencies, statuses, time.perf_counter() - started, in_flight.peak)
+
+
+def compare(paths: Sequence[str], connections_count: int = 50, requests: int = 500, workers: int = 4,
+            db_latency_ms: float = 0) -> Dict[str, dict]:
+    """同じ負荷を WSGI と ASGI にかけた結果。"""
+    with simulated_db_latency(db_latency_ms / 1000):
+        # 計測前に開いていた接続には遅延が入らないので、閉じて開き直させる
+        connections.close_all()
+        return {
+            'wsgi': run_wsgi(paths, connections_count, requests, workers),
+            'asgi': run_asgi(paths, connections_count, requests),
+        }
@@ -0,0 +1,504 @@
+from decimal import Decimal
+from typing import Dict, List, Optional
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Sum
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .db import upsert_add
+from .inventory import reservation_expiry
+from .models import Cart, CartItem, Product
+
+
+CART_COUNT_SESSION_KEY = 'cart_count'
+CART_LINES_SESSION_KEY = 'cart'
+CART_TOUCHED_SESSION_KEY = 'cart_touched'
+
+# Cart.updated_at を更新する間隔（秒）。カート操作のたびには書き込まない
+CART_TOUCH_INTERVAL = 24 * 60 * 60
+
+
+def refresh_cart_count(request, cart_id=None) -> int:
+    """
+    カート内の商品点数を DB から数え直してセッションに保存する。
+    セッション上の値が無い・ずれている可能性があるときの修復用。
+    """
+    cart_id = cart_id or request.session.get('cart_id')
+    count = 0
+    if cart_id:
+        count = CartItem.objects.filter(cart_id=cart_id).aggregate(total=Sum('quantity'))['total'] or 0
+    request.session[CART_COUNT_SESSION_KEY] = count
+    return count
+
+
+async def arefresh_cart_count(request, cart_id=None) -> int:
+    """refresh_cart_count の async 版。"""
+    cart_id = cart_id or request.session.get('cart_id')
+    count = 0
+    if cart_id:
+        count = (await CartItem.objects.filter(cart_id=cart_id).aaggregate(total=Sum('quantity')))['total'] or 0
+    request.session[CART_COUNT_SESSION_KEY] = count
+    return count
+
+
+def get_cart_count(request) -> int:
+    """
+    ヘッダーのバッジ用の商品点数。通常はセッションの値を返すだけでクエリは発行しない。
+    """
+    count = request.session.get(CART_COUNT_SESSION_KEY)
+    if count is None:
+        if not request.session.get('cart_id'):
+            return 0
+        count = refresh_cart_count(request)
+    return count
+
+
+async def aget_cart_count(request) -> int:
+    """get_cart_count の async 版。"""
+    count = request.session.get(CART_COUNT_SESSION_KEY)
+    if count is None:
+        if not request.session.get('cart_id'):
+            return 0
+        count = await arefresh_cart_count(request)
+    return count
+
+
+def set_cart_count(request, count: int):
+    count = max(count, 0)
+    # 値が変わらないときはセッションを更新済みにしない（無駄な保存を避ける）
+    if request.session.get(CART_COUNT_SESSION_KEY) != count:
+        request.session[CART_COUNT_SESSION_KEY] = count
+
+
+def adjust_cart_count(request, delta: int):
+    """
+    カート操作のたびに呼び、セッション上の点数を増減する。
+    元の値が無いときは DB から数え直す（操作後の行が反映された値になる）。
+    """
+    count = request.session.get(CART_COUNT_SESSION_KEY)
+    if count is None:
+        refresh_cart_count(request)
+    else:
+        set_cart_count(request, count + delta)
+
+
+async def aadjust_cart_count(request, delta: int):
+    """adjust_cart_count の async 版。"""
+    count = request.session.get(CART_COUNT_SESSION_KEY)
+    if count is None:
+        await arefresh_cart_count(request)
+    else:
+        set_cart_count(request, count + delta)
+
+
+class CartLine:
+    """DB を使わないカートの1行。テンプレートからは CartItem と同じように扱える。"""
+
+    def __init__(self, product: Product, quantity: int):
+        self.product = product
+        self.quantity = quantity
+
+    @property
+    def subtotal(self) -> Decimal:
+        return self.product.price * self.quantity
+
+    def __str__(self):
+        return self.product.name
+
+
+class BaseCartStorage:
+    """
+    カートの保存先の共通インターフェース。
+    ビューはこのクラスのメソッドだけを使い、保存先（DB / セッション）を意識しない。
+    """
+
+    # セッション上にはカートがあったのに実体が消えていた（期限切れなど）
+    is_expired = False
+
+    def __init__(self, request):
+        self.request = request
+        self.session = request.session
+
+    def get_items(self) -> list:
+        """product / quantity / subtotal を持つ行のリスト。"""
+        raise NotImplementedError
+
+    def add(self, product_id: int, quantity: int = 1):
+        raise NotImplementedError
+
+    def decrease(self, product_id: int):
+        raise NotImplementedError
+
+    def remove(self, product_id: int):
+        raise NotImplementedError
+
+    def count(self) -> int:
+        raise NotImplementedError
+
+    def get_quantity(self, product_id: int) -> int:
+        """カートに入っている product_id の数量。"""
+        raise NotImplementedError
+
+    @property
+    def cart_id(self) -> Optional[int]:
+        """DB 上のカートの ID（在庫の仮押さえから自分の分を除くのに使う）。無ければ None。"""
+        return None
+
+    def is_empty(self) -> bool:
+        return self.count() <= 0
+
+    def get_checkout_cart(self) -> Cart:
+        """
+        注文確定用に DB 上の Cart を返す。
+        注文処理（order_create）のトランザクションの中で呼ぶこと。
+        """
+        raise NotImplementedError
+
+    def clear(self):
+        """注文確定後にカートを空にする。トランザクションの中で呼ぶこと。"""
+        raise NotImplementedError
+
+    # async ビュー用。既定では同期版をスレッドで呼ぶ。ORM の async API で書けるものは各実装で置き換える。
+    # トランザクション（transaction.atomic）は async では使えないので、それが要る操作は同期版のままにする
+
+    async def aget_items(self) -> list:
+        return await sync_to_async(self.get_items)()
+
+    async def aadd(self, product_id: int, quantity: int = 1):
+        await sync_to_async(self.add)(product_id, quantity)
+
+    async def adecrease(self, product_id: int):
+        await sync_to_async(self.decrease)(product_id)
+
+    async def aremove(self, product_id: int):
+        await sync_to_async(self.remove)(product_id)
+
+    async def acount(self) -> int:
+        return await sync_to_async(self.count)()
+
+    async def aget_quantity(self, product_id: int) -> int:
+        return await sync_to_async(self.get_quantity)(product_id)
+
+    async def ais_empty(self) -> bool:
+        return await self.acount() <= 0
+
+
+class DatabaseCartStorage(BaseCartStorage):
+    """
+    Cart / CartItem テーブルにカートを保存する実装。
+    セッションには cart_id と、ヘッダー表示用の点数だけを持つ。
+    """
+
+    def __init__(self, request):
+        super().__init__(request)
+        self._cart = None
+        self._loaded = False
+
+    def get_cart(self, create_if_missing: bool = False) -> Optional[Cart]:
+        if not self._loaded:
+            cart_id = self.session.get('cart_id')
+            self._set_loaded(Cart.objects.filter(pk=cart_id).first() if cart_id else None, cart_id)
+
+        if self._cart is None and create_if_missing:
+            self._remember_cart(Cart.objects.create())
+        return self._cart
+
+    async def aget_cart(self, create_if_missing: bool = False) -> Optional[Cart]:
+        if not self._loaded:
+            cart_id = self.session.get('cart_id')
+            self._set_loaded(await Cart.objects.filter(pk=cart_id).afirst() if cart_id else None, cart_id)
+
+        if self._cart is None and create_if_missing:
+            self._remember_cart(await Cart.objects.acreate())
+        return self._cart
+
+    def _set_loaded(self, cart, cart_id):
+        self._cart = cart
+        if cart_id and cart is None:
+            self.is_expired = True
+            self._forget_cart()
+        self._loaded = True
+
+    def _remember_cart(self, cart):
+        self._cart = cart
+        self.session['cart_id'] = cart.pk
+        self.session[CART_TOUCHED_SESSION_KEY] = int(cart.updated_at.timestamp())
+        set_cart_count(self.request, 0)
+
+    def _forget_cart(self):
+        self.session.pop('cart_id', None)
+        self.session.pop(CART_TOUCHED_SESSION_KEY, None)
+        set_cart_count(self.request, 0)
+
+    def _touch(self, cart):
+        """
+        最終操作日時を進める（purge_carts に消されないように）。
+        書き込みを増やさないよう、前回から CART_TOUCH_INTERVAL 秒以上経ったときだけ UPDATE する。
+        """
+        now = timezone.now()
+        if now.timestamp() - self.session.get(CART_TOUCHED_SESSION_KEY, 0) >= CART_TOUCH_INTERVAL:
+            Cart.objects.filter(pk=cart.pk).update(updated_at=now)
+            self.session[CART_TOUCHED_SESSION_KEY] = int(now.timestamp())
+
+    async def _atouch(self, cart):
+        now = timezone.now()
+        if now.timestamp() - self.session.get(CART_TOUCHED_SESSION_KEY, 0) >= CART_TOUCH_INTERVAL:
+            await Cart.objects.filter(pk=cart.pk).aupdate(updated_at=now)
+            self.session[CART_TOUCHED_SESSION_KEY] = int(now.timestamp())
+
+    def get_items(self):
+        cart = self.get_cart()
+        if cart is None:
+            return []
+        items = list(cart.cart_items.select_related('product').all())
+        # 明細を読んだついでにヘッダー用の点数を正しい値に直しておく
+        set_cart_count(self.request, sum(item.quantity for item in items))
+        return items
+
+    async def aget_items(self):
+        cart = await self.aget_cart()
+        if cart is None:
+            return []
+        items = [item async for item in cart.cart_items.select_related('product')]
+        set_cart_count(self.request, sum(item.quantity for item in items))
+        return items
+
+    def add(self, product_id, quantity=1):
+        cart = self.get_cart(create_if_missing=True)
+        try:
+            with transaction.atomic():
+                self._upsert_line(cart, product_id, quantity)
+        except IntegrityError:
+            # 読んだ直後に purge_carts がカートを消した。新しいカートに入れ直す
+            self._cart = None
+            self._forget_cart()
+            cart = self.get_cart(create_if_missing=True)
+            self._upsert_line(cart, product_id, quantity)
+        self._touch(cart)
+        adjust_cart_count(self.request, quantity)
+
+    def _upsert_line(self, cart, product_id, quantity):
+        # 既存行の確認と加算を1文で行う（同時に追加されても行が重複しない）。在庫の仮押さえもここで延ばす
+        upsert_add(
+            CartItem,
+            conflict_fields=['cart_id', 'product_id'],
+            rows=[{'cart_id': cart.pk, 'product_id': product_id, 'quantity': quantity,
+                   'reserved_until': reservation_expiry()}],
+            add_fields=['quantity'],
+            replace_fields=['reserved_until'],
+        )
+
+    def decrease(self, product_id):
+        cart = self.get_cart()
+        if cart is None:
+            return
+
+        cart_item = cart.cart_items.filter(product_id=product_id).first()
+        if cart_item:
+            cart_item.quantity -= 1
+            if cart_item.quantity <= 0:
+                cart_item.delete()
+            else:
+                cart_item.save()
+            self._touch(cart)
+            adjust_cart_count(self.request, -1)
+
+    async def adecrease(self, product_id):
+        cart = await self.aget_cart()
+        if cart is None:
+            return
+
+        cart_item = await cart.cart_items.filter(product_id=product_id).afirst()
+        if cart_item:
+            cart_item.quantity -= 1
+            if cart_item.quantity <= 0:
+                await cart_item.adelete()
+            else:
+                await cart_item.asave()
+            await self._atouch(cart)
+            await aadjust_cart_count(self.request, -1)
+
+    def remove(self, product_id):
+        cart = self.get_cart()
+        if cart is None:
+            return
+
+        cart_item = cart.cart_items.filter(product_id=product_id).first()
+        if cart_item:
+            cart_item.delete()
+            self._touch(cart)
+            adjust_cart_count(self.request, -cart_item.quantity)
+
+    async def aremove(self, product_id):
+        cart = await self.aget_cart()
+        if cart is None:
+            return
+
+        cart_item = await cart.cart_items.filter(product_id=product_id).afirst()
+        if cart_item:
+            await cart_item.adelete()
+            await self._atouch(cart)
+            await aadjust_cart_count(self.request, -cart_item.quantity)
+
+    def count(self):
+        return get_cart_count(self.request)
+
+    async def acount(self):
+        return await aget_cart_count(self.request)
+
+    def get_quantity(self, product_id):
+        cart = self.get_cart()
+        if cart is None:
+            return 0
+        return cart.cart_items.filter(product_id=product_id).values_list('quantity', flat=True).first() or 0
+
+    async def aget_quantity(self, product_id):
+        cart = await self.aget_cart()
+        if cart is None:
+            return 0
+        return await cart.cart_items.filter(product_id=product_id).values_list('quantity', flat=True).afirst() or 0
+
+    @property
+    def cart_id(self):
+        return self.session.get('cart_id')
+
+    def is_empty(self):
+        cart = self.get_cart()
+        return cart is None or not cart.cart_items.exists()
+
+    async def ais_empty(self):
+        cart = await self.aget_cart()
+        return cart is None or not await cart.cart_items.aexists()
+
+    def get_checkout_cart(self):
+        return self.get_cart()
+
+    def clear(self):
+        # 明細だけでなく Cart の行も消す（空のカートを残さない）
+        cart = self.get_cart()
+        if cart is not None:
+            cart.delete()
+        transaction.on_commit(self._forget_cart)
+
+
+class SessionCartStorage(BaseCartStorage):
+    """
+    セッションに {"商品ID": 数量} の形でカートを保存する実装。
+    閲覧中・カート操作中は DB に書き込まず、注文確定のときだけ Cart / CartItem を作る。
+
+    SESSION_ENGINE に signed_cookies か cache を指定すると、セッション自体も DB を使わなくなる。
+    """
+
+    def _lines(self) -> Dict[str, int]:
+        return self.session.get(CART_LINES_SESSION_KEY, {})
+
+    def _save(self, lines: Dict[str, int]):
+        self.session[CART_LINES_SESSION_KEY] = lines
+        self.session.modified = True
+
+    def get_items(self) -> List[CartLine]:
+        lines = self._lines()
+        if not lines:
+            return []
+        products = Product.objects.in_bulk([int(pk) for pk in lines])
+        items = [CartLine(products[int(pk)], quantity) for pk, quantity in lines.items() if int(pk) in products]
+
+        return self._drop_deleted(lines, items)
+
+    async def aget_items(self) -> List[CartLine]:
+        lines = self._lines()
+        if not lines:
+            return []
+        products = await Product.objects.ain_bulk([int(pk) for pk in lines])
+        items = [CartLine(products[int(pk)], quantity) for pk, quantity in lines.items() if int(pk) in products]
+        return self._drop_deleted(lines, items)
+
+    def _drop_deleted(self, lines, items):
+        # 削除された商品はカートからも外す
+        if len(items) != len(lines):
+            self._save({str(item.product.pk): item.quantity for item in items})
+        return items
+
+    def add(self, product_id, quantity=1):
+        lines = self._lines()
+        key = str(product_id)
+        lines[key] = lines.get(key, 0) + quantity
+        self._save(lines)
+
+    def decrease(self, product_id):
+        lines = self._lines()
+        key = str(product_id)
+        if key in lines:
+            lines[key] -= 1
+            if lines[key] <= 0:
+                del lines[key]
+            self._save(lines)
+
+    def remove(self, product_id):
+        lines = self._lines()
+        if lines.pop(str(product_id), None) is not None:
+            self._save(lines)
+
+    def count(self):
+        return sum(self._lines().values())
+
+    def get_quantity(self, product_id):
+        return self._lines().get(str(product_id), 0)
+
+    # セッションだけを読み書きする操作は DB に触れないので、スレッドに移さずそのまま呼ぶ
+
+    async def aadd(self, product_id, quantity=1):
+        self.add(product_id, quantity)
+
+    async def adecrease(self, product_id):
+        self.decrease(product_id)
+
+    async def aremove(self, product_id):
+        self.remove(product_id)
+
+    async def acount(self):
+        return self.count()
+
+    async def aget_quantity(self, product_id):
+        return self.get_quantity(product_id)
+
+    def get_checkout_cart(self):
+        cart = Cart.objects.create()
+        products = set(Product.objects.filter(pk__in=[int(pk) for pk in self._lines()]).values_list('pk', flat=True))
+        CartItem.objects.bulk_create([
+            CartItem(cart=cart, product_id=int(pk), quantity=quantity)
+            for pk, quantity in self._lines().items() if int(pk) in products
+        ])
+        self._checkout_cart = cart
+        return cart
+
+    def clear(self):
+        cart = getattr(self, '_checkout_cart', None)
+        if cart is not None:
+            cart.delete()
+        transaction.on_commit(lambda: self._save({}))
+
+
+def get_cart_from_request(request) -> BaseCartStorage:
+    """
+    リクエストに紐づくカートを返す。
+    保存先は settings.CART_STORAGE で切り替える（既定は DatabaseCartStorage）。
+    """
+    if not hasattr(request, '_cart_storage'):
+        storage_class = import_string(getattr(settings, 'CART_STORAGE', 'product.cart.DatabaseCartStorage'))
+        request._cart_storage = storage_class(request)
+    return request._cart_storage
+
+
+async def aget_cart_from_request(request) -> BaseCartStorage:
+    """
+    async ビュー用の get_cart_from_request。
+    セッションを先にスレッドで読み込んでおく（DB セッションでも、以降の読み書きはメモリ上で済む）。
+    カートの読み書きには a で始まる async 版のメソッドを使うこと。
+    """
+    if not request.session.accessed:
+        await sync_to_async(request.session.get)('cart_id')
+    return get_cart_from_request(request)
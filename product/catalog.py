@@ -0,0 +1,144 @@
+import time
+
+from django.core.cache import cache
+
+
+CATALOG_VERSION_KEY = 'product:catalog-version'
+# 在庫の表示（在庫切れ・残りN点）が変わりうる操作のたびに進める
+INVENTORY_VERSION_KEY = 'product:inventory-version'
+# 商品詳細の「よく一緒に購入されている商品」を作り直すたびに進める
+RECOMMENDATION_VERSION_KEY = 'product:recommendation-version'
+# これまでに入れた仮押さえのうち、一番遅い期限（ns）
+RESERVED_UNTIL_KEY = 'product:reserved-until'
+
+
+def _get_version(key) -> int:
+    """
+    キャッシュにあるバージョン（最後に変更された時刻の ns）を返す。
+    キャッシュから消えていた場合は新しい値を発行するので、古いバージョンに戻ることはない。
+    """
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, time.time_ns(), timeout=None)
+        version = cache.get(key)
+    return version
+
+
+def _bump_version(key) -> int:
+    version = max(time.time_ns(), (cache.get(key) or 0) + 1)
+    cache.set(key, version, timeout=None)
+    return version
+
+
+def get_catalog_version() -> int:
+    """商品カタログ全体のバージョン。"""
+    return _get_version(CATALOG_VERSION_KEY)
+
+
+def bump_catalog_version() -> int:
+    """商品の追加・変更・削除のたびに呼び、カタログのバージョンを進める。"""
+    return _bump_version(CATALOG_VERSION_KEY)
+
+
+def bump_inventory_version() -> int:
+    """注文確定で在庫が減ったときに呼ぶ。"""
+    return _bump_version(INVENTORY_VERSION_KEY)
+
+
+def bump_recommendation_version() -> int:
+    return _bump_version(RECOMMENDATION_VERSION_KEY)
+
+
+async def anote_reservation(until) -> int:
+    """
+    在庫を管理している商品がカートに入った（仮押さえが増え、ほかの人が注文できる数が減った）ときに呼ぶ。
+    在庫のバージョンを進め、仮押さえの期限の最大値を until まで延ばす。
+    """
+    found = await cache.aget_many([INVENTORY_VERSION_KEY, RESERVED_UNTIL_KEY])
+    version = max(time.time_ns(), found.get(INVENTORY_VERSION_KEY, 0) + 1)
+    await cache.aset_many({
+        INVENTORY_VERSION_KEY: version,
+        RESERVED_UNTIL_KEY: max(int(until.timestamp() * 1e9), found.get(RESERVED_UNTIL_KEY, 0)),
+    }, timeout=None)
+    return version
+
+
+async def aget_storefront_versions() -> dict:
+    """
+    商品一覧・詳細の表示に関わるバージョンをまとめて読む（キャッシュへの問い合わせは通常1回）。
+    catalog / inventory / recommendation と、仮押さえの期限の最大値 reserved_until（無ければ 0）を返す。
+    """
+    keys = {'catalog': CATALOG_VERSION_KEY, 'inventory': INVENTORY_VERSION_KEY,
+            'recommendation': RECOMMENDATION_VERSION_KEY}
+    found = await cache.aget_many([*keys.values(), RESERVED_UNTIL_KEY])
+    versions = {'reserved_until': found.get(RESERVED_UNTIL_KEY, 0)}
+    for name, key in keys.items():
+        version = found.get(key)
+        if version is None:
+            await cache.aadd(key, time.time_ns(), timeout=None)
+            version = await cache.aget(key)
+        versions[name] = version
+    return versions
+
+
+def product_version_key(product_id) -> str:
+    return f'product:version:{product_id}'
+
+
+def _fill_versions(product_ids, found):
+    """キャッシュから読んだバージョンを商品ごとにし、無かった商品の分は新しい値を発行する。(versions, missing) を返す。"""
+    versions = {}
+    missing = {}
+    for pk in product_ids:
+        version = found.get(product_version_key(pk))
+        if version is None:
+            version = time.time_ns()
+            missing[product_version_key(pk)] = version
+        versions[pk] = version
+    return versions, missing
+
+
+def get_product_versions(product_ids) -> dict:
+    """
+    商品ごとのバージョンをまとめて取得する（キャッシュへの問い合わせは1回）。
+    バージョンは描画済みカードのキャッシュキーに含めるので、消えていた商品には新しい値を発行する。
+    """
+    product_ids = list(product_ids)
+    versions, missing = _fill_versions(product_ids, cache.get_many([product_version_key(pk) for pk in product_ids]))
+    if missing:
+        cache.set_many(missing, timeout=None)
+    return versions
+
+
+async def aget_product_versions(product_ids) -> dict:
+    """get_product_versions の async 版。"""
+    product_ids = list(product_ids)
+    found = await cache.aget_many([product_version_key(pk) for pk in product_ids])
+    versions, missing = _fill_versions(product_ids, found)
+    if missing:
+        await cache.aset_many(missing, timeout=None)
+    return versions
+
+
+def bump_product_version(product_id) -> int:
+    version = time.time_ns()
+    cache.set(product_version_key(product_id), version, timeout=None)
+    return version
+
+
+def attach_card_versions(products):
+    """テンプレートのフラグメントキャッシュ用に product.card_version を付ける。"""
+    products = list(products)
+    versions = get_product_versions(p.pk for p in products)
+    for product in products:
+        product.card_version = versions[product.pk]
+    return products
+
+
+async def aattach_card_versions(products):
+    """attach_card_versions の async 版。"""
+    products = list(products)
+    versions = await aget_product_versions(p.pk for p in products)
+    for product in products:
+        product.card_version = versions[product.pk]
+    return products
@@ -0,0 +1,86 @@
+"""
+商品一覧・詳細の条件付き GET（If-None-Match / If-Modified-Since に 304 Not Modified で答える）。
+
+ページを描画せずに、キャッシュにあるバージョン（catalog.aget_storefront_versions）とリクエストの情報だけで
+ETag と Last-Modified を決める。変わっていなければ、商品のクエリも描画もせずに 304 を返す。
+
+ETag に含めるもの
+- 商品カタログ・在庫（・商品詳細ではおすすめ）のバージョン
+- 仮押さえが残っている可能性があるか（最後の仮押さえの期限が過ぎると ETag が変わり、在庫の表示を出し直す）
+- パス（ページ・並び順のクエリを含む）
+- ヘッダーのカートの点数と、CSRF の Cookie（フォームの CSRF トークンはこれに対応する）
+- CONDITIONAL_GET_SALT（デプロイのたびに変えて、テンプレートの変更を反映させる）
+仮押さえが減ったとき（数量を減らす・削除・期限切れ）は在庫のバージョンを進めないので、最後の仮押さえの期限が
+過ぎるまで、注文できる数が実際より少なく表示されることがある（カート追加・注文確定は毎回 DB で確かめる）。
+
+CSRF トークンとカートの点数が入るページなので、共有キャッシュには置かせない（private, no-cache）。
+フラッシュメッセージを表示するリクエストは条件付き GET にしない。
+初めての訪問では描画のときに CSRF の Cookie が発行されるので、ETag が揃うのは2回目のリクエストから。
+"""
+import hashlib
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+from django.conf import settings
+from django.contrib import messages
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date
+
+from .catalog import aget_storefront_versions
+
+
+@dataclass
+class Validators:
+    etag: str
+    # UNIX 時間（秒）
+    last_modified: int
+
+
+async def avalidators(request, cart, recommendations: bool = False) -> Optional[Validators]:
+    """
+    このリクエストの ETag と Last-Modified。条件付き GET にしないリクエストでは None。
+    cart は aget_cart_from_request() の戻り値（セッションは読み込み済みであること）。
+    """
+    if request.method not in ('GET', 'HEAD'):
+        return None
+    cart_count = await cart.acount()
+    if len(messages.get_messages(request)):
+        return None
+
+    versions = await aget_storefront_versions()
+    changed = [versions['catalog'], versions['inventory']]
+    if recommendations:
+        changed.append(versions['recommendation'])
+    reservations_live = time.time_ns() < versions['reserved_until']
+    if versions['reserved_until'] and not reservations_live:
+        # 仮押さえがすべて期限切れになった時刻も、在庫の表示が変わった時刻として扱う
+        changed.append(versions['reserved_until'])
+
+    parts = (
+        getattr(settings, 'CONDITIONAL_GET_SALT', ''), request.get_full_path(), *changed, reservations_live,
+        cart_count, request.COOKIES.get(settings.CSRF_COOKIE_NAME, ''),
+    )
+    # CSRF トークンは描画のたびにマスクが変わり、バイト列は一致しないので弱い ETag にする
+    digest = hashlib.blake2b(repr(parts).encode('utf-8'), digest_size=16).hexdigest()
+    return Validators(etag=f'W/"{digest}"', last_modified=max(changed) // 10 ** 9)
+
+
+def not_modified(request, validators: Optional[Validators]):
+    """リクエストの If-None-Match / If-Modified-Since と一致すれば 304 を返す。そうでなければ None。"""
+    if validators is None:
+        return None
+    response = get_conditional_response(request, etag=validators.etag, last_modified=validators.last_modified)
+    if response is not None:
+        add_headers(response, validators)
+    return response
+
+
+def add_headers(response, validators: Optional[Validators]):
+    """ETag・Last-Modified と、ブラウザに毎回確かめさせる Cache-Control を付ける。"""
+    if validators is not None:
+        response.headers['ETag'] = validators.etag
+        response.headers['Last-Modified'] = http_date(validators.last_modified)
+    patch_cache_control(response, private=True, no_cache=True)
+    patch_vary_headers(response, ('Cookie',))
+    return response
@@ -0,0 +1,78 @@
+from typing import Dict, List, Sequence
+
+from django.db import IntegrityError, connection, transaction
+from django.db.models import F
+
+
+def supports_upsert() -> bool:
+    """INSERT ... ON CONFLICT DO UPDATE が使えるか（PostgreSQL / SQLite 3.24 以降）。"""
+    if connection.vendor == 'postgresql':
+        return True
+    if connection.vendor == 'sqlite':
+        return connection.Database.sqlite_version_info >= (3, 24, 0)
+    return False
+
+
+def upsert_add(model, conflict_fields: Sequence[str], rows: List[Dict], add_fields: Sequence[str],
+               replace_fields: Sequence[str] = ()):
+    """
+    rows を1文で挿入し、conflict_fields が重複した行は add_fields を加算する（replace_fields は置き換える）。
+      INSERT INTO t (...) VALUES (...)
+      ON CONFLICT (conflict_fields) DO UPDATE SET f = t.f + EXCLUDED.f, g = EXCLUDED.g
+    conflict_fields には一意制約が張られている必要がある。
+    ON CONFLICT が使えない DB では UPDATE → INSERT（競合したら UPDATE し直す）で代用する。
+    """
+    if not rows:
+        return
+
+    if not supports_upsert():
+        for row in rows:
+            _update_or_insert(model, conflict_fields, row, add_fields, replace_fields)
+        return
+
+    qn = connection.ops.quote_name
+    table = qn(model._meta.db_table)
+    columns = list(rows[0])
+    db_columns = [model._meta.get_field(name).column for name in columns]
+    updates = ', '.join([
+        *(
+            f'{qn(model._meta.get_field(name).column)} = {table}.{qn(model._meta.get_field(name).column)} '
+            f'+ EXCLUDED.{qn(model._meta.get_field(name).column)}'
+            for name in add_fields
+        ),
+        *(
+            f'{qn(model._meta.get_field(name).column)} = EXCLUDED.{qn(model._meta.get_field(name).column)}'
+            for name in replace_fields
+        ),
+    ])
+    conflict = ', '.join(qn(model._meta.get_field(name).column) for name in conflict_fields)
+    sql = (
+        f'INSERT INTO {table} ({", ".join(qn(c) for c in db_columns)}) '
+        f'VALUES ({", ".join(["%s"] * len(columns))}) '
+        f'ON CONFLICT ({conflict}) DO UPDATE SET {updates}'
+    )
+
+    fields = [model._meta.get_field(name) for name in columns]
+    params = [
+        [field.get_db_prep_value(row[name], connection) for name, field in zip(columns, fields)]
+        for row in rows
+    ]
+    with connection.cursor() as cursor:
+        if len(params) == 1:
+            cursor.execute(sql, params[0])
+        else:
+            cursor.executemany(sql, params)
+
+
+def _update_or_insert(model, conflict_fields, row, add_fields, replace_fields=()):
+    lookup = {name: row[name] for name in conflict_fields}
+    increments = {name: F(name) + row[name] for name in add_fields}
+    increments.update({name: row[name] for name in replace_fields})
+    if model._default_manager.filter(**lookup).update(**increments):
+        return
+    try:
+        with transaction.atomic():
+            model._default_manager.create(**row)
+    except IntegrityError:
+        # 同時に挿入された行があった
+        model._default_manager.filter(**lookup).update(**increments)
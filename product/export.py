@@ -0,0 +1,125 @@
+import csv
+import zlib
+from datetime import timedelta
+from typing import Iterable, Iterator, Optional
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import BigIntegerField, Subquery, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .models import Order, OrderItem
+
+
+# 注文明細1行につき1レコード。カード情報は出力しない
+EXPORT_FIELDS = [
+    ('order_id', 'order_id'),
+    ('created_at', 'order__created_at'),
+    ('status', 'order__status'),
+    ('last_name', 'order__last_name'),
+    ('first_name', 'order__first_name'),
+    ('email', 'order__email'),
+    ('address', 'order__address'),
+    ('order_total', 'order__total_price'),
+    ('item_id', 'id'),
+    ('product_id', 'product_id'),
+    ('product_name', 'product_name'),
+    ('product_price', 'product_price'),
+    ('quantity', 'quantity'),
+]
+EXPORT_COLUMNS = [name for name, _ in EXPORT_FIELDS]
+
+CONTENT_TYPES = {
+    'csv': 'text/csv; charset=utf-8',
+    'ndjson': 'application/x-ndjson; charset=utf-8',
+}
+
+
+def export_queryset(since_id: Optional[int] = None, lag_seconds: Optional[int] = None):
+    """
+    出力対象の注文明細。注文ID順に並べるので、途中で止まっても since_id から再開できる。
+    lag_seconds を指定すると、作成から lag_seconds 経っていない最初の注文の手前までに絞る。
+    注文IDの採番順とコミット順は一致しないので、これが無いとまだコミットされていない小さい ID の注文を
+    次回の since_id で飛ばしてしまう（rollups.update_rollups と同じ対処）。
+    """
+    queryset = OrderItem.objects.order_by('order_id', 'id')
+    if since_id:
+        queryset = queryset.filter(order_id__gt=since_id)
+    if lag_seconds is not None:
+        cutoff = timezone.now() - timedelta(seconds=lag_seconds)
+        recent = Order.objects.filter(created_at__gte=cutoff)
+        if since_id:
+            recent = recent.filter(pk__gt=since_id)
+        first_recent = Subquery(recent.order_by('pk').values('pk')[:1])
+        # 1本のクエリのまま絞る（該当する注文が無ければ上限なし）
+        queryset = queryset.filter(
+            order_id__lt=Coalesce(first_recent, Value(2 ** 63 - 1), output_field=BigIntegerField())
+        )
+    return queryset
+
+
+def iter_rows(queryset, chunk_size: int = 2000) -> Iterator[tuple]:
+    """
+    サーバーサイドカーソル（PostgreSQL）で chunk_size 件ずつ読み出す。
+    モデルのインスタンスは作らず、タプルのまま流す。
+    """
+    return queryset.values_list(*[lookup for _, lookup in EXPORT_FIELDS]).iterator(chunk_size=chunk_size)
+
+
+class LastOrderId:
+    """
+    書き出した行のうち最大の注文ID（次回の差分出力の since_id）。
+    書き出しの途中にコミットされた注文を含めないよう、クエリし直さずに流れた行から求める。
+    """
+
+    def __init__(self):
+        self.value: Optional[int] = None
+
+    def track(self, rows: Iterable[tuple]) -> Iterator[tuple]:
+        for row in rows:
+            if self.value is None or row[0] > self.value:
+                self.value = row[0]
+            yield row
+
+
+class _Echo:
+    def write(self, value):
+        return value
+
+
+def iter_csv(rows: Iterable[tuple]) -> Iterator[bytes]:
+    writer = csv.writer(_Echo())
+    yield writer.writerow(EXPORT_COLUMNS).encode('utf-8')
+    for row in rows:
+        yield writer.writerow(row).encode('utf-8')
+
+
+def iter_ndjson(rows: Iterable[tuple]) -> Iterator[bytes]:
+    encoder = DjangoJSONEncoder(ensure_ascii=False, separators=(',', ':'))
+    for row in rows:
+        yield (encoder.encode(dict(zip(EXPORT_COLUMNS, row))) + '\n').encode('utf-8')
+
+
+def iter_gzip(chunks: Iterable[bytes], buffer_size: int = 64 * 1024) -> Iterator[bytes]:
+    """チャンクをその場で gzip 圧縮しながら流す。"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    pending = []
+    pending_size = 0
+    for chunk in chunks:
+        pending.append(chunk)
+        pending_size += len(chunk)
+        if pending_size >= buffer_size:
+            data = compressor.compress(b''.join(pending))
+            pending, pending_size = [], 0
+            if data:
+                yield data
+    yield compressor.compress(b''.join(pending)) + compressor.flush()
+
+
+def iter_export(queryset, fmt: str = 'csv', compress: bool = False, chunk_size: int = 2000,
+                last_order_id: Optional[LastOrderId] = None) -> Iterator[bytes]:
+    rows = iter_rows(queryset, chunk_size=chunk_size)
+    if last_order_id is not None:
+        rows = last_order_id.track(rows)
+    chunks = iter_ndjson(rows) if fmt == 'ndjson' else iter_csv(rows)
+    return iter_gzip(chunks) if compress else chunks
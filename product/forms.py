@@ -1,12 +1,15 @@
 from django import forms
+from django.utils import timezone
 from .models import Order
 import re
+import uuid
+from datetime import datetime, time, timedelta
 
 class OrderForm(forms.ModelForm):
     class Meta:
         model = Order
         fields = ['last_name', 'first_name', 'username', 'email', 'address',
-                    'card_name', 'card_number', 'card_expiry']
+                    'card_name', 'card_number', 'card_expiry', 'idempotency_key']
         
         widgets = {
             'last_name': forms.TextInput(attrs={'placeholder': '姓', 'class': 'form-control'}),
@@ -14,8 +17,27 @@ class OrderForm(forms.ModelForm):
             'username': forms.TextInput(attrs={'placeholder': 'ユーザー名', 'class': 'form-control'}),
             'email': forms.EmailInput(attrs={'placeholder': 'メールアドレス', 'class': 'form-control'}),
             'address': forms.TextInput(attrs={'placeholder': '住所', 'class': 'form-control'}),
+            'idempotency_key': forms.HiddenInput(),
         }
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # 表示のたびに新しいキーを発行する（同じ画面からの再送は同じキーになる）
+        if not self.is_bound:
+            self.initial.setdefault('idempotency_key', uuid.uuid4().hex)
+
+    def clean_idempotency_key(self):
+        return self.cleaned_data.get('idempotency_key') or None
+
+    def validate_unique(self):
+        # キーの重複は order_create 側で「同じ注文の再送」として扱うので、入力エラーにはしない
+        exclude = self._get_validation_exclusions()
+        exclude.add('idempotency_key')
+        try:
+            self.instance.validate_unique(exclude=exclude)
+        except forms.ValidationError as e:
+            self._update_errors(e)
+
     def clean_card_number(self):
         card_number = self.cleaned_data.get('card_number')
         
@@ -35,3 +57,49 @@ class OrderForm(forms.ModelForm):
             raise forms.ValidationError("有効期限は MM/YY の形式で入力してください。")
         
         return expiry
+
+
+class OrderFilterForm(forms.Form):
+    status = forms.ChoiceField(
+        choices=[('', 'すべて')] + Order.STATUS_CHOICES,
+        required=False,
+        widget=forms.Select(attrs={'class': 'form-select'}),
+    )
+    date_from = forms.DateField(
+        required=False,
+        widget=forms.DateInput(attrs={'type': 'date', 'class': 'form-control'}),
+    )
+    date_to = forms.DateField(
+        required=False,
+        widget=forms.DateInput(attrs={'type': 'date', 'class': 'form-control'}),
+    )
+
+    def filter(self, queryset, prefix=''):
+        """
+        一覧の絞り込み条件を付ける。日付は created_at の範囲条件にして、インデックスが使えるようにする。
+        注文明細など、注文を関連先に持つクエリセットには prefix='order__' を渡す。
+        """
+        if not self.is_valid():
+            return queryset
+
+        status = self.cleaned_data.get('status')
+        date_from = self.cleaned_data.get('date_from')
+        date_to = self.cleaned_data.get('date_to')
+
+        if status:
+            queryset = queryset.filter(**{f'{prefix}status': status})
+        if date_from:
+            queryset = queryset.filter(**{f'{prefix}created_at__gte': _start_of_day(date_from)})
+        if date_to:
+            queryset = queryset.filter(**{f'{prefix}created_at__lt': _start_of_day(date_to + timedelta(days=1))})
+        return queryset
+
+
+class OrderExportForm(OrderFilterForm):
+    format = forms.ChoiceField(choices=[('csv', 'CSV'), ('ndjson', 'NDJSON')], required=False)
+    since_id = forms.IntegerField(required=False, min_value=0)
+    gzip = forms.BooleanField(required=False)
+
+
+def _start_of_day(date):
+    return timezone.make_aware(datetime.combine(date, time.min))
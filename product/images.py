@@ -0,0 +1,116 @@
+import posixpath
+from io import BytesIO
+from typing import Iterable, List, Optional
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image, ImageOps
+
+from .models import Product
+from .storage import known_derivative_widths, remember_derivative_widths, save_as
+
+
+# 派生画像の形式。WebP を優先し、対応していないブラウザには JPEG を返す
+FORMATS = {
+    'webp': {'format': 'WEBP', 'quality': 80, 'method': 4},
+    'jpg': {'format': 'JPEG', 'quality': 82, 'optimize': True, 'progressive': True},
+}
+
+
+def get_widths() -> List[int]:
+    return sorted(getattr(settings, 'PRODUCT_IMAGE_WIDTHS', [320, 640, 960]))
+
+
+def derivative_name(name: str, width: int, ext: str) -> str:
+    """
+    元画像と同じ場所の derived/ 以下に置く。名前は元画像から決まるので、DB に URL を持たなくてよい。
+      product_image/denim.png -> product_image/derived/denim_640w.webp
+    """
+    directory, filename = posixpath.split(name)
+    stem = posixpath.splitext(filename)[0]
+    return posixpath.join(directory, 'derived', f'{stem}_{width}w.{ext}')
+
+
+def _flatten(image: Image.Image) -> Image.Image:
+    """JPEG は透過を持てないので、白背景に合成する。"""
+    if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel('A'))
+        return background
+    return image.convert('RGB')
+
+
+def _encode(image: Image.Image, ext: str) -> bytes:
+    if ext == 'jpg':
+        image = _flatten(image)
+    elif image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'A' in image.getbands() or 'transparency' in image.info else 'RGB')
+    buffer = BytesIO()
+    image.save(buffer, **FORMATS[ext])
+    return buffer.getvalue()
+
+
+def generate_derivatives(name: str, storage=None, widths: Optional[Iterable[int]] = None) -> List[int]:
+    """
+    元画像 name から、幅ごとの WebP / JPEG を作って storage に保存し、作った幅の一覧を返す。
+    元画像より大きい幅には拡大しない（元画像が一番小さい幅より狭い場合は、元の幅で1つだけ作る）。
+    """
+    storage = storage or default_storage
+    with storage.open(name, 'rb') as f:
+        original = Image.open(f)
+        original = ImageOps.exif_transpose(original)
+        original.load()
+
+    targets = [w for w in (widths or get_widths()) if w <= original.width] or [original.width]
+    for width in targets:
+        height = max(round(original.height * width / original.width), 1)
+        resized = original.resize((width, height), Image.LANCZOS) if width != original.width else original
+        for ext in FORMATS:
+            save_as(storage, derivative_name(name, width, ext), ContentFile(_encode(resized, ext)))
+    return targets
+
+
+def delete_derivatives(name: str, widths: Iterable[int], storage=None):
+    storage = storage or default_storage
+    for width in widths:
+        for ext in FORMATS:
+            target = derivative_name(name, width, ext)
+            if storage.exists(target):
+                storage.delete(target)
+
+
+def build_for_name(name: str):
+    """バックフィルのワーカープロセスで実行する。DB には触らない。"""
+    return name, generate_derivatives(name)
+
+
+def update_product_images(product, previous_name: str = '', previous_widths: Iterable[int] = ()):
+    """
+    商品画像の派生画像を作り直し、product.image_widths を保存する。
+    画像が差し替え・削除された場合は、前の画像の派生画像を消す。
+    """
+    name = product.image.name if product.image else ''
+    # 同じ内容の画像は1ファイルを共有するので、他の商品が使っていない場合だけ消す
+    if previous_name and previous_name != name and not Product.objects.filter(image=previous_name).exists():
+        delete_derivatives(previous_name, previous_widths)
+
+    widths = []
+    if name:
+        # 登録済みの画像なら派生画像も作成済み（seed_products の再実行などで作り直さない）
+        widths = known_derivative_widths(name)
+        if widths is None:
+            widths = generate_derivatives(name)
+            remember_derivative_widths(name, widths)
+    product.image_widths = widths
+    # save() なので post_save でカードのキャッシュも更新される
+    product.save(update_fields=['image_widths'])
+
+
+def storage_url(name: str, storage=None) -> str:
+    return (storage or default_storage).url(name)
+
+
+def srcset(name: str, widths: Iterable[int], ext: str, storage=None) -> str:
+    return ', '.join(f'{storage_url(derivative_name(name, w, ext), storage)} {w}w' for w in widths)
@@ -0,0 +1,129 @@
+"""
+在庫の管理。
+
+- Product.stock が空の商品は在庫を管理しない（いくらでも注文できる）
+- 注文確定時は、カートのすべての行の在庫を1文の条件付き UPDATE で減らす（decrement_stock）。
+  行ロック（select_for_update）で先に読んで確かめる方式と違い、確認と減算が同じ文なので
+  同時に注文が確定しても在庫がマイナスになる（売り越す）ことがない
+- カートに入れた数量は STOCK_RESERVATION_MINUTES 分のあいだ仮押さえとして扱い、
+  ほかの人のカート追加や在庫表示から差し引く。仮押さえは期限が来れば自然に外れ、
+  注文確定時には見ない（実際の在庫が足りていれば、先に注文を確定した人が買える）
+"""
+from datetime import timedelta
+from typing import Dict, Iterable, List, Optional
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, F, Q, Sum, Value, When
+from django.utils import timezone
+
+from .catalog import bump_inventory_version
+from .models import CartItem, Product
+
+
+class OutOfStock(Exception):
+    """在庫が足りない。lines は減らそうとした {商品ID: 数量}。"""
+
+    def __init__(self, lines: Dict[int, int]):
+        self.lines = lines
+        super().__init__(f'在庫が足りない商品があります: {sorted(lines)}')
+
+
+def reservation_expiry():
+    """今カートに入れた数量の仮押さえの期限。"""
+    return timezone.now() + timedelta(minutes=getattr(settings, 'STOCK_RESERVATION_MINUTES', 15))
+
+
+def _reserved_items(product_ids: Iterable[int], exclude_cart_id: Optional[int] = None):
+    items = CartItem.objects.filter(product_id__in=list(product_ids), reserved_until__gt=timezone.now())
+    if exclude_cart_id:
+        items = items.exclude(cart_id=exclude_cart_id)
+    return items.values('product_id').annotate(total=Sum('quantity')).values_list('product_id', 'total')
+
+
+def reserved_quantities(product_ids: Iterable[int], exclude_cart_id: Optional[int] = None) -> Dict[int, int]:
+    """商品ごとの、期限内の仮押さえの合計（exclude_cart_id のカートの分は除く）。1クエリ。"""
+    return dict(_reserved_items(product_ids, exclude_cart_id))
+
+
+async def areserved_quantities(product_ids: Iterable[int], exclude_cart_id: Optional[int] = None) -> Dict[int, int]:
+    """reserved_quantities の async 版。"""
+    return {pk: total async for pk, total in _reserved_items(product_ids, exclude_cart_id)}
+
+
+def _set_availability(products: List[Product], reserved: Dict[int, int]):
+    threshold = getattr(settings, 'LOW_STOCK_THRESHOLD', 5)
+    for product in products:
+        if product.stock is None:
+            product.available = None
+            product.low_stock = False
+        else:
+            product.available = max(product.stock - reserved.get(product.pk, 0), 0)
+            product.low_stock = product.available <= threshold
+
+
+def attach_availability(products: List[Product], exclude_cart_id: Optional[int] = None) -> List[Product]:
+    """
+    各商品に available（注文できる数。在庫を管理しない商品は None）と low_stock を付ける。
+    在庫を管理している商品が無ければクエリは発行しない。
+    テンプレートでは、描画済みカードのキャッシュ（{% cache %}）の外で使うこと。
+    """
+    tracked = [product.pk for product in products if product.stock is not None]
+    _set_availability(products, reserved_quantities(tracked, exclude_cart_id) if tracked else {})
+    return products
+
+
+async def aattach_availability(products: List[Product], exclude_cart_id: Optional[int] = None) -> List[Product]:
+    """attach_availability の async 版。"""
+    tracked = [product.pk for product in products if product.stock is not None]
+    _set_availability(products, await areserved_quantities(tracked, exclude_cart_id) if tracked else {})
+    return products
+
+
+def can_reserve(product: Product, quantity: int, cart_id: Optional[int] = None) -> bool:
+    """カートの数量を quantity にしてよいか（ほかのカートの仮押さえを差し引いた在庫で判定する）。"""
+    if product.stock is None:
+        return True
+    reserved = reserved_quantities([product.pk], exclude_cart_id=cart_id).get(product.pk, 0)
+    return quantity <= product.stock - reserved
+
+
+async def acan_reserve(product: Product, quantity: int, cart_id: Optional[int] = None) -> bool:
+    """can_reserve の async 版。"""
+    if product.stock is None:
+        return True
+    reserved = (await areserved_quantities([product.pk], exclude_cart_id=cart_id)).get(product.pk, 0)
+    return quantity <= product.stock - reserved
+
+
+def decrement_stock(lines: Dict[int, int]):
+    """
+    {商品ID: 数量} の在庫をまとめて減らす。トランザクションの中で呼ぶこと。
+      UPDATE product SET stock = stock - CASE id WHEN 1 THEN 2 ... END
+      WHERE id IN (...) AND (stock IS NULL OR stock >= CASE id WHEN 1 THEN 2 ... END)
+    在庫を管理しない商品（stock が NULL）もこの文で対象になる（NULL - q は NULL のまま）ので、
+    更新された行数が商品数より少なければ、どれかの在庫が足りない。そのときは OutOfStock を送出する
+    （呼び出し側のトランザクションごとロールバックされ、減らした分も元に戻る）。
+    どの商品が足りなかったかは、ロールバックの後で short_products() で調べる。
+    在庫を管理している商品は updated_at も進め、コミットされたら在庫のバージョンを進める（商品一覧・詳細の ETag が変わる）。
+    """
+    if not lines:
+        return
+    quantity = Case(*(When(pk=pk, then=Value(q)) for pk, q in lines.items()))
+    updated = Product.objects.filter(pk__in=list(lines)).filter(
+        Q(stock__isnull=True) | Q(stock__gte=quantity)
+    ).update(
+        stock=F('stock') - quantity,
+        updated_at=Case(When(stock__isnull=False, then=Value(timezone.now())), default=F('updated_at')),
+    )
+    if updated != len(lines):
+        raise OutOfStock(lines)
+    transaction.on_commit(bump_inventory_version)
+
+
+def short_products(lines: Dict[int, int]) -> List[Product]:
+    """lines のうち、今の在庫では足りない商品。"""
+    return [
+        product for product in Product.objects.filter(pk__in=list(lines), stock__isnull=False).only('name', 'stock')
+        if product.stock < lines[product.pk]
+    ]
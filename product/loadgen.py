@@ -0,0 +1,179 @@
+import random
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from decimal import Decimal
+from typing import Callable, List, Optional, Tuple
+
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from . import search
+from .catalog import bump_catalog_version
+from .models import Cart, CartItem, Order, OrderItem, Product, StoredFile
+
+
+ADJECTIVES = ['定番の', '大きな', '小さな', '軽い', '丈夫な', '限定', '新作', 'シンプルな', '上質な', 'カラフルな']
+ITEMS = ['Tシャツ', 'デニムパンツ', 'トートバッグ', 'カレンダー', 'キャップ', '靴', 'ティッシュ', '水',
+         'マグカップ', 'ノート', 'ペン', 'タオル', 'ソックス', 'リュック', '傘']
+LAST_NAMES = ['山田', '佐藤', '鈴木', '高橋', '田中', '伊藤', '渡辺', '中村']
+FIRST_NAMES = ['太郎', '花子', '一郎', '次郎', '美咲', '翔太', '陽菜', '蓮']
+PREFECTURES = ['東京都', '大阪府', '北海道', '福岡県', '愛知県', '神奈川県']
+
+
+@contextmanager
+def historical_timestamps(model, *field_names):
+    """
+    auto_now_add / auto_now を一時的に止め、created_at などに過去の日時を入れられるようにする。
+    bulk_create でも pre_save が呼ばれて現在時刻で上書きされるため。
+    """
+    fields = [model._meta.get_field(name) for name in field_names]
+    saved = [(f.auto_now, f.auto_now_add) for f in fields]
+    for f in fields:
+        f.auto_now = f.auto_now_add = False
+    try:
+        yield
+    finally:
+        for f, (auto_now, auto_now_add) in zip(fields, saved):
+            f.auto_now, f.auto_now_add = auto_now, auto_now_add
+
+
+def image_pool() -> List[Tuple[str, list]]:
+    """
+    既に保存済みの画像（名前と派生画像の幅）の一覧。商品にはこの名前を入れるだけで、
+    画像をアップロードし直さない。
+    """
+    pool = list(StoredFile.objects.exclude(name='').values_list('name', 'derivative_widths'))
+    if not pool:
+        pool = list(
+            Product.objects.exclude(image='').exclude(image__isnull=True)
+            .values_list('image', 'image_widths').distinct()
+        )
+    return [(name, widths or []) for name, widths in pool]
+
+
+class LoadDataGenerator:
+    """
+    負荷試験用のデータを bulk_create でまとめて作る。
+    乱数は seed から作るので、同じ引数なら同じ内容のデータになる（ID は既存のデータ次第）。
+    """
+
+    def __init__(self, seed: int = 0, batch_size: int = 5000, end: Optional[datetime] = None,
+                 progress: Optional[Callable[[str, int, int, float], None]] = None):
+        self.rng = random.Random(seed)
+        self.batch_size = batch_size
+        self.end = end or timezone.now().replace(minute=0, second=0, microsecond=0)
+        self.progress = progress
+        self._products: List[Tuple[int, str, Decimal]] = []
+
+    def _report(self, label, done, total, started):
+        if self.progress:
+            self.progress(label, done, total, time.monotonic() - started)
+
+    def _batches(self, total):
+        for start in range(0, total, self.batch_size):
+            yield start, min(self.batch_size, total - start)
+
+    def load_products(self):
+        """注文・カートに使う商品（ID・名前・価格）を読み込む。"""
+        self._products = list(Product.objects.order_by('pk').values_list('pk', 'name', 'price'))
+        return self._products
+
+    def create_products(self, count: int) -> int:
+        rng = self.rng
+        images = image_pool()
+        offset = (Product.objects.aggregate(n=Max('pk'))['n'] or 0) + 1
+        backend = search.get_backend()
+        started = time.monotonic()
+
+        for start, size in self._batches(count):
+            batch = []
+            for i in range(start, start + size):
+                image, widths = rng.choice(images) if images else ('', [])
+                batch.append(Product(
+                    name=f'{rng.choice(ADJECTIVES)}{rng.choice(ITEMS)} No.{offset + i}',
+                    description=f'{rng.choice(ADJECTIVES)}{rng.choice(ITEMS)}',
+                    price=Decimal(rng.randrange(1, 200) * 100),
+                    image=image,
+                    image_widths=widths,
+                ))
+            with transaction.atomic():
+                created = Product.objects.bulk_create(batch)
+                # bulk_create は post_save を送らないので、検索インデックスも自分で入れる
+                backend.index(created)
+            self._report('商品', start + size, count, started)
+
+        # カードのキャッシュ・オートコンプリートのインデックスを作り直させる
+        bump_catalog_version()
+        self.load_products()
+        return count
+
+    def create_carts(self, count: int, max_items: int = 5, days: int = 30) -> int:
+        rng = self.rng
+        products = self._products or self.load_products()
+        if not products:
+            return 0
+        started = time.monotonic()
+        span = days * 24 * 60 * 60
+
+        with historical_timestamps(Cart, 'created_at'):
+            for start, size in self._batches(count):
+                carts = []
+                for _ in range(size):
+                    at = self.end - timedelta(seconds=rng.randrange(span))
+                    carts.append(Cart(created_at=at, updated_at=at))
+                with transaction.atomic():
+                    carts = Cart.objects.bulk_create(carts)
+                    items = []
+                    for cart in carts:
+                        picked = rng.sample(products, min(rng.randint(1, max_items), len(products)))
+                        items.extend(
+                            CartItem(cart_id=cart.pk, product_id=pk, quantity=rng.randint(1, 3))
+                            for pk, _, _ in picked
+                        )
+                    CartItem.objects.bulk_create(items)
+                self._report('カート', start + size, count, started)
+        return count
+
+    def create_orders(self, count: int, max_items: int = 4, days: int = 365) -> int:
+        """
+        過去 days 日に散らばった注文を、古い順に作る（ID の順と注文日時の順が揃う、本番と同じ並び）。
+        """
+        rng = self.rng
+        products = self._products or self.load_products()
+        if not products:
+            return 0
+        started = time.monotonic()
+        begin = self.end - timedelta(days=days)
+        step = timedelta(days=days) / max(count, 1)
+
+        with historical_timestamps(Order, 'created_at'):
+            for start, size in self._batches(count):
+                orders, lines = [], []
+                for i in range(start, start + size):
+                    picked = rng.sample(products, min(rng.randint(1, max_items), len(products)))
+                    quantities = [rng.randint(1, 3) for _ in picked]
+                    last_name, first_name = rng.choice(LAST_NAMES), rng.choice(FIRST_NAMES)
+                    orders.append(Order(
+                        last_name=last_name,
+                        first_name=first_name,
+                        username=f'user{rng.randrange(100000)}',
+                        email=f'user{i}@example.com',
+                        address=f'{rng.choice(PREFECTURES)}{rng.randint(1, 9)}-{rng.randint(1, 30)}',
+                        total_price=sum(price * q for (_, _, price), q in zip(picked, quantities)),
+                        status='paid' if rng.random() < 0.8 else 'pending',
+                        created_at=begin + step * (i + rng.random()),
+                    ))
+                    lines.append(list(zip(picked, quantities)))
+
+                with transaction.atomic():
+                    orders = Order.objects.bulk_create(orders)
+                    OrderItem.objects.bulk_create([
+                        OrderItem(order_id=order.pk, product_id=pk, product_name=name,
+                                  product_price=price, quantity=quantity)
+                        for order, order_lines in zip(orders, lines)
+                        for (pk, name, price), quantity in order_lines
+                    ])
+                self._report('注文', start + size, count, started)
+        return count
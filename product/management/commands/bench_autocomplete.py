@@ -0,0 +1,51 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from product.autocomplete import build_index
+from product.models import Product
+
+
+class Command(BaseCommand):
+    help = '入力補完のインデックス検索と icontains クエリの速度を比較します。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('prefixes', nargs='*', help='計測する入力（省略時は商品名の先頭1〜2文字）')
+        parser.add_argument('--iterations', type=int, default=1000)
+        parser.add_argument('--limit', type=int, default=10)
+
+    def _measure(self, func, prefixes, iterations):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            for prefix in prefixes:
+                func(prefix)
+        return (time.perf_counter() - start) / (iterations * len(prefixes))
+
+    def handle(self, *args, **options):
+        iterations = options['iterations']
+        limit = options['limit']
+
+        start = time.perf_counter()
+        index = build_index()
+        build_time = time.perf_counter() - start
+
+        prefixes = options['prefixes']
+        if not prefixes:
+            names = index.names[:50]
+            prefixes = sorted({name[:n] for name in names for n in (1, 2) if name[:n]})
+        if not prefixes:
+            self.stdout.write(self.style.WARNING('商品が登録されていません。'))
+            return
+
+        index_time = self._measure(lambda p: index.lookup(p, limit), prefixes, iterations)
+        db_iterations = max(1, iterations // 100)
+        db_time = self._measure(
+            lambda p: list(Product.objects.filter(name__icontains=p).values_list('pk', 'name')[:limit]),
+            prefixes, db_iterations,
+        )
+
+        self.stdout.write(f'商品数: {len(index)} / 入力パターン: {len(prefixes)}')
+        self.stdout.write(f'インデックス構築: {build_time * 1000:.1f} ms')
+        self.stdout.write(f'前方一致インデックス: {index_time * 1e6:.2f} µs/回')
+        self.stdout.write(f'icontains クエリ:     {db_time * 1e6:.2f} µs/回')
+        self.stdout.write(self.style.SUCCESS(f'{db_time / index_time:.0f} 倍高速'))
@@ -0,0 +1,43 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from product import bench
+
+
+class Command(BaseCommand):
+    help = '同じ数の同時接続を WSGI（同期ワーカー）と ASGI（イベントループ）で処理し、スループットと応答時間を比べます。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='*', help='リクエストするパス（省略時は一覧・詳細・カート）')
+        parser.add_argument('--connections', type=int, default=50, help='同時に接続するクライアントの数')
+        parser.add_argument('--requests', type=int, default=500, help='リクエストの総数')
+        parser.add_argument('--workers', type=int, default=4, help='WSGI の同期ワーカーの数（gunicorn --workers）')
+        parser.add_argument('--db-latency-ms', type=float, default=0,
+                            help='クエリごとに待たせる時間（ネットワーク越しの DB を模す）')
+        parser.add_argument('--json', action='store_true', help='結果を JSON で出力する')
+
+    def handle(self, *args, **options):
+        paths = options['paths'] or bench.default_paths()
+        if len(paths) < 3 and not options['paths']:
+            raise CommandError('商品がありません。先に seed_products か generate_load_data を実行してください。')
+
+        results = bench.compare(
+            paths, connections_count=options['connections'], requests=options['requests'],
+            workers=options['workers'], db_latency_ms=options['db_latency_ms'],
+        )
+        if options['json']:
+            self.stdout.write(json.dumps(results, ensure_ascii=False, indent=2))
+            return
+
+        self.stdout.write(
+            f'同時接続 {options["connections"]} / {options["requests"]} リクエスト / '
+            f'WSGI ワーカー {options["workers"]} / クエリの遅延 {options["db_latency_ms"]} ms'
+        )
+        for name, result in results.items():
+            latency = result['latency']
+            self.stdout.write(
+                f'  {name.upper():<5} {result["requests_per_s"]:>8.1f} 件/秒  '
+                f'p50 {latency["p50_ms"]:>8.2f} ms  p95 {latency["p95_ms"]:>8.2f} ms  p99 {latency["p99_ms"]:>8.2f} ms  '
+                f'同時処理 最大 {result["peak_in_flight"]:>4}  5xx {result["errors"]}'
+            )
@@ -0,0 +1,74 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import django
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from product import images
+from product.catalog import bump_catalog_version, bump_product_version
+from product.models import Product
+from product.storage import remember_derivative_widths
+
+
+class Command(BaseCommand):
+    help = '既存の商品画像からサムネイル（WebP / JPEG）を作ります。画像の処理は複数プロセスで並列に行います。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help='画像を処理するプロセス数（1 ならこのプロセスで順に処理する）')
+        parser.add_argument('--force', action='store_true', help='作成済みの商品も作り直す')
+
+    def handle(self, *args, **options):
+        queryset = Product.objects.exclude(image='').exclude(image__isnull=True)
+        if not options['force']:
+            queryset = queryset.filter(image_widths=[])
+        targets = {}
+        for pk, name in queryset.values_list('pk', 'image').iterator():
+            targets.setdefault(name, []).append(pk)
+
+        if not targets:
+            self.stdout.write('処理する画像はありません。')
+            return
+
+        started = time.monotonic()
+        done = failed = 0
+        for name, result in self._run(list(targets), options['workers']):
+            if isinstance(result, Exception):
+                failed += 1
+                self.stderr.write(f'失敗: {name}: {result}')
+                continue
+            remember_derivative_widths(name, result)
+            # QuerySet.update() はシグナルを送らないので、カードのキャッシュは自分で無効にする
+            Product.objects.filter(pk__in=targets[name]).update(image_widths=result)
+            for pk in targets[name]:
+                bump_product_version(pk)
+            done += 1
+            if done % 50 == 0:
+                self.stdout.write(f'{done} / {len(targets)} 枚（{time.monotonic() - started:.1f} 秒）')
+
+        bump_catalog_version()
+        self.stdout.write(self.style.SUCCESS(
+            f'完了: {done} 枚 / 失敗 {failed} 枚（{time.monotonic() - started:.1f} 秒）'
+        ))
+
+    def _run(self, names, workers):
+        """(name, 作成した幅の一覧 または 例外) を、処理が終わった順に返す。"""
+        if workers <= 1:
+            for name in names:
+                try:
+                    yield images.build_for_name(name)
+                except Exception as e:
+                    yield name, e
+            return
+
+        # 子プロセスに DB 接続を引き継がせない（ワーカーは DB に触らない）
+        connections.close_all()
+        with ProcessPoolExecutor(max_workers=workers, initializer=django.setup) as executor:
+            futures = {executor.submit(images.build_for_name, name): name for name in names}
+            for future in as_completed(futures):
+                try:
+                    yield future.result()
+                except Exception as e:
+                    yield futures[future], e
@@ -0,0 +1,27 @@
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+
+from product.models import Product
+from product.storage import collapse_duplicates
+
+
+class Command(BaseCommand):
+    help = 'メディアのフォルダ内で中身が同じファイルを1つにまとめ、商品の画像を付け替えます。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', default='product_image', help='対象のフォルダ（メディアのルートからの相対パス）')
+        parser.add_argument('--dry-run', action='store_true', help='削除せず、まとめる対象だけ表示する')
+
+    def handle(self, *args, **options):
+        path = options['path'].strip('/')
+        _, files = default_storage.listdir(path)
+        names = [f'{path}/{name}' for name in files]
+        names += Product.objects.filter(image__startswith=f'{path}/').values_list('image', flat=True)
+
+        replaced = collapse_duplicates(default_storage, names, delete=not options['dry_run'])
+        for name, keep in sorted(replaced.items()):
+            self.stdout.write(f'{name} -> {keep}')
+        if options['dry_run']:
+            self.stdout.write(f'{len(replaced)} 件の重複ファイルが見つかりました（{len(set(names))} 件中）。')
+        else:
+            self.stdout.write(self.style.SUCCESS(f'{len(replaced)} 件の重複ファイルを削除しました（{len(set(names))} 件中）。'))
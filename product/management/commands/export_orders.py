@@ -0,0 +1,55 @@
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from product import export
+from product.forms import OrderExportForm
+
+
+class Command(BaseCommand):
+    help = '注文明細を CSV / NDJSON で書き出します（件数によらずメモリ使用量は一定）。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=['csv', 'ndjson'], default='csv')
+        parser.add_argument('--status', default='')
+        parser.add_argument('--date-from', help='YYYY-MM-DD（この日を含む）')
+        parser.add_argument('--date-to', help='YYYY-MM-DD（この日を含む）')
+        parser.add_argument('--since-id', type=int, help='この注文IDより後の注文だけを書き出す（差分出力）')
+        parser.add_argument('--lag', type=int, default=settings.SALES_ROLLUP_LAG_SECONDS,
+                            help='作成からこの秒数が経っていない注文は次回に回す（コミット前の注文を飛ばさないため）')
+        parser.add_argument('--gzip', action='store_true')
+        parser.add_argument('--chunk-size', type=int, default=2000)
+        parser.add_argument('-o', '--output', help='出力先ファイル（省略時は標準出力）')
+
+    def handle(self, *args, **options):
+        form = OrderExportForm({
+            'format': options['format'],
+            'status': options['status'],
+            'date_from': options['date_from'],
+            'date_to': options['date_to'],
+            'since_id': options['since_id'],
+            'gzip': options['gzip'],
+        })
+        if not form.is_valid():
+            raise CommandError(form.errors.as_text())
+
+        queryset = form.filter(export.export_queryset(since_id=options['since_id'], lag_seconds=options['lag']), prefix='order__')
+        last = export.LastOrderId()
+        chunks = export.iter_export(
+            queryset, fmt=options['format'], compress=options['gzip'], chunk_size=options['chunk_size'],
+            last_order_id=last,
+        )
+
+        out = open(options['output'], 'wb') if options['output'] else sys.stdout.buffer
+        try:
+            for chunk in chunks:
+                out.write(chunk)
+        finally:
+            if options['output']:
+                out.close()
+            else:
+                out.flush()
+
+        if last.value is not None:
+            self.stderr.write(f'最後の注文ID: {last.value}（次回は --since-id {last.value} で差分を出力できます）')
@@ -0,0 +1,41 @@
+from datetime import datetime, time
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from product.loadgen import LoadDataGenerator
+
+
+class Command(BaseCommand):
+    help = '負荷試験用に、商品・カート・過去の注文を大量に作ります（既存のデータは消しません）。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=1000)
+        parser.add_argument('--carts', type=int, default=10000)
+        parser.add_argument('--orders', type=int, default=100000)
+        parser.add_argument('--days', type=int, default=365, help='注文を散らばらせる過去の日数')
+        parser.add_argument('--seed', type=int, default=0, help='乱数の種（同じ値なら同じデータになる）')
+        parser.add_argument('--end', type=lambda v: datetime.fromisoformat(v).date(),
+                            help='注文・カートの日時をこの日（YYYY-MM-DD）までに収める（省略時は現在時刻）')
+        parser.add_argument('--batch-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        def progress(label, done, total, seconds):
+            if done == total or done % (options['batch_size'] * 20) == 0:
+                rate = done / seconds if seconds else 0
+                self.stdout.write(f'{label}: {done:,} / {total:,}（{seconds:.1f} 秒、{rate:,.0f} 件/秒）')
+
+        end = timezone.make_aware(datetime.combine(options['end'], time.min)) if options['end'] else None
+        generator = LoadDataGenerator(
+            seed=options['seed'], batch_size=options['batch_size'], end=end, progress=progress,
+        )
+        if options['products']:
+            generator.create_products(options['products'])
+        if options['carts']:
+            generator.create_carts(options['carts'])
+        if options['orders']:
+            generator.create_orders(options['orders'], days=options['days'])
+
+        self.stdout.write(self.style.SUCCESS(
+            '完了しました。売上集計は manage.py update_sales_rollups --rebuild で作り直してください。'
+        ))
@@ -0,0 +1,58 @@
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from product import purge
+from product.models import Cart
+
+
+class Command(BaseCommand):
+    help = '放置されたカート・空のカート・宙に浮いた明細・期限切れのセッションを、少しずつ削除します。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=settings.CART_RETENTION_DAYS,
+                            help='最終操作からこの日数が経ったカートを消す')
+        parser.add_argument('--empty-hours', type=int, default=24,
+                            help='明細が空のカートは、最終操作からこの時間が経ったら消す')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--sleep', type=float, default=0.1, help='バッチの合間に待つ秒数')
+        parser.add_argument('--dry-run', action='store_true', help='削除せず、対象の件数だけ表示する')
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        stale_before = now - timedelta(days=options['days'])
+        empty_before = now - timedelta(hours=options['empty_hours'])
+
+        if options['dry_run']:
+            self.stdout.write(f"放置カート: {Cart.objects.filter(updated_at__lt=stale_before).count()} 件")
+            session_model = purge.session_model()
+            if session_model is not None:
+                expired = session_model.objects.filter(expire_date__lt=now).count()
+                self.stdout.write(f"期限切れセッション: {expired} 件")
+            return
+
+        batch = {'batch_size': options['batch_size'], 'sleep': options['sleep']}
+        steps = [
+            ('放置カート', lambda progress: purge.purge_stale_carts(stale_before, progress=progress, **batch)),
+            ('空のカート', lambda progress: purge.purge_empty_carts(empty_before, progress=progress, **batch)),
+            ('宙に浮いた明細', lambda progress: purge.purge_orphaned_items(progress=progress, **batch)),
+            ('期限切れセッション', lambda progress: purge.purge_expired_sessions(now, progress=progress, **batch)),
+        ]
+
+        summary = []
+        for label, run in steps:
+            started = time.monotonic()
+
+            def progress(deleted, total, seconds, label=label):
+                self.stdout.write(f'{label}: {deleted} 件削除（累計 {total} 件、このバッチ {seconds * 1000:.0f} ms）')
+
+            total = run(progress)
+            elapsed = time.monotonic() - started
+            rate = total / elapsed if elapsed else 0
+            summary.append(f'{label} {total} 件')
+            self.stdout.write(f'{label}: 合計 {total} 件（{elapsed:.1f} 秒、{rate:.0f} 件/秒）')
+
+        self.stdout.write(self.style.SUCCESS('完了: ' + ' / '.join(summary)))
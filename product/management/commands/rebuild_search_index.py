@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from product import search
+
+
+class Command(BaseCommand):
+    help = '商品検索インデックスを作り直します。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        count = search.rebuild_index(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'{count}件の商品をインデックスしました。'))
@@ -4,6 +4,7 @@ from django.core.files import File
 from django.core.files.base import ContentFile
 from pathlib import  Path
 from product.models import Product
+from product import images
 import os
 import tempfile
 
@@ -45,6 +46,7 @@ class Command(BaseCommand):
 
                 product.image.save(file_name, django_file)
 
+            images.update_product_images(product)
             created_count += 1
 
         self.stdout.write(self.style.SUCCESS(f'{created_count}件の初期データの投入が完了しました！'))
@@ -0,0 +1,46 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from product import outbox
+
+
+class Command(BaseCommand):
+    help = '送信待ちメールをまとめて送信します。--loop を付けると常駐して送り続けます。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--max-attempts', type=int, default=5,
+                            help='この回数失敗したメールは送信失敗（dead）にする')
+        parser.add_argument('--backoff', type=int, default=60,
+                            help='1回目の再送までの秒数（以降 2倍ずつ延ばす）')
+        parser.add_argument('--max-backoff', type=int, default=60 * 60)
+        parser.add_argument('--lease', type=int, default=15 * 60,
+                            help='取り出したメールを借りておく秒数（これを過ぎると別のワーカーが送り直す）')
+        parser.add_argument('--loop', action='store_true', help='送信待ちが無くなっても終了しない')
+        parser.add_argument('--interval', type=float, default=5.0,
+                            help='--loop 時、送信待ちが無いときの待機秒数')
+
+    def handle(self, *args, **options):
+        totals = {'sent': 0, 'retry': 0, 'dead': 0}
+        while True:
+            result = outbox.send_pending(
+                batch_size=options['batch_size'],
+                max_attempts=options['max_attempts'],
+                backoff_seconds=options['backoff'],
+                max_backoff_seconds=options['max_backoff'],
+                lease_seconds=options['lease'],
+            )
+            if result:
+                for key, value in result.items():
+                    totals[key] += value
+                self.stdout.write(f"送信 {result['sent']} / 再送待ち {result['retry']} / 失敗 {result['dead']}")
+                continue
+
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
+
+        self.stdout.write(self.style.SUCCESS(
+            f"完了: 送信 {totals['sent']} / 再送待ち {totals['retry']} / 失敗 {totals['dead']}"
+        ))
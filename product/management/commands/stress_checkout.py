@@ -0,0 +1,58 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from product import stress
+
+
+class Command(BaseCommand):
+    help = '複数のワーカーで同時にカート操作と注文確定を繰り返し、スループット・レイテンシ・エラーと不変条件を確かめます。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=8)
+        parser.add_argument('--mode', choices=['thread', 'process'], default='thread',
+                            help='process はワーカーごとに DB 接続とプロセスを分ける（PostgreSQL 向け）')
+        parser.add_argument('--iterations', type=int, default=20, help='ワーカーあたりの注文の回数')
+        parser.add_argument('--lines', type=int, default=3, help='1回の注文でカートに入れる商品の数')
+        parser.add_argument('--products', type=int, default=10, help='使う商品の数（少ないほど競合が増える）')
+        parser.add_argument('--stock', type=int, help='開始前に、使う商品の在庫をこの数にする')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--json', action='store_true', help='結果を JSON で出力する')
+
+    def handle(self, *args, **options):
+        try:
+            report = stress.run_stress(
+                workers=options['workers'], iterations=options['iterations'], lines=options['lines'],
+                products=options['products'], mode=options['mode'], seed=options['seed'], stock=options['stock'],
+            )
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        if options['json']:
+            self.stdout.write(json.dumps(report, ensure_ascii=False, indent=2))
+        else:
+            self.stdout.write(
+                f'{connection.vendor} / {report["mode"]} × {report["workers"]}: {report["elapsed_s"]} 秒'
+            )
+            self.stdout.write(
+                f'リクエスト: {report["requests"]} 件 ({report["requests_per_s"]} 件/秒) / '
+                f'注文: {report["checkouts"]} 件 ({report["checkouts_per_s"]} 件/秒) / 断られた注文: {report["rejected"]} 件'
+            )
+            for name, latency in report['latency'].items():
+                self.stdout.write(
+                    f'  {name:<16} {latency["count"]:>6} 件  p50 {latency["p50_ms"]:>8.2f} ms  '
+                    f'p95 {latency["p95_ms"]:>8.2f} ms  p99 {latency["p99_ms"]:>8.2f} ms'
+                )
+            errors = report['errors']
+            self.stdout.write(
+                f'エラー: デッドロック {errors["deadlock"]} / シリアライズ失敗 {errors["serialization"]} / '
+                f'ロック待ち {errors["locked"]} / その他 {errors["other"]}'
+            )
+
+        if report['problems']:
+            for problem in report['problems']:
+                self.stderr.write(problem)
+            raise CommandError(f'不変条件が {len(report["problems"])} 件破れています。')
+        if not options['json']:
+            self.stdout.write(self.style.SUCCESS('不変条件はすべて満たされています。'))
@@ -0,0 +1,34 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from product import recommendations
+
+
+class Command(BaseCommand):
+    help = '前回の続きから注文を同時購入の回数に反映し、商品ごとの「よく一緒に購入されている商品」を更新します。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--lag', type=int, default=settings.SALES_ROLLUP_LAG_SECONDS,
+                            help='作成からこの秒数が経っていない注文は次回に回す')
+        parser.add_argument('--rebuild', action='store_true', help='同時購入の回数とおすすめを空にして全注文から作り直す')
+        parser.add_argument('--loop', action='store_true', help='終わっても終了せず、一定間隔で更新し続ける')
+        parser.add_argument('--interval', type=float, default=600.0, help='--loop 時の待機秒数')
+
+    def handle(self, *args, **options):
+        if options['rebuild']:
+            count = recommendations.rebuild_recommendations(batch_size=options['batch_size'],
+                                                            lag_seconds=options['lag'])
+            self.stdout.write(self.style.SUCCESS(f'作り直し完了: {count} 件の注文を反映しました。'))
+            if not options['loop']:
+                return
+
+        while True:
+            count = recommendations.update_recommendations(batch_size=options['batch_size'],
+                                                           lag_seconds=options['lag'])
+            self.stdout.write(f'{count} 件の注文を反映しました。')
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
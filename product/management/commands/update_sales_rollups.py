@@ -0,0 +1,44 @@
+import time
+from datetime import date
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from product import rollups
+
+
+class Command(BaseCommand):
+    help = '前回の続きから注文を売上集計テーブルに反映します。--rebuild で作り直し、--check で明細と突き合わせます。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--lag', type=int, default=settings.SALES_ROLLUP_LAG_SECONDS,
+                            help='作成からこの秒数が経っていない注文は次回に回す')
+        parser.add_argument('--rebuild', action='store_true', help='集計テーブルを空にして全注文から作り直す')
+        parser.add_argument('--check', action='store_true', help='集計テーブルと注文明細を突き合わせる')
+        parser.add_argument('--since', type=date.fromisoformat, help='--check の対象をこの日（YYYY-MM-DD）以降に絞る')
+        parser.add_argument('--loop', action='store_true', help='終わっても終了せず、一定間隔で集計し続ける')
+        parser.add_argument('--interval', type=float, default=60.0, help='--loop 時の待機秒数')
+
+    def handle(self, *args, **options):
+        if options['check']:
+            problems = rollups.check_rollups(since=options['since'])
+            for problem in problems:
+                self.stderr.write(problem)
+            if problems:
+                raise CommandError(f'集計が明細と {len(problems)} 件食い違っています。--rebuild で作り直してください。')
+            self.stdout.write(self.style.SUCCESS('集計は注文明細と一致しています。'))
+            return
+
+        if options['rebuild']:
+            count = rollups.rebuild_rollups(batch_size=options['batch_size'], lag_seconds=options['lag'])
+            self.stdout.write(self.style.SUCCESS(f'作り直し完了: {count} 件の注文を集計しました。'))
+            if not options['loop']:
+                return
+
+        while True:
+            count = rollups.update_rollups(batch_size=options['batch_size'], lag_seconds=options['lag'])
+            self.stdout.write(f'{count} 件の注文を集計しました。')
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,233 @@
+import os
+import socket
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterable, Optional
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+# リクエスト時間のヒストグラムの境界（秒）
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+PROCESS_KEY = f'{socket.gethostname()}:{os.getpid()}'
+PROCESS_INDEX_KEY = 'metrics:processes'
+
+SPAN_KINDS = ('db', 'template', 'storage')
+
+
+class RequestMetrics:
+    """1リクエストの間に積み上げる計測値。"""
+    __slots__ = ('db_queries', 'db', 'template', 'storage')
+
+    def __init__(self):
+        self.db_queries = 0
+        self.db = 0.0
+        self.template = 0.0
+        self.storage = 0.0
+
+
+_current: ContextVar[Optional[RequestMetrics]] = ContextVar('request_metrics', default=None)
+
+
+def start_request() -> RequestMetrics:
+    current = RequestMetrics()
+    _current.set(current)
+    return current
+
+
+def end_request():
+    _current.set(None)
+
+
+@contextmanager
+def span(kind: str):
+    """
+    テンプレートの描画・ストレージ（Cloudinary など）へのアクセスの時間を、今のリクエストに加算する。
+    リクエストの外（管理コマンドなど）では何もしない。
+    """
+    current = _current.get()
+    if current is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        setattr(current, kind, getattr(current, kind) + time.perf_counter() - started)
+
+
+def db_wrapper(execute, sql, params, many, context):
+    """DB 接続の execute_wrappers に入れておく（instrument_connection）。クエリ数と時間を数える。"""
+    current = _current.get()
+    if current is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        current.db_queries += 1
+        current.db += time.perf_counter() - started
+
+
+def instrument_connection(connection):
+    """
+    接続に db_wrapper を付ける（connection_created のたびに呼ぶ。付け済みなら何もしない）。
+    async ビューのクエリは sync_to_async のスレッドの接続で実行されるので、
+    リクエストの開始時に今のスレッドの接続にだけ付けるのではなく、すべての接続に常に付けておく。
+    計測中のリクエストは ContextVar で渡るので、リクエストの外のクエリは数えない。
+    """
+    if db_wrapper not in connection.execute_wrappers:
+        connection.execute_wrappers.append(db_wrapper)
+
+
+def _empty_view_stats() -> dict:
+    return {
+        'requests': {},
+        'buckets': [0] * (len(BUCKETS) + 1),
+        'sum': 0.0,
+        'count': 0,
+        'db_queries': 0,
+        'db_seconds': 0.0,
+        'template_seconds': 0.0,
+        'storage_seconds': 0.0,
+    }
+
+
+class Registry:
+    """
+    プロセス内の集計。記録はロックを取って数値を足すだけにして、リクエストごとの負荷を小さくする。
+    ほかのプロセス（gunicorn のワーカー）と合算できるよう、定期的にキャッシュへスナップショットを書く。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._views: Dict[str, dict] = {}
+        self._published_at = 0.0
+
+    def observe(self, view: str, method: str, status: int, duration: float, current: RequestMetrics):
+        index = bisect_left(BUCKETS, duration)
+        label = f'{method} {status}'
+        with self._lock:
+            stats = self._views.get(view)
+            if stats is None:
+                stats = self._views[view] = _empty_view_stats()
+            stats['requests'][label] = stats['requests'].get(label, 0) + 1
+            stats['buckets'][index] += 1
+            stats['sum'] += duration
+            stats['count'] += 1
+            stats['db_queries'] += current.db_queries
+            stats['db_seconds'] += current.db
+            stats['template_seconds'] += current.template
+            stats['storage_seconds'] += current.storage
+
+    def snapshot(self) -> Dict[str, dict]:
+        with self._lock:
+            return {
+                view: {**stats, 'requests': dict(stats['requests']), 'buckets': list(stats['buckets'])}
+                for view, stats in self._views.items()
+            }
+
+    def publish_due(self) -> bool:
+        """前回キャッシュに書いてから METRICS_PUBLISH_INTERVAL 秒経ったか。"""
+        return time.monotonic() - self._published_at >= getattr(settings, 'METRICS_PUBLISH_INTERVAL', 10)
+
+    def publish(self, force: bool = False):
+        """METRICS_PUBLISH_INTERVAL 秒に1回まで、このプロセスの集計をキャッシュに書く。"""
+        if not force and not self.publish_due():
+            return
+        interval = getattr(settings, 'METRICS_PUBLISH_INTERVAL', 10)
+        self._published_at = time.monotonic()
+        cache.set(f'metrics:process:{PROCESS_KEY}', self.snapshot(), timeout=interval * 30)
+        processes = cache.get(PROCESS_INDEX_KEY) or []
+        if PROCESS_KEY not in processes:
+            cache.set(PROCESS_INDEX_KEY, [*processes, PROCESS_KEY][-256:], timeout=None)
+
+    def reset(self):
+        with self._lock:
+            self._views.clear()
+
+
+registry = Registry()
+
+
+def collect() -> Dict[str, dict]:
+    """キャッシュにある全プロセスの集計を合算する（期限切れのプロセスは含まれない）。"""
+    registry.publish(force=True)
+    processes = cache.get(PROCESS_INDEX_KEY) or []
+    snapshots = cache.get_many([f'metrics:process:{key}' for key in processes]).values()
+    return merge(snapshots)
+
+
+def merge(snapshots: Iterable[Dict[str, dict]]) -> Dict[str, dict]:
+    merged: Dict[str, dict] = {}
+    for snapshot in snapshots:
+        for view, stats in snapshot.items():
+            total = merged.setdefault(view, _empty_view_stats())
+            for label, count in stats['requests'].items():
+                total['requests'][label] = total['requests'].get(label, 0) + count
+            total['buckets'] = [a + b for a, b in zip(total['buckets'], stats['buckets'])]
+            for key in ('sum', 'count', 'db_queries', 'db_seconds', 'template_seconds', 'storage_seconds'):
+                total[key] += stats[key]
+    return merged
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render_prometheus(stats: Dict[str, dict]) -> str:
+    """Prometheus のテキスト形式（version 0.0.4）にする。"""
+    lines = [
+        '# HELP django_http_requests_total Requests by view, method and status.',
+        '# TYPE django_http_requests_total counter',
+    ]
+    for view in sorted(stats):
+        for label, count in sorted(stats[view]['requests'].items()):
+            method, status = label.split(' ')
+            lines.append(
+                f'django_http_requests_total{{view="{_escape(view)}",method="{method}",status="{status}"}} {count}'
+            )
+
+    lines += [
+        '# HELP django_http_request_duration_seconds Request latency by view.',
+        '# TYPE django_http_request_duration_seconds histogram',
+    ]
+    for view in sorted(stats):
+        view_stats = stats[view]
+        cumulative = 0
+        for bound, count in zip([*BUCKETS, '+Inf'], view_stats['buckets']):
+            cumulative += count
+            lines.append(
+                f'django_http_request_duration_seconds_bucket{{view="{_escape(view)}",le="{bound}"}} {cumulative}'
+            )
+        lines.append(f'django_http_request_duration_seconds_sum{{view="{_escape(view)}"}} {view_stats["sum"]:.6f}')
+        lines.append(f'django_http_request_duration_seconds_count{{view="{_escape(view)}"}} {view_stats["count"]}')
+
+    counters = [
+        ('django_db_queries_total', 'db_queries', 'DB queries by view.', '{}'),
+        ('django_db_query_seconds_total', 'db_seconds', 'Time spent in DB queries by view.', '{:.6f}'),
+        ('django_template_render_seconds_total', 'template_seconds', 'Time spent rendering templates by view.',
+         '{:.6f}'),
+        ('django_storage_seconds_total', 'storage_seconds', 'Time spent in media storage calls by view.', '{:.6f}'),
+    ]
+    for name, key, help_text, fmt in counters:
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} counter']
+        for view in sorted(stats):
+            lines.append(f'{name}{{view="{_escape(view)}"}} {fmt.format(stats[view][key])}')
+    return '\n'.join(lines) + '\n'
+
+
+def server_timing(current: RequestMetrics, total: float) -> str:
+    """Server-Timing ヘッダーの値。ブラウザの開発者ツールに内訳が表示される。"""
+    parts = [f'db;dur={current.db * 1000:.1f};desc="{current.db_queries} queries"']
+    if current.template:
+        parts.append(f'tpl;dur={current.template * 1000:.1f}')
+    if current.storage:
+        parts.append(f'storage;dur={current.storage * 1000:.1f}')
+    parts.append(f'total;dur={total * 1000:.1f}')
+    return ', '.join(parts)
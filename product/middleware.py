@@ -0,0 +1,60 @@
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+
+from . import metrics
+from .auth import has_basic_auth
+
+
+class MetricsMiddleware:
+    """
+    ビューごとの処理時間・DB のクエリ数と時間・テンプレートの描画時間を集計する。
+    - 集計は manage/metrics/ で Prometheus 形式で見られる
+    - METRICS_SERVER_TIMING が True なら、内訳を Server-Timing ヘッダーで返す
+      （内部の処理時間が分かるので、X-Profile と同じく管理用の Basic 認証を付けたリクエストにだけ返す）
+    ストリーミングのレスポンスは、レスポンスを返した時点（本文の送信前）までを計る。
+    WSGI / ASGI のどちらでも動く（ASGI では async のまま次に渡すので、async ビューをスレッドに移さない）。
+    クエリは各接続に常に付けてある metrics.db_wrapper が数える（signals.instrument_connection）。
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        current = metrics.start_request()
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+            self._observe(request, response, current, started)
+        finally:
+            metrics.end_request()
+        metrics.registry.publish()
+        return response
+
+    async def __acall__(self, request):
+        current = metrics.start_request()
+        started = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+            self._observe(request, response, current, started)
+        finally:
+            metrics.end_request()
+        # キャッシュへの書き出しは DB キャッシュのこともあるのでスレッドで行う（間隔が来たときだけ）
+        if metrics.registry.publish_due():
+            await sync_to_async(metrics.registry.publish)()
+        return response
+
+    def _observe(self, request, response, current, started):
+        duration = time.perf_counter() - started
+        match = getattr(request, 'resolver_match', None)
+        view = match.view_name if match else 'unmatched'
+        metrics.registry.observe(view, request.method, response.status_code, duration, current)
+        if getattr(settings, 'METRICS_SERVER_TIMING', True) and has_basic_auth(request):
+            response['Server-Timing'] = metrics.server_timing(current, duration)
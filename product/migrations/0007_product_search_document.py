@@ -0,0 +1,84 @@
+# Generated by Django 4.2.5 on 2026-10-18 06:15
+
+from django.db import migrations, models
+import django.db.models.deletion
+import re
+import unicodedata
+
+
+# この時点の product/search.py の写し（後から search.py を変えても、このマイグレーションは変わらない）
+FTS_TABLE = 'product_search_fts'
+
+_RUN_RE = re.compile(r'\w+')
+_SEGMENT_RE = re.compile(r'[0-9a-z]+|[^0-9a-z_]+')
+
+
+def tokenize(text):
+    tokens = []
+    for run in _RUN_RE.findall(unicodedata.normalize('NFKC', text or '').lower()):
+        for segment in _SEGMENT_RE.findall(run):
+            if segment.isascii() or len(segment) == 1:
+                tokens.append(segment)
+            else:
+                tokens.extend(segment[i:i + 2] for i in range(len(segment) - 1))
+    return list(dict.fromkeys(tokens))
+
+
+def create_search_indexes(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        schema_editor.execute(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(tokens, tokenize = 'unicode61')"
+        )
+    elif vendor == 'postgresql':
+        schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        schema_editor.execute(
+            'CREATE INDEX IF NOT EXISTS product_search_tokens_gin '
+            'ON product_productsearchdocument USING gin '
+            "(array_to_tsvector(string_to_array(tokens, ' ')))"
+        )
+        schema_editor.execute(
+            'CREATE INDEX IF NOT EXISTS product_name_trgm_gin '
+            'ON product_product USING gin (name gin_trgm_ops)'
+        )
+
+    Product = apps.get_model('product', 'Product')
+    ProductSearchDocument = apps.get_model('product', 'ProductSearchDocument')
+    documents = [
+        ProductSearchDocument(product_id=p.pk, tokens=' '.join(tokenize(f'{p.name} {p.description or ""}')))
+        for p in Product.objects.only('pk', 'name', 'description')
+    ]
+    ProductSearchDocument.objects.bulk_create(documents, batch_size=1000)
+    if vendor == 'sqlite':
+        with schema_editor.connection.cursor() as cursor:
+            cursor.executemany(f'INSERT INTO {FTS_TABLE} (rowid, tokens) VALUES (%s, %s)',
+                               [(d.product_id, d.tokens) for d in documents])
+
+
+def drop_search_indexes(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        schema_editor.execute(f'DROP TABLE IF EXISTS {FTS_TABLE}')
+    elif vendor == 'postgresql':
+        schema_editor.execute('DROP INDEX IF EXISTS product_name_trgm_gin')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product', '0006_order_card_expiry_order_card_name_order_card_number'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductSearchDocument',
+            fields=[
+                ('product', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='search_document', serialize=False, to='product.product')),
+                ('tokens', models.TextField(verbose_name='検索トークン')),
+            ],
+            options={
+                'verbose_name_plural': '商品検索インデックス',
+            },
+        ),
+        migrations.RunPython(create_search_indexes, drop_search_indexes),
+    ]
@@ -0,0 +1,56 @@
+# Generated by Django 4.2.5 on 2026-10-18 06:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product', '0011_order_list_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductSalesDaily',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField(verbose_name='日付')),
+                ('product_id', models.BigIntegerField(default=0, verbose_name='商品ID')),
+                ('product_name', models.CharField(max_length=100, verbose_name='商品名')),
+                ('revenue', models.DecimalField(decimal_places=2, default=0, max_digits=14, verbose_name='売上')),
+                ('units', models.PositiveIntegerField(default=0, verbose_name='販売数')),
+                ('orders', models.PositiveIntegerField(default=0, verbose_name='注文数')),
+            ],
+            options={
+                'verbose_name': '商品別日次売上',
+                'verbose_name_plural': '商品別日次売上',
+            },
+        ),
+        migrations.CreateModel(
+            name='SalesHourly',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hour', models.DateTimeField(unique=True, verbose_name='時間帯')),
+                ('revenue', models.DecimalField(decimal_places=2, default=0, max_digits=14, verbose_name='売上')),
+                ('units', models.PositiveIntegerField(default=0, verbose_name='販売数')),
+                ('orders', models.PositiveIntegerField(default=0, verbose_name='注文数')),
+            ],
+            options={
+                'verbose_name': '時間別売上',
+                'verbose_name_plural': '時間別売上',
+            },
+        ),
+        migrations.CreateModel(
+            name='Watermark',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50, unique=True)),
+                ('value', models.BigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='productsalesdaily',
+            constraint=models.UniqueConstraint(fields=('day', 'product_id'), name='unique_product_sales_day'),
+        ),
+    ]
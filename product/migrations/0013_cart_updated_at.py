@@ -0,0 +1,27 @@
+# Generated by Django 4.2.5 on 2026-10-18 06:26
+
+from django.db import migrations, models
+from django.db.models import F
+import django.utils.timezone
+
+
+def copy_created_at(apps, schema_editor):
+    """既存のカートは作成日時を最終操作日時とみなす（追加した時点の日時で一律に若返らせない）。"""
+    Cart = apps.get_model('product', 'Cart')
+    Cart.objects.update(updated_at=F('created_at'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product', '0012_sales_rollups'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cart',
+            name='updated_at',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now, verbose_name='最終操作日時'),
+        ),
+        migrations.RunPython(copy_created_at, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.2.5 on 2026-10-18 06:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product', '0014_product_image_widths'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StoredFile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('digest', models.CharField(max_length=64, unique=True, verbose_name='SHA-256')),
+                ('name', models.CharField(max_length=255, verbose_name='保存先の名前')),
+                ('size', models.BigIntegerField(default=0, verbose_name='サイズ')),
+                ('derivative_widths', models.JSONField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'verbose_name': '保存済みファイル',
+                'verbose_name_plural': '保存済みファイル',
+            },
+        ),
+    ]
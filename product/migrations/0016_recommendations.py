@@ -0,0 +1,49 @@
+# Generated by Django 4.2.5 on 2026-10-18 06:41
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product', '0015_stored_file'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductCooccurrence',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('product_a', models.BigIntegerField(verbose_name='商品ID')),
+                ('product_b', models.BigIntegerField(verbose_name='一緒に購入された商品ID')),
+                ('orders', models.PositiveIntegerField(default=0, verbose_name='注文数')),
+            ],
+            options={
+                'verbose_name': '同時購入',
+                'verbose_name_plural': '同時購入',
+            },
+        ),
+        migrations.CreateModel(
+            name='ProductRecommendation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('rank', models.PositiveSmallIntegerField(verbose_name='順位')),
+                ('score', models.PositiveIntegerField(default=0, verbose_name='同時購入された注文数')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='recommendations', to='product.product', verbose_name='商品')),
+                ('recommended', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='recommended_for', to='product.product', verbose_name='おすすめ商品')),
+            ],
+            options={
+                'verbose_name': 'おすすめ商品',
+                'verbose_name_plural': 'おすすめ商品',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='productcooccurrence',
+            constraint=models.UniqueConstraint(fields=('product_a', 'product_b'), name='unique_product_cooccurrence'),
+        ),
+        migrations.AddConstraint(
+            model_name='productrecommendation',
+            constraint=models.UniqueConstraint(fields=('product', 'rank'), name='unique_product_recommendation_rank'),
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 4.2.5 on 2026-10-18 07:27
+
+from django.db import migrations, models
+import unicodedata
+
+
+def fill_names(apps, schema_editor):
+    """既存の検索ドキュメントに、正規化した商品名（この時点の search.normalize と同じ）を入れる。"""
+    ProductSearchDocument = apps.get_model('product', 'ProductSearchDocument')
+    documents = list(ProductSearchDocument.objects.select_related('product').only('pk', 'product__name'))
+    for document in documents:
+        document.name = unicodedata.normalize('NFKC', document.product.name or '').lower()
+    ProductSearchDocument.objects.bulk_update(documents, ['name'], batch_size=1000)
+
+
+def create_name_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(
+            'CREATE INDEX IF NOT EXISTS product_search_name_trgm_gin '
+            'ON product_productsearchdocument USING gin (name gin_trgm_ops)'
+        )
+        schema_editor.execute('DROP INDEX IF EXISTS product_name_trgm_gin')
+
+
+def drop_name_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(
+            'CREATE INDEX IF NOT EXISTS product_name_trgm_gin '
+            'ON product_product USING gin (name gin_trgm_ops)'
+        )
+        schema_editor.execute('DROP INDEX IF EXISTS product_search_name_trgm_gin')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product', '0018_product_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='productsearchdocument',
+            name='name',
+            field=models.TextField(default='', verbose_name='正規化した商品名'),
+        ),
+        migrations.RunPython(fill_names, migrations.RunPython.noop),
+        migrations.RunPython(create_name_index, drop_name_index),
+    ]
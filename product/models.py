@@ -1,4 +1,5 @@
 from django.db import models
+from django.utils import timezone
 
 # Create your models here.
 class Product(models.Model):
@@ -22,12 +23,52 @@ class Product(models.Model):
         blank=True,
         null=True,
     )
+    # 作成済みの派生画像（サムネイル）の幅。product/images.py が更新する
+    image_widths = models.JSONField(
+        default=list,
+        blank=True,
+        editable=False,
+    )
+    # 在庫数。空なら在庫を管理しない（いくらでも注文できる）。注文確定時に product/inventory.py が減らす
+    stock = models.PositiveIntegerField(
+        verbose_name='在庫数',
+        blank=True,
+        null=True,
+    )
+    # 最後に変更された日時。save() のほか、注文確定で在庫を減らしたとき（inventory.decrement_stock）にも進む
+    updated_at = models.DateTimeField(
+        verbose_name='更新日時',
+        auto_now=True,
+    )
 
     class Meta:
         verbose_name_plural = '商品'
+        indexes = [
+            # 商品一覧の価格順（?sort=price）のキーセットページング。深いページも索引をたどるだけで済む
+            models.Index(fields=['price', 'id'], name='product_price_id_idx'),
+        ]
 
     def __str__(self):
         return self.name
+
+
+class ProductSearchDocument(models.Model):
+    """
+    商品検索用のトークン列（商品名・説明を bigram 化したもの）。
+    DB ごとの全文検索インデックスはこのテーブル（PostgreSQL）または
+    FTS5 仮想テーブル（SQLite）に張る。詳しくは product/search.py。
+    """
+    product = models.OneToOneField(
+        Product, on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='search_document',
+    )
+    tokens = models.TextField(verbose_name='検索トークン')
+    # search.normalize() した商品名。PostgreSQL ではこれに pg_trgm の GIN インデックスを張り、部分一致で引く
+    name = models.TextField(default='', verbose_name='正規化した商品名')
+
+    class Meta:
+        verbose_name_plural = '商品検索インデックス'
     
 
 class Cart(models.Model):
@@ -35,10 +76,12 @@ class Cart(models.Model):
         verbose_name='カゴに追加した日時',
         auto_now_add=True,
     )
-
-    def get_total_price(self):
-        return sum(item.subtotal for item in self.cart_items.all())
-    
+    # 最後にカートを操作した日時。manage.py purge_carts はこの列で古いカートを探す
+    updated_at = models.DateTimeField(
+        verbose_name='最終操作日時',
+        default=timezone.now,
+        db_index=True,
+    )
 
 
 class CartItem(models.Model):
@@ -52,6 +95,21 @@ class CartItem(models.Model):
     quantity = models.PositiveIntegerField(
         verbose_name='数量',
     )
+    # この日時まではカートの数量を在庫から仮押さえしているとみなす（カートに追加するたびに延びる）
+    reserved_until = models.DateTimeField(
+        verbose_name='仮押さえの期限',
+        null=True,
+        blank=True,
+    )
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['cart', 'product'], name='unique_cart_product'),
+        ]
+        indexes = [
+            # 商品ごとの仮押さえ数の集計用
+            models.Index(fields=['product', 'reserved_until'], name='cartitem_reservation_idx'),
+        ]
 
     @property
     def subtotal(self):
@@ -76,10 +134,19 @@ class Order(models.Model):
     total_price = models.DecimalField(max_digits=10, decimal_places=2, verbose_name='合計金額')
     status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
     created_at = models.DateTimeField(auto_now_add=True, verbose_name='注文日時')
+    # 注文フォームごとに発行するキー。二重送信・再送されたリクエストを同じ注文として扱う
+    idempotency_key = models.CharField(
+        max_length=64, unique=True, null=True, blank=True, verbose_name='冪等性キー',
+    )
 
     class Meta:
         verbose_name = '注文'
         verbose_name_plural = '注文'
+        indexes = [
+            # 受注一覧のカーソルページング（新しい順）と、ステータスでの絞り込み用
+            models.Index(fields=['-created_at', '-id'], name='order_created_idx'),
+            models.Index(fields=['status', '-created_at', '-id'], name='order_status_created_idx'),
+        ]
 
     def __str__(self):
         return f"注文ID: {self.id} - {self.last_name}"
@@ -100,3 +167,152 @@ class OrderItem(models.Model):
 
     def __str__(self):
         return f"{self.product_name} (注文ID: {self.order.id})"
+
+
+class EmailOutbox(models.Model):
+    """
+    送信待ちメール。注文と同じトランザクションで書き込み、
+    manage.py send_outbox がまとめて送信する。
+    """
+    STATUS_CHOICES = [('pending', '送信待ち'), ('sent', '送信済み'), ('dead', '送信失敗')]
+
+    order = models.ForeignKey(
+        Order, related_name='emails', on_delete=models.SET_NULL,
+        null=True, blank=True,
+    )
+    subject = models.CharField(max_length=255, verbose_name='件名')
+    body = models.TextField(verbose_name='本文')
+    from_email = models.CharField(max_length=254, blank=True, verbose_name='送信元')
+    to = models.JSONField(default=list, verbose_name='宛先')
+
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
+    attempts = models.PositiveIntegerField(default=0, verbose_name='送信試行回数')
+    next_attempt_at = models.DateTimeField(default=timezone.now, verbose_name='次回送信日時')
+    last_error = models.TextField(blank=True, verbose_name='最後のエラー')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='作成日時')
+    sent_at = models.DateTimeField(null=True, blank=True, verbose_name='送信日時')
+
+    class Meta:
+        verbose_name = '送信メール'
+        verbose_name_plural = '送信メール'
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at'], name='outbox_status_next_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.subject} ({self.get_status_display()})"
+
+
+class SalesHourly(models.Model):
+    """
+    1時間ごとの売上（全商品合計）。manage.py update_sales_rollups が差分を加算していく。
+    日次の合計はこのテーブルを足し合わせて求める（注文は必ずどれか1つの時間帯に入るので注文数も足せる）。
+    """
+    hour = models.DateTimeField(unique=True, verbose_name='時間帯')
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0, verbose_name='売上')
+    units = models.PositiveIntegerField(default=0, verbose_name='販売数')
+    orders = models.PositiveIntegerField(default=0, verbose_name='注文数')
+
+    class Meta:
+        verbose_name = '時間別売上'
+        verbose_name_plural = '時間別売上'
+
+    def __str__(self):
+        return f"{self.hour:%Y/%m/%d %H時} ¥{self.revenue}"
+
+
+class ProductSalesDaily(models.Model):
+    """
+    商品ごと・日ごとの売上。商品が削除されても集計は残るよう、商品は外部キーではなく ID で持つ
+    （削除済みで ID が分からない明細は product_id=0 にまとめる）。
+    """
+    day = models.DateField(verbose_name='日付')
+    product_id = models.BigIntegerField(default=0, verbose_name='商品ID')
+    product_name = models.CharField(max_length=100, verbose_name='商品名')
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0, verbose_name='売上')
+    units = models.PositiveIntegerField(default=0, verbose_name='販売数')
+    orders = models.PositiveIntegerField(default=0, verbose_name='注文数')
+
+    class Meta:
+        verbose_name = '商品別日次売上'
+        verbose_name_plural = '商品別日次売上'
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'product_id'], name='unique_product_sales_day'),
+        ]
+
+    def __str__(self):
+        return f"{self.day} {self.product_name} ¥{self.revenue}"
+
+
+class Watermark(models.Model):
+    """差分集計の処理済み位置（最後に処理した注文IDなど）を名前ごとに持つ。"""
+    name = models.CharField(max_length=50, unique=True)
+    value = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.name}: {self.value}"
+
+
+class ProductCooccurrence(models.Model):
+    """
+    2つの商品が同じ注文に含まれた回数。manage.py update_recommendations が差分を加算していく。
+    (a, b) と (b, a) の両方を持つので、ある商品の相手はすべて product_a で引ける。
+    商品が削除されても回数は残るよう、外部キーではなく ID で持つ。
+    """
+    product_a = models.BigIntegerField(verbose_name='商品ID')
+    product_b = models.BigIntegerField(verbose_name='一緒に購入された商品ID')
+    orders = models.PositiveIntegerField(default=0, verbose_name='注文数')
+
+    class Meta:
+        verbose_name = '同時購入'
+        verbose_name_plural = '同時購入'
+        constraints = [
+            models.UniqueConstraint(fields=['product_a', 'product_b'], name='unique_product_cooccurrence'),
+        ]
+
+    def __str__(self):
+        return f"{self.product_a} & {self.product_b}: {self.orders}"
+
+
+class ProductRecommendation(models.Model):
+    """商品ごとの「よく一緒に購入されている商品」の上位（ProductCooccurrence から作る）。"""
+    product = models.ForeignKey(
+        Product, on_delete=models.CASCADE, related_name='recommendations', verbose_name='商品'
+    )
+    recommended = models.ForeignKey(
+        Product, on_delete=models.CASCADE, related_name='recommended_for', verbose_name='おすすめ商品'
+    )
+    rank = models.PositiveSmallIntegerField(verbose_name='順位')
+    score = models.PositiveIntegerField(default=0, verbose_name='同時購入された注文数')
+
+    class Meta:
+        verbose_name = 'おすすめ商品'
+        verbose_name_plural = 'おすすめ商品'
+        constraints = [
+            # 詳細ページは product_id で絞って rank 順に読むので、この一意制約のインデックスで済む
+            models.UniqueConstraint(fields=['product', 'rank'], name='unique_product_recommendation_rank'),
+        ]
+
+    def __str__(self):
+        return f"{self.product_id} -> {self.recommended_id} ({self.rank})"
+
+
+class StoredFile(models.Model):
+    """
+    内容のハッシュで保存したメディアファイルの台帳（product/storage.py が使う）。
+    同じ内容のファイルが再度アップロードされたら、ストレージに問い合わせずにこの名前を返す。
+    """
+    digest = models.CharField(max_length=64, unique=True, verbose_name='SHA-256')
+    name = models.CharField(max_length=255, verbose_name='保存先の名前')
+    size = models.BigIntegerField(default=0, verbose_name='サイズ')
+    # 作成済みの派生画像の幅（未作成なら null）。同じ画像を再登録したときに作り直さないため
+    derivative_widths = models.JSONField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = '保存済みファイル'
+        verbose_name_plural = '保存済みファイル'
+
+    def __str__(self):
+        return self.name
@@ -0,0 +1,113 @@
+import logging
+from datetime import timedelta
+from typing import Iterable, Optional
+
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+from django.utils import timezone
+
+from .models import EmailOutbox
+
+
+logger = logging.getLogger(__name__)
+
+
+def enqueue_mail(subject: str, body: str, from_email: str, recipient_list: Iterable[str], order=None) -> EmailOutbox:
+    """
+    メールを送信待ちとして保存する。呼び出し元のトランザクションと一緒にコミットされる。
+    """
+    return EmailOutbox.objects.create(
+        order=order,
+        subject=subject,
+        body=body,
+        from_email=from_email or '',
+        to=list(recipient_list),
+    )
+
+
+def backoff_delay(attempts: int, base_seconds: int, max_seconds: int) -> timedelta:
+    """1回目の失敗で base、以降 2倍ずつ（上限 max）待ってから再送する。"""
+    return timedelta(seconds=min(base_seconds * 2 ** max(attempts - 1, 0), max_seconds))
+
+
+def claim_pending(batch_size: int, lease_seconds: int) -> tuple:
+    """
+    送信時刻を過ぎた送信待ちメールを最大 batch_size 件取り出し、次回送信時刻を lease_seconds 後にずらして借りる。
+    複数のワーカーが同時に動いても同じメールを取らないよう、行ロック（SKIP LOCKED）で取り出す。
+    ロックはこの短いトランザクションの間だけで、送信中は持たない。ワーカーが途中で落ちても、
+    期限が過ぎれば別のワーカーが送り直す。戻り値は (メールのリスト, 借りた期限)。
+    """
+    now = timezone.now()
+    lease_until = now + timedelta(seconds=lease_seconds)
+    with transaction.atomic():
+        batch = list(
+            EmailOutbox.objects.select_for_update(skip_locked=True)
+            .filter(status='pending', next_attempt_at__lte=now)
+            .order_by('next_attempt_at', 'pk')[:batch_size]
+        )
+        if batch:
+            EmailOutbox.objects.filter(pk__in=[mail.pk for mail in batch]).update(next_attempt_at=lease_until)
+    return batch, lease_until
+
+
+def send_pending(batch_size: int = 100, max_attempts: int = 5,
+                 backoff_seconds: int = 60, max_backoff_seconds: int = 60 * 60,
+                 lease_seconds: int = 15 * 60, connection=None) -> Optional[dict]:
+    """
+    送信時刻を過ぎた送信待ちメールを最大 batch_size 件、1本の SMTP 接続で送る。
+    - 取り出し（claim_pending）と結果の記録はそれぞれ短いトランザクションで行い、SMTP の送信はその外で行う
+    - 失敗したメールは指数バックオフで次回送信時刻をずらす
+    - max_attempts 回失敗したものは dead にして再送しない
+    - 送信に lease_seconds 以上かかって別のワーカーが借り直したメールは、結果を記録しない
+    戻り値は {'sent': n, 'retry': n, 'dead': n}。対象が無ければ None。
+    """
+    batch, lease_until = claim_pending(batch_size, lease_seconds)
+    if not batch:
+        return None
+
+    result = {'sent': 0, 'retry': 0, 'dead': 0}
+    connection = connection or get_connection()
+    try:
+        connection.open()
+    except Exception as e:
+        logger.warning('SMTP 接続に失敗しました: %s', e)
+
+    try:
+        for mail in batch:
+            message = EmailMessage(mail.subject, mail.body, mail.from_email or None, mail.to,
+                                   connection=connection)
+            try:
+                message.send()
+            except Exception as e:
+                mail.attempts += 1
+                mail.last_error = f'{type(e).__name__}: {e}'
+                if mail.attempts >= max_attempts:
+                    mail.status = 'dead'
+                    result['dead'] += 1
+                    logger.error('メール送信を諦めました (id=%s): %s', mail.pk, mail.last_error)
+                else:
+                    mail.next_attempt_at = timezone.now() + backoff_delay(
+                        mail.attempts, backoff_seconds, max_backoff_seconds
+                    )
+                    result['retry'] += 1
+            else:
+                mail.attempts += 1
+                mail.status = 'sent'
+                mail.sent_at = timezone.now()
+                result['sent'] += 1
+    finally:
+        connection.close()
+
+    with transaction.atomic():
+        owned = set(
+            EmailOutbox.objects.select_for_update()
+            .filter(pk__in=[mail.pk for mail in batch], status='pending', next_attempt_at=lease_until)
+            .values_list('pk', flat=True)
+        )
+        if len(owned) < len(batch):
+            logger.warning('借りた期限を過ぎたため、%s 件の送信結果を記録しませんでした', len(batch) - len(owned))
+        EmailOutbox.objects.bulk_update(
+            [mail for mail in batch if mail.pk in owned],
+            ['status', 'attempts', 'next_attempt_at', 'last_error', 'sent_at'],
+        )
+    return result
@@ -0,0 +1,187 @@
+import base64
+import json
+from dataclasses import dataclass
+from typing import Any, List, Optional, Sequence, Tuple
+
+from django.db import connections
+from django.db.models import Q
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(values: Sequence[Any]) -> str:
+    """
+    並び順の列の値を URL に載せられる不透明な文字列にする。
+    Decimal / datetime などは文字列化して JSON に詰める。
+    """
+    payload = json.dumps([str(v) if not isinstance(v, (int, str)) else v for v in values],
+                         separators=(',', ':'), ensure_ascii=False)
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor: str) -> List[Any]:
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')).decode('utf-8'))
+    except (ValueError, UnicodeError):
+        raise InvalidCursor(cursor)
+    if not isinstance(values, list):
+        raise InvalidCursor(cursor)
+    return values
+
+
+@dataclass
+class KeysetPage:
+    object_list: List[Any]
+    next_cursor: Optional[str] = None
+    previous_cursor: Optional[str] = None
+
+    @property
+    def has_next(self) -> bool:
+        return self.next_cursor is not None
+
+    @property
+    def has_previous(self) -> bool:
+        return self.previous_cursor is not None
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+
+class KeysetPaginator:
+    """
+    OFFSET を使わないカーソル（keyset）ページネーション。
+    - ordering は一意になる列の組（最後は必ず pk / id）で指定する。先頭の '-' は降順
+    - after / before にはページ端の行の値をエンコードしたカーソルを渡す
+    - どのページも「WHERE (並び順の列) > (カーソル) ORDER BY ... LIMIT n+1」の1クエリで取れるので、
+      深いページでも 1ページ目と同じコストになる
+    """
+
+    def __init__(self, queryset, ordering: Sequence[str] = ('pk',), per_page: int = 20):
+        self.queryset = queryset
+        self.ordering = list(ordering)
+        self.per_page = per_page
+        self.fields = [o.lstrip('-') for o in self.ordering]
+        self.descending = [o.startswith('-') for o in self.ordering]
+
+    def _to_python(self, values):
+        if len(values) != len(self.fields):
+            raise InvalidCursor(values)
+        model = self.queryset.model
+        converted = []
+        for name, value in zip(self.fields, values):
+            model_field = model._meta.pk if name == 'pk' else model._meta.get_field(name)
+            try:
+                value = model_field.to_python(value)
+            except Exception:
+                raise InvalidCursor(values)
+            # None は比較に使えない（encode_cursor は None を作らない）
+            if value is None:
+                raise InvalidCursor(values)
+            converted.append(value)
+        return converted
+
+    def _seek_filter(self, values, forward: bool) -> Q:
+        """
+        (a, b, c) > (x, y, z) を展開した条件を作る。
+          a >= x AND (a > x OR (a = x AND b > y) OR (a = x AND b = y AND c > z))
+        先頭の a >= x は意味の上では不要だが、これがあると DB が (a, b, c) の索引の途中から読み始められる
+        （OR だけだと索引の先頭から読み飛ばすことになり、深いページほど遅くなる）。
+        """
+        condition = Q()
+        for i, name in enumerate(self.fields):
+            lookup = 'lt' if self.descending[i] == forward else 'gt'
+            term = Q(**{f'{name}__{lookup}': values[i]})
+            for prev_name, prev_value in zip(self.fields[:i], values[:i]):
+                term &= Q(**{prev_name: prev_value})
+            condition |= term
+        if len(self.fields) > 1:
+            lookup = 'lte' if self.descending[0] == forward else 'gte'
+            condition = Q(**{f'{self.fields[0]}__{lookup}': values[0]}) & condition
+        return condition
+
+    def _cursor_for(self, obj) -> str:
+        return encode_cursor([getattr(obj, name) for name in self.fields])
+
+    def _page_queryset(self, after: Optional[str], before: Optional[str]):
+        """ページの行を読むクエリ（LIMIT per_page + 1）と、前向きに読むかどうか。"""
+        queryset = self.queryset
+        forward = not before
+
+        if after or before:
+            values = self._to_python(decode_cursor(after or before))
+            queryset = queryset.filter(self._seek_filter(values, forward))
+
+        if forward:
+            ordering = self.ordering
+        else:
+            ordering = [o[1:] if o.startswith('-') else f'-{o}' for o in self.ordering]
+        return queryset.order_by(*ordering)[:self.per_page + 1], forward
+
+    def _make_page(self, rows, forward: bool, after: Optional[str]) -> KeysetPage:
+        has_more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+
+        if not forward:
+            rows.reverse()
+
+        page = KeysetPage(object_list=rows)
+        if rows:
+            if forward:
+                page.next_cursor = self._cursor_for(rows[-1]) if has_more else None
+                page.previous_cursor = self._cursor_for(rows[0]) if after else None
+            else:
+                page.previous_cursor = self._cursor_for(rows[0]) if has_more else None
+                page.next_cursor = self._cursor_for(rows[-1])
+        return page
+
+    def page(self, after: Optional[str] = None, before: Optional[str] = None) -> KeysetPage:
+        queryset, forward = self._page_queryset(after, before)
+        return self._make_page(list(queryset), forward, after)
+
+    async def apage(self, after: Optional[str] = None, before: Optional[str] = None) -> KeysetPage:
+        """page の async 版。"""
+        queryset, forward = self._page_queryset(after, before)
+        return self._make_page([row async for row in queryset], forward, after)
+
+
+def estimate_count(queryset, cap: int = 1000) -> Tuple[int, str]:
+    """
+    COUNT(*) で全件を数えずに件数の目安を返す。戻り値は (件数, 種類)。種類は次のどれか。
+    - 'estimate': PostgreSQL の推定値（絞り込みなしなら pg_class.reltuples、絞り込みありなら実行計画の推定行数）
+    - 'at_least': cap + 1 件までしか数えず、超えた（件数は cap で、「cap 件以上」の意味）
+    - 'exact': 正確な件数
+    推定値が cap 以下なら、安く数えられるので正確な件数を返す。
+    """
+    queryset = queryset.order_by()
+    db = queryset.db
+    connection = connections[db]
+
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            if not queryset.query.where.children:
+                cursor.execute(
+                    'SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass',
+                    [queryset.model._meta.db_table],
+                )
+                row = cursor.fetchone()
+                estimate = row[0] if row else -1
+            else:
+                sql, params = queryset.values('pk').query.sql_with_params()
+                cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+                plan = cursor.fetchone()[0]
+                if isinstance(plan, str):
+                    plan = json.loads(plan)
+                estimate = plan[0]['Plan']['Plan Rows']
+        if estimate > cap:
+            return int(estimate), 'estimate'
+
+    count = queryset.values('pk')[:cap + 1].count()
+    if count > cap:
+        return cap, 'at_least'
+    return count, 'exact'
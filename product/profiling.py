@@ -0,0 +1,196 @@
+"""
+本番環境での一部リクエストのプロファイリング。
+
+- PROFILE_SAMPLE_RATE が N なら N 件に1件をスタックサンプラーで計測する（0 なら無効）
+- 管理用の Basic 認証を付けて X-Profile ヘッダーを送ったリクエストは必ず計測する
+  （X-Profile: cprofile で cProfile、それ以外はスタックサンプラー）
+結果はキャッシュ上のリングバッファ（PROFILE_BUFFER_SIZE 件）に保存し、manage/profiles/ から
+pstats（cProfile）または collapsed-stack（フレームグラフ用）でダウンロードする。
+"""
+import cProfile
+import marshal
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from typing import List, Optional
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from .auth import has_basic_auth
+
+
+SEQUENCE_KEY = 'profiles:sequence'
+PROFILE_HEADER = 'HTTP_X_PROFILE'
+
+CPROFILE = 'cprofile'
+SAMPLER = 'sample'
+
+
+def _buffer_size() -> int:
+    return getattr(settings, 'PROFILE_BUFFER_SIZE', 20)
+
+
+def _slot_key(slot: int) -> str:
+    return f'profiles:slot:{slot}'
+
+
+def choose_mode(request) -> Optional[str]:
+    """このリクエストを計測するか。計測するなら方式（cprofile / sample）を返す。"""
+    requested = request.META.get(PROFILE_HEADER)
+    if requested and has_basic_auth(request):
+        return CPROFILE if requested.lower() == CPROFILE else SAMPLER
+    rate = getattr(settings, 'PROFILE_SAMPLE_RATE', 0)
+    if rate > 0 and random.random() * rate < 1:
+        return SAMPLER
+    return None
+
+
+def _frame_label(code) -> str:
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+
+class StackSampler:
+    """
+    別スレッドから一定間隔で対象スレッドのスタックを取り、同じスタックの回数を数える。
+    対象スレッドには何も仕掛けないので、cProfile より負荷が小さい。
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.stacks = Counter()
+        self._thread_id = threading.get_ident()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profile-sampler', daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(_frame_label(frame.f_code))
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def collapsed(self) -> str:
+        """Brendan Gregg の flamegraph.pl / speedscope が読める collapsed-stack 形式。"""
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+
+def run_profiled(mode: str, func, *args):
+    """func(*args) を計測しながら実行し、(戻り値, 計測結果) を返す。"""
+    if mode == CPROFILE:
+        profiler = cProfile.Profile()
+        result = profiler.runcall(func, *args)
+        profiler.create_stats()
+        # pstats.Stats(path) でそのまま読める形式（Profile.dump_stats と同じ）
+        return result, {'pstats': marshal.dumps(profiler.stats), 'collapsed': None}
+
+    interval = getattr(settings, 'PROFILE_SAMPLE_INTERVAL_MS', 5) / 1000
+    with StackSampler(interval) as sampler:
+        result = func(*args)
+    return result, {'pstats': None, 'collapsed': sampler.collapsed()}
+
+
+async def arun_profiled(mode: str, func, *args):
+    """
+    run_profiled の async 版（ASGI）。await func(*args) の間、イベントループのスレッドを計測する。
+    同じループで同時に処理しているほかのリクエストの分も混ざり、
+    sync_to_async のスレッドで動く処理（クエリ・テンプレートの描画）は含まれない。
+    """
+    if mode == CPROFILE:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            result = await func(*args)
+        finally:
+            profiler.disable()
+        profiler.create_stats()
+        return result, {'pstats': marshal.dumps(profiler.stats), 'collapsed': None}
+
+    interval = getattr(settings, 'PROFILE_SAMPLE_INTERVAL_MS', 5) / 1000
+    with StackSampler(interval) as sampler:
+        result = await func(*args)
+    return result, {'pstats': None, 'collapsed': sampler.collapsed()}
+
+
+def store(request, response, mode: str, duration: float, data: dict) -> int:
+    """計測結果をリングバッファに入れる。古いものから上書きされる。"""
+    cache.add(SEQUENCE_KEY, 0, timeout=None)
+    profile_id = cache.incr(SEQUENCE_KEY)
+    match = getattr(request, 'resolver_match', None)
+    cache.set(_slot_key(profile_id % _buffer_size()), {
+        'id': profile_id,
+        'mode': mode,
+        'method': request.method,
+        'path': request.get_full_path()[:500],
+        'view': match.view_name if match else '',
+        'status': response.status_code,
+        'duration': duration,
+        'created_at': timezone.now(),
+        **data,
+    }, timeout=None)
+    return profile_id
+
+
+def list_profiles() -> List[dict]:
+    """新しい順。"""
+    profiles = cache.get_many([_slot_key(slot) for slot in range(_buffer_size())]).values()
+    return sorted(profiles, key=lambda profile: profile['id'], reverse=True)
+
+
+def get_profile(profile_id: int) -> Optional[dict]:
+    profile = cache.get(_slot_key(profile_id % _buffer_size()))
+    # 上書き済みなら別の計測結果が入っている
+    if profile is None or profile['id'] != profile_id:
+        return None
+    return profile
+
+
+class ProfilingMiddleware:
+    """計測対象に選ばれたリクエストだけ、以降のミドルウェアとビューをまとめて計測する。WSGI / ASGI の両方で動く。"""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        mode = choose_mode(request)
+        if mode is None:
+            return self.get_response(request)
+
+        started = time.perf_counter()
+        response, data = run_profiled(mode, self.get_response, request)
+        duration = time.perf_counter() - started
+        response['X-Profile-Id'] = str(store(request, response, mode, duration, data))
+        return response
+
+    async def __acall__(self, request):
+        mode = choose_mode(request)
+        if mode is None:
+            return await self.get_response(request)
+
+        started = time.perf_counter()
+        response, data = await arun_profiled(mode, self.get_response, request)
+        duration = time.perf_counter() - started
+        response['X-Profile-Id'] = str(await sync_to_async(store)(request, response, mode, duration, data))
+        return response
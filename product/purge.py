@@ -0,0 +1,115 @@
+import time
+from importlib import import_module
+from typing import Callable, Optional
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+
+from .models import Cart, CartItem
+
+
+def _purge_in_batches(select_batch, delete_batch, batch_size: int, sleep: float,
+                      progress: Optional[Callable] = None) -> int:
+    """
+    「batch_size 件の ID を選ぶ → その ID だけ消す」を、対象が無くなるまで繰り返す。
+    1バッチ = 1トランザクションにして、ロックを持つ時間と1文あたりの削除件数を小さく保つ。
+    バッチの合間に sleep 秒待ち、本番のトラフィックに DB を明け渡す。
+    """
+    total = 0
+    while True:
+        started = time.monotonic()
+        with transaction.atomic():
+            ids = select_batch(batch_size)
+            if not ids:
+                return total
+            deleted = delete_batch(ids)
+        total += deleted
+        if progress:
+            progress(deleted=deleted, total=total, seconds=time.monotonic() - started)
+        if len(ids) < batch_size:
+            return total
+        if sleep:
+            time.sleep(sleep)
+
+
+def purge_stale_carts(older_than, batch_size: int = 1000, sleep: float = 0.0, progress=None) -> int:
+    """
+    最終操作日時（Cart.updated_at、インデックスあり）が older_than より前のカートを明細ごと消す。
+    注文処理中などでロックされているカートは飛ばす（SKIP LOCKED）。
+    """
+    def select_batch(limit):
+        return list(
+            Cart.objects.select_for_update(skip_locked=True)
+            .filter(updated_at__lt=older_than)
+            .order_by('updated_at')
+            .values_list('pk', flat=True)[:limit]
+        )
+
+    def delete_batch(ids):
+        # ロックを取った後でもう一度条件を確かめる（選んでから触られたカートは消さない）
+        return Cart.objects.filter(pk__in=ids, updated_at__lt=older_than).delete()[1].get(Cart._meta.label, 0)
+
+    return _purge_in_batches(select_batch, delete_batch, batch_size, sleep, progress)
+
+
+def purge_empty_carts(older_than, batch_size: int = 1000, sleep: float = 0.0, progress=None) -> int:
+    """明細が1件も無いまま older_than より前から放置されているカートを消す。"""
+    empty = Cart.objects.filter(updated_at__lt=older_than).exclude(
+        Exists(CartItem.objects.filter(cart_id=OuterRef('pk')))
+    )
+
+    def select_batch(limit):
+        return list(empty.select_for_update(skip_locked=True).order_by('updated_at').values_list('pk', flat=True)[:limit])
+
+    def delete_batch(ids):
+        return empty.filter(pk__in=ids).delete()[1].get(Cart._meta.label, 0)
+
+    return _purge_in_batches(select_batch, delete_batch, batch_size, sleep, progress)
+
+
+def purge_orphaned_items(batch_size: int = 1000, sleep: float = 0.0, progress=None) -> int:
+    """
+    存在しないカートを指している明細を消す。
+    外部キー制約があれば通常は 0 件だが、制約が効いていなかった頃のデータを掃除する。
+    """
+    orphans = CartItem.objects.exclude(Exists(Cart.objects.filter(pk=OuterRef('cart_id'))))
+
+    def select_batch(limit):
+        return list(orphans.order_by('pk').values_list('pk', flat=True)[:limit])
+
+    def delete_batch(ids):
+        return CartItem.objects.filter(pk__in=ids).delete()[0]
+
+    return _purge_in_batches(select_batch, delete_batch, batch_size, sleep, progress)
+
+
+def session_model():
+    """DB にセッションを保存する設定（db / cached_db）のときだけ、そのモデルを返す。"""
+    engine = import_module(settings.SESSION_ENGINE)
+    store = getattr(engine, 'SessionStore', None)
+    if store is None or not hasattr(store, 'get_model_class'):
+        return None
+    return store.get_model_class()
+
+
+def purge_expired_sessions(now, batch_size: int = 1000, sleep: float = 0.0, progress=None) -> int:
+    """
+    有効期限切れのセッションを消す（clearsessions と同じ対象を、バッチに分けて消す）。
+    expire_date にはインデックスがある。
+    """
+    model = session_model()
+    if model is None:
+        return 0
+
+    def select_batch(limit):
+        return list(
+            model.objects.filter(expire_date__lt=now)
+            .order_by('expire_date')
+            .values_list('pk', flat=True)[:limit]
+        )
+
+    def delete_batch(ids):
+        return model.objects.filter(pk__in=ids, expire_date__lt=now).delete()[0]
+
+    return _purge_in_batches(select_batch, delete_batch, batch_size, sleep, progress)
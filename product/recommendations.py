@@ -0,0 +1,172 @@
+from datetime import timedelta
+from typing import Iterable, Tuple
+
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+from scipy import sparse
+
+from .catalog import bump_recommendation_version
+from .db import upsert_add
+from .models import Order, OrderItem, Product, ProductCooccurrence, ProductRecommendation, Watermark
+
+
+WATERMARK_NAME = 'recommendations'
+
+
+def _top_k() -> int:
+    return getattr(settings, 'RECOMMENDATION_TOP_K', 4)
+
+
+def cooccurrence_counts(pairs: Iterable[Tuple[int, int]]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    (注文ID, 商品ID) の組から、商品の組 (a, b) ごとに「両方を含む注文の数」n を数え、配列 a, b, n で返す。
+    注文×商品の 0/1 の疎行列 M を作り、M.T @ M の非対角成分を取り出す（対称なので両方向が得られる）。
+    同じ注文に同じ商品が複数行あっても1と数える。
+    """
+    pairs = np.fromiter((v for pair in pairs for v in pair), dtype=np.int64).reshape(-1, 2)
+    if not len(pairs):
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, empty
+    order_ids, rows = np.unique(pairs[:, 0], return_inverse=True)
+    product_ids, cols = np.unique(pairs[:, 1], return_inverse=True)
+    matrix = sparse.csr_matrix(
+        (np.ones(len(pairs), dtype=np.int32), (rows, cols)), shape=(len(order_ids), len(product_ids))
+    )
+    # 重複した (注文, 商品) は足し合わされているので 1 に戻す
+    matrix.data[:] = 1
+
+    counts = (matrix.T @ matrix).tocoo()
+    off_diagonal = counts.row != counts.col
+    return (
+        product_ids[counts.row[off_diagonal]],
+        product_ids[counts.col[off_diagonal]],
+        counts.data[off_diagonal].astype(np.int64),
+    )
+
+
+def top_neighbours(a: np.ndarray, b: np.ndarray, n: np.ndarray, k: int) -> Tuple[np.ndarray, ...]:
+    """
+    商品 a ごとに、回数 n の多い順（同数なら新しい商品 b から）に上位 k 件を選び、(a, b, n, 順位) を返す。
+    Python のループを使わず、並べ替えとグループ内の連番だけで求める。
+    """
+    order = np.lexsort((-b, -n, a))
+    a, b, n = a[order], b[order], n[order]
+    starts = np.flatnonzero(np.r_[True, a[1:] != a[:-1]])
+    ranks = np.arange(len(a)) - np.repeat(starts, np.diff(np.r_[starts, len(a)])) + 1
+    keep = ranks <= k
+    return a[keep], b[keep], n[keep], ranks[keep]
+
+
+def _save_recommendations(product_ids, a: np.ndarray, b: np.ndarray, n: np.ndarray) -> int:
+    """product_ids のおすすめを置き換える。削除済みの商品は除く。"""
+    existing = np.fromiter(
+        Product.objects.filter(pk__in=np.union1d(a, b).tolist()).values_list('pk', flat=True), dtype=np.int64
+    )
+    alive = np.isin(a, existing) & np.isin(b, existing)
+    a, b, n, ranks = top_neighbours(a[alive], b[alive], n[alive], _top_k())
+
+    ProductRecommendation.objects.filter(product_id__in=product_ids).delete()
+    ProductRecommendation.objects.bulk_create([
+        ProductRecommendation(product_id=pa, recommended_id=pb, rank=rank, score=count)
+        for pa, pb, count, rank in zip(a.tolist(), b.tolist(), n.tolist(), ranks.tolist())
+    ], batch_size=1000)
+    # 商品詳細の ETag を変える
+    transaction.on_commit(bump_recommendation_version)
+    return len(a)
+
+
+def refresh_recommendations(product_ids: Iterable[int]) -> int:
+    """指定した商品のおすすめを ProductCooccurrence から作り直す。戻り値は作った行数。"""
+    product_ids = set(product_ids)
+    if not product_ids:
+        return 0
+    rows = np.array(
+        ProductCooccurrence.objects.filter(product_a__in=product_ids).values_list('product_a', 'product_b', 'orders'),
+        dtype=np.int64,
+    ).reshape(-1, 3)
+    return _save_recommendations(product_ids, rows[:, 0], rows[:, 1], rows[:, 2])
+
+
+def get_watermark():
+    return Watermark.objects.filter(name=WATERMARK_NAME).first()
+
+
+def update_recommendations(batch_size: int = 5000, lag_seconds: int = 60) -> int:
+    """
+    前回の続き（watermark の注文ID より後）から、注文を batch_size 件ずつ同時購入の回数に加算し、
+    そのバッチに出てきた商品のおすすめだけを作り直す。戻り値は処理した注文数。
+    同時購入は同じ注文の中でしか起きないので、注文単位に区切って足していけば全件で数えたのと同じになる。
+    コミット順と ID の順のずれへの対処は売上集計（rollups.update_rollups）と同じ。
+    """
+    cutoff = timezone.now() - timedelta(seconds=lag_seconds)
+    processed = 0
+    while True:
+        with transaction.atomic():
+            watermark, _ = Watermark.objects.select_for_update().get_or_create(name=WATERMARK_NAME)
+            pending = Order.objects.filter(pk__gt=watermark.value).order_by('pk')
+            ids = []
+            for pk, created_at in pending.values_list('pk', 'created_at')[:batch_size]:
+                if created_at >= cutoff:
+                    break
+                ids.append(pk)
+            if not ids:
+                return processed
+
+            pairs = OrderItem.objects.filter(
+                order_id__gt=watermark.value, order_id__lte=ids[-1], product_id__isnull=False
+            ).values_list('order_id', 'product_id')
+            a, b, n = cooccurrence_counts(pairs.iterator(chunk_size=batch_size))
+            upsert_add(
+                ProductCooccurrence,
+                conflict_fields=['product_a', 'product_b'],
+                rows=[
+                    {'product_a': pa, 'product_b': pb, 'orders': count}
+                    for pa, pb, count in zip(a.tolist(), b.tolist(), n.tolist())
+                ],
+                add_fields=['orders'],
+            )
+            refresh_recommendations(a.tolist())
+
+            watermark.value = ids[-1]
+            watermark.save(update_fields=['value', 'updated_at'])
+            processed += len(ids)
+
+
+def rebuild_recommendations(batch_size: int = 5000, lag_seconds: int = 60) -> int:
+    """
+    同時購入の回数とおすすめを空にして、全注文から作り直す。戻り値は反映した注文数。
+    差分更新のように回数を1バッチずつ足し込むと遅いので、全注文の明細を一度に数えて一括で書き込む。
+    """
+    cutoff = timezone.now() - timedelta(seconds=lag_seconds)
+    with transaction.atomic():
+        Watermark.objects.select_for_update().filter(name=WATERMARK_NAME).delete()
+        ProductCooccurrence.objects.all().delete()
+        ProductRecommendation.objects.all().delete()
+
+        # 作成から lag_seconds 経っていない最初の注文の手前までを対象にする
+        first_recent = Order.objects.filter(created_at__gte=cutoff).order_by('pk').values_list('pk', flat=True).first()
+        orders = Order.objects.filter(pk__lt=first_recent) if first_recent else Order.objects.all()
+        last_id = orders.aggregate(last=Max('pk'))['last'] or 0
+
+        pairs = OrderItem.objects.filter(order_id__lte=last_id, product_id__isnull=False).values_list(
+            'order_id', 'product_id'
+        )
+        a, b, n = cooccurrence_counts(pairs.iterator(chunk_size=batch_size))
+        ProductCooccurrence.objects.bulk_create([
+            ProductCooccurrence(product_a=pa, product_b=pb, orders=count)
+            for pa, pb, count in zip(a.tolist(), b.tolist(), n.tolist())
+        ], batch_size=batch_size)
+        _save_recommendations(set(a.tolist()), a, b, n)
+        Watermark.objects.create(name=WATERMARK_NAME, value=last_id)
+        processed = orders.count()
+    return processed + update_recommendations(batch_size=batch_size, lag_seconds=lag_seconds)
+
+
+def recommended_products(product, fields: Iterable[str]):
+    """詳細ページ用。おすすめ商品を順位順に1クエリで読む（ProductRecommendation の一意制約のインデックスを使う）。"""
+    return Product.objects.only(*fields).filter(
+        recommended_for__product=product
+    ).order_by('recommended_for__rank')
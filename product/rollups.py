@@ -0,0 +1,159 @@
+from datetime import datetime, time, timedelta
+from typing import Dict, List, Optional
+
+from django.db import transaction
+from django.db.models import Count, DecimalField, F, Max, Sum
+from django.db.models.functions import Coalesce, TruncDate, TruncHour
+from django.utils import timezone
+
+from .db import upsert_add
+from .models import Order, OrderItem, ProductSalesDaily, SalesHourly, Watermark
+
+
+WATERMARK_NAME = 'sales_rollups'
+
+_revenue = Sum(F('product_price') * F('quantity'), output_field=DecimalField(max_digits=14, decimal_places=2))
+
+
+def _hourly_totals(items) -> Dict:
+    rows = (
+        items.annotate(period=TruncHour('order__created_at'))
+        .values('period')
+        .annotate(revenue=_revenue, units=Sum('quantity'), orders=Count('order_id', distinct=True))
+    )
+    return {row['period']: row for row in rows}
+
+
+def _product_daily_totals(items) -> Dict:
+    rows = (
+        items.annotate(day=TruncDate('order__created_at'), pid=Coalesce('product_id', 0))
+        .values('day', 'pid')
+        .annotate(
+            name=Max('product_name'), revenue=_revenue,
+            units=Sum('quantity'), orders=Count('order_id', distinct=True),
+        )
+    )
+    return {(row['day'], row['pid']): row for row in rows}
+
+
+def _apply(items):
+    upsert_add(
+        SalesHourly,
+        conflict_fields=['hour'],
+        rows=[
+            {'hour': hour, 'revenue': row['revenue'], 'units': row['units'], 'orders': row['orders']}
+            for hour, row in _hourly_totals(items).items()
+        ],
+        add_fields=['revenue', 'units', 'orders'],
+    )
+    upsert_add(
+        ProductSalesDaily,
+        conflict_fields=['day', 'product_id'],
+        rows=[
+            {'day': day, 'product_id': pid, 'product_name': row['name'],
+             'revenue': row['revenue'], 'units': row['units'], 'orders': row['orders']}
+            for (day, pid), row in _product_daily_totals(items).items()
+        ],
+        add_fields=['revenue', 'units', 'orders'],
+    )
+
+
+def get_watermark() -> Optional[Watermark]:
+    return Watermark.objects.filter(name=WATERMARK_NAME).first()
+
+
+def update_rollups(batch_size: int = 1000, lag_seconds: int = 60) -> int:
+    """
+    前回の続き（watermark の注文ID より後）から、注文を batch_size 件ずつ集計テーブルに加算する。
+    戻り値は処理した注文数。
+    - 集計は DB 側の GROUP BY で行い、1バッチあたり数本のクエリで済ませる
+    - 注文IDの採番順とコミット順は一致しないので、作成から lag_seconds 経っていない注文は次回に回す
+      （まだコミットされていない小さい ID の注文を飛ばさないため）
+    - バッチごとに watermark の行をロックし、集計と watermark の更新を同じトランザクションで行う
+      （途中で止まっても、同時に2つ動いても二重に加算されない）
+    """
+    cutoff = timezone.now() - timedelta(seconds=lag_seconds)
+    processed = 0
+    while True:
+        with transaction.atomic():
+            watermark, _ = Watermark.objects.select_for_update().get_or_create(name=WATERMARK_NAME)
+            pending = Order.objects.filter(pk__gt=watermark.value).order_by('pk')
+            ids = []
+            for pk, created_at in pending.values_list('pk', 'created_at')[:batch_size]:
+                if created_at >= cutoff:
+                    break
+                ids.append(pk)
+            if not ids:
+                return processed
+
+            _apply(OrderItem.objects.filter(order_id__gt=watermark.value, order_id__lte=ids[-1]))
+            watermark.value = ids[-1]
+            watermark.save(update_fields=['value', 'updated_at'])
+            processed += len(ids)
+
+
+def rebuild_rollups(batch_size: int = 1000, lag_seconds: int = 60) -> int:
+    """集計テーブルを空にして、全注文から作り直す。"""
+    with transaction.atomic():
+        Watermark.objects.select_for_update().filter(name=WATERMARK_NAME).delete()
+        SalesHourly.objects.all().delete()
+        ProductSalesDaily.objects.all().delete()
+    return update_rollups(batch_size=batch_size, lag_seconds=lag_seconds)
+
+
+def check_rollups(since=None) -> List[str]:
+    """
+    集計テーブルと、注文明細から直接集計した値を比べ、食い違いの一覧を返す（空なら一致）。
+    比べるのは watermark までの注文だけ。since（日付）を渡すとその日以降に絞る。
+    """
+    watermark = get_watermark()
+    items = OrderItem.objects.filter(order_id__lte=watermark.value if watermark else 0)
+    hourly = SalesHourly.objects.all()
+    daily = ProductSalesDaily.objects.all()
+    if since:
+        start = timezone.make_aware(datetime.combine(since, time.min))
+        items = items.filter(order__created_at__gte=start)
+        hourly = hourly.filter(hour__gte=start)
+        daily = daily.filter(day__gte=since)
+
+    problems = []
+    fields = ('revenue', 'units', 'orders')
+
+    expected = _hourly_totals(items)
+    actual = {row.hour: row for row in hourly}
+    for hour in sorted(set(expected) | set(actual)):
+        want = tuple(expected[hour][f] for f in fields) if hour in expected else (0, 0, 0)
+        got = tuple(getattr(actual[hour], f) for f in fields) if hour in actual else (0, 0, 0)
+        if want != got:
+            problems.append(f'{timezone.localtime(hour):%Y-%m-%d %H}時: 集計 {got} / 明細 {want}')
+
+    expected = _product_daily_totals(items)
+    actual = {(row.day, row.product_id): row for row in daily}
+    for key in sorted(set(expected) | set(actual)):
+        want = tuple(expected[key][f] for f in fields) if key in expected else (0, 0, 0)
+        got = tuple(getattr(actual[key], f) for f in fields) if key in actual else (0, 0, 0)
+        if want != got:
+            problems.append(f'{key[0]} 商品ID {key[1]}: 集計 {got} / 明細 {want}')
+    return problems
+
+
+def daily_sales(start_day):
+    """start_day 以降の日次売上（新しい日から）。時間別の集計行を日ごとに足し合わせる。"""
+    start = timezone.make_aware(datetime.combine(start_day, time.min))
+    return list(
+        SalesHourly.objects.filter(hour__gte=start)
+        .annotate(day=TruncDate('hour'))
+        .values('day')
+        .annotate(revenue=Sum('revenue'), units=Sum('units'), orders=Sum('orders'))
+        .order_by('-day')
+    )
+
+
+def top_products(start_day, limit: int = 20):
+    """start_day 以降の売上上位の商品。"""
+    return list(
+        ProductSalesDaily.objects.filter(day__gte=start_day)
+        .values('product_id')
+        .annotate(name=Max('product_name'), revenue=Sum('revenue'), units=Sum('units'), orders=Sum('orders'))
+        .order_by('-revenue', 'product_id')[:limit]
+    )
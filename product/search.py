@@ -0,0 +1,228 @@
+import re
+import unicodedata
+from typing import Iterable, List
+
+from django.db import connection
+
+from .models import Product, ProductSearchDocument
+
+
+FTS_TABLE = 'product_search_fts'
+
+_RUN_RE = re.compile(r'\w+')
+_SEGMENT_RE = re.compile(r'[0-9a-z]+|[^0-9a-z_]+')
+
+
+def normalize(text: str) -> str:
+    """全角英数字・半角カナなどを NFKC で揃え、小文字にする。"""
+    return unicodedata.normalize('NFKC', text or '').lower()
+
+
+def _segments(text: str):
+    """
+    文字列を (segment, is_ascii) に分解する。
+    英数字は単語のまま、日本語などの空白で区切られない文字列はひとかたまりで返す。
+    """
+    for run in _RUN_RE.findall(normalize(text)):
+        for segment in _SEGMENT_RE.findall(run):
+            yield segment, segment.isascii()
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    インデックス用のトークン列を作る。
+    - 英数字: 単語単位（'nike', '2026'）
+    - 日本語など: 2文字ずつずらした bigram（'デニムパンツ' -> 'デニ', 'ニム', 'ムパ', 'パン', 'ンツ'）
+    """
+    tokens = []
+    for segment, is_ascii in _segments(text):
+        if is_ascii or len(segment) == 1:
+            tokens.append(segment)
+        else:
+            tokens.extend(segment[i:i + 2] for i in range(len(segment) - 1))
+    return list(dict.fromkeys(tokens))
+
+
+def query_terms(text: str) -> List[tuple]:
+    """
+    検索語を (term, is_prefix) のリストにする。
+    入力途中の英単語や 1文字だけの日本語は前方一致で扱う。
+    """
+    terms = []
+    for segment, is_ascii in _segments(text):
+        if is_ascii or len(segment) == 1:
+            terms.append((segment, True))
+        else:
+            terms.extend((segment[i:i + 2], False) for i in range(len(segment) - 1))
+    return list(dict.fromkeys(terms))
+
+
+def document_for(product: Product) -> str:
+    return ' '.join(tokenize(f'{product.name} {product.description or ""}'))
+
+
+def escape_like(text: str) -> str:
+    """LIKE のワイルドカード（% と _）とエスケープ文字（\\）を、文字そのものとして扱うようにする。"""
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+class BaseSearchBackend:
+    """
+    どの DB でも動く最低限の実装。
+    ProductSearchDocument のトークン列に対して部分一致で探すため、件数が増えると遅くなる。
+    """
+
+    def index(self, products: Iterable[Product]):
+        documents = [
+            ProductSearchDocument(product_id=p.pk, tokens=document_for(p), name=normalize(p.name)) for p in products
+        ]
+        if not documents:
+            return
+        ProductSearchDocument.objects.filter(product_id__in=[d.product_id for d in documents]).delete()
+        ProductSearchDocument.objects.bulk_create(documents)
+
+    def remove(self, product_ids: Iterable[int]):
+        ProductSearchDocument.objects.filter(product_id__in=list(product_ids)).delete()
+
+    def clear(self):
+        ProductSearchDocument.objects.all().delete()
+
+    def search(self, text: str, limit: int) -> List[int]:
+        terms = query_terms(text)
+        if not terms:
+            return []
+        queryset = ProductSearchDocument.objects.all()
+        for term, _ in terms:
+            queryset = queryset.filter(tokens__contains=term)
+        return list(queryset.values_list('product_id', flat=True)[:limit])
+
+
+class SqliteSearchBackend(BaseSearchBackend):
+    """
+    SQLite の FTS5 仮想テーブルを使う実装。
+    rowid に product_id を入れ、bigram 済みのトークン列を空白区切りで保存する。
+    """
+
+    def index(self, products):
+        products = list(products)
+        super().index(products)
+        with connection.cursor() as cursor:
+            cursor.executemany(f'DELETE FROM {FTS_TABLE} WHERE rowid = %s', [(p.pk,) for p in products])
+            cursor.executemany(f'INSERT INTO {FTS_TABLE} (rowid, tokens) VALUES (%s, %s)',
+                               [(p.pk, document_for(p)) for p in products])
+
+    def remove(self, product_ids):
+        product_ids = list(product_ids)
+        super().remove(product_ids)
+        with connection.cursor() as cursor:
+            cursor.executemany(f'DELETE FROM {FTS_TABLE} WHERE rowid = %s', [(pk,) for pk in product_ids])
+
+    def clear(self):
+        super().clear()
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {FTS_TABLE}')
+
+    def search(self, text, limit):
+        terms = query_terms(text)
+        if not terms:
+            return []
+        match = ' AND '.join(
+            '"{}"{}'.format(term.replace('"', '""'), '*' if is_prefix else '') for term, is_prefix in terms
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s ORDER BY rank LIMIT %s',
+                [match, limit],
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+
+class PostgresSearchBackend(BaseSearchBackend):
+    """
+    PostgreSQL の GIN インデックスを使う実装。
+    - トークン列は array_to_tsvector で「そのまま」lexeme にする（パーサやロケールに日本語を分割させない）
+    - 正規化した商品名（ProductSearchDocument.name）には pg_trgm の GIN インデックスもあり、
+      トークン境界をまたぐ部分一致を拾う。検索語も同じように正規化するので、全角・半角の違いは問わない
+    """
+
+    vector_sql = "array_to_tsvector(string_to_array(d.tokens, ' '))"
+
+    def search(self, text, limit):
+        terms = query_terms(text)
+        if not terms:
+            return []
+        tsquery = ' & '.join(
+            "'{}'{}".format(term.replace("'", "''").replace('\\', '\\\\'), ':*' if is_prefix else '')
+            for term, is_prefix in terms
+        )
+        # tsvector の GIN と商品名の pg_trgm の GIN を別々に引いて UNION する
+        # （結合した表をまたいで OR にすると、どちらのインデックスも使えず全件を読む）
+        hits = f"""
+            SELECT d.product_id, ts_rank({self.vector_sql}, %s::tsquery) AS rank
+            FROM product_productsearchdocument d
+            WHERE {self.vector_sql} @@ %s::tsquery
+        """
+        params = [tsquery, tsquery]
+        needle = normalize(text).strip()
+        # pg_trgm のインデックスが効くのは 3文字以上のときだけ
+        if len(needle) >= 3:
+            hits += r"""
+            UNION ALL
+            SELECT n.product_id, 0 FROM product_productsearchdocument n WHERE n.name LIKE %s ESCAPE '\'
+            """
+            params.append(f'%{escape_like(needle)}%')
+
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                SELECT product_id FROM ({hits}) hits
+                GROUP BY product_id
+                ORDER BY MAX(rank) DESC, product_id
+                LIMIT %s
+                """,
+                params + [limit],
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+
+def get_backend() -> BaseSearchBackend:
+    if connection.vendor == 'sqlite':
+        return SqliteSearchBackend()
+    if connection.vendor == 'postgresql':
+        return PostgresSearchBackend()
+    return BaseSearchBackend()
+
+
+def index_product(product: Product):
+    get_backend().index([product])
+
+
+def remove_product(product_id: int):
+    get_backend().remove([product_id])
+
+
+def rebuild_index(batch_size: int = 1000) -> int:
+    backend = get_backend()
+    backend.clear()
+    count = 0
+    batch = []
+    for product in Product.objects.only('pk', 'name', 'description').iterator(chunk_size=batch_size):
+        batch.append(product)
+        if len(batch) >= batch_size:
+            backend.index(batch)
+            count += len(batch)
+            batch = []
+    if batch:
+        backend.index(batch)
+        count += len(batch)
+    return count
+
+
+def search_products(text: str, limit: int = 50, fields=None) -> List[Product]:
+    """検索語に一致する商品を関連度順に返す。"""
+    product_ids = get_backend().search(text, limit)
+    queryset = Product.objects.all()
+    if fields:
+        queryset = queryset.only(*fields)
+    products = queryset.in_bulk(product_ids)
+    return [products[pk] for pk in product_ids if pk in products]
@@ -0,0 +1,45 @@
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import metrics, search
+from .catalog import bump_catalog_version, bump_product_version
+from .models import Product
+
+# これらの項目が変わったときだけ検索インデックスを作り直す
+SEARCH_FIELDS = {'name', 'description'}
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def product_changed(sender, instance, **kwargs):
+    """
+    商品が保存・削除されたらバージョンを進める。
+    管理画面・商品管理ビュー・seed_products のどこから変更しても、古いカードが表示されることはない。
+    （QuerySet.update() はシグナルを送らないので、使う場合は自分で bump すること）
+    """
+    bump_product_version(instance.pk)
+    bump_catalog_version()
+
+
+@receiver(post_save, sender=Product)
+def index_saved_product(sender, instance, update_fields=None, **kwargs):
+    """
+    保存された商品を検索インデックスに入れ直す（管理画面など、どこから保存しても検索結果が古くならない）。
+    bulk_create・QuerySet.update() はシグナルを送らないので、使う場合は自分で入れること。
+    """
+    if update_fields is not None and not SEARCH_FIELDS & set(update_fields):
+        return
+    search.index_product(instance)
+
+
+@receiver(post_delete, sender=Product)
+def unindex_deleted_product(sender, instance, **kwargs):
+    """削除された商品を検索インデックスから外す（FTS5 の行は CASCADE で消えないため）。"""
+    search.remove_product(instance.pk)
+
+
+@receiver(connection_created)
+def instrument_connection(sender, connection, **kwargs):
+    """DB に接続したら、MetricsMiddleware がクエリを数えられるようにする（スレッドごとの接続すべて）。"""
+    metrics.instrument_connection(connection)
@@ -0,0 +1,188 @@
+import hashlib
+import posixpath
+from typing import Dict, Iterable, List, Optional
+
+import cloudinary
+import cloudinary.uploader
+from cloudinary_storage.storage import MediaCloudinaryStorage
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from django.core.files.uploadedfile import UploadedFile
+from django.db import IntegrityError, transaction
+from django.utils.deconstruct import deconstructible
+
+from . import metrics
+
+
+# ファイル名に使うハッシュの長さ（16進で 32文字 = 128bit）
+HASH_LENGTH = 32
+
+
+def file_digest(content) -> str:
+    """ファイルの SHA-256。大きなファイルでもメモリに載せずにチャンクごとに読む。"""
+    digest = hashlib.sha256()
+    if hasattr(content, 'seek'):
+        content.seek(0)
+    for chunk in content.chunks() if hasattr(content, 'chunks') else File(content).chunks():
+        digest.update(chunk)
+    if hasattr(content, 'seek'):
+        content.seek(0)
+    return digest.hexdigest()
+
+
+def hashed_name(name: str, digest: str) -> str:
+    """product_image/cap.png -> product_image/3f2a...c1.png"""
+    directory, filename = posixpath.split(name)
+    ext = posixpath.splitext(filename)[1].lower()
+    return posixpath.join(directory, f'{digest[:HASH_LENGTH]}{ext}')
+
+
+class ContentAddressedStorageMixin:
+    """
+    ファイルを内容のハッシュで名付けて保存するストレージの mixin。
+    - 同じ内容のファイルは1つしか保存しない（名前が違っても同じファイルを指す）
+    - 保存済みの内容は StoredFile の台帳で分かるので、再アップロード時にストレージへの
+      書き込みも存在確認も行わない（ディスク I/O やネットワーク通信が発生しない）
+    - 派生画像のように名前を自分で決めたいファイルは save_as() で保存する
+    """
+
+    def save(self, name, content, max_length=None):
+        from .models import StoredFile
+
+        if name is None:
+            name = content.name
+        if not hasattr(content, 'chunks'):
+            content = File(content, name)
+
+        digest = file_digest(content)
+        known = StoredFile.objects.filter(digest=digest).values_list('name', flat=True).first()
+        if known:
+            return known
+
+        target = hashed_name(name, digest)
+        # 台帳に無くても、同じ内容がすでに置かれていればそれを使う
+        with metrics.span('storage'):
+            stored = target if self.exists(target) else super().save(target, content, max_length=max_length)
+        try:
+            with transaction.atomic():
+                StoredFile.objects.create(digest=digest, name=stored, size=content.size)
+        except IntegrityError:
+            # 同じ内容が同時に保存された
+            return StoredFile.objects.get(digest=digest).name
+        return stored
+
+    def save_as(self, name, content):
+        """name のまま保存する（既にあれば置き換える）。台帳には載せない。"""
+        with metrics.span('storage'):
+            if self.exists(name):
+                self.delete(name)
+            return super().save(name, content)
+
+
+@deconstructible
+class ContentAddressedFileSystemStorage(ContentAddressedStorageMixin, FileSystemStorage):
+    pass
+
+
+@deconstructible
+class ContentAddressedCloudinaryStorage(ContentAddressedStorageMixin, MediaCloudinaryStorage):
+    """
+    Cloudinary 版。public_id をこちらで決めてアップロードする（Cloudinary にランダムな接尾辞を付けさせない）。
+    - 保存名（ImageField に入る名前）は、初めてのアップロードでも台帳から返すときでも、拡張子付きの
+      ハッシュ名（product_image/3f2a...c1.png）で揃える
+    - public_id には拡張子を _png のように含める。同じ画像から作る .webp と .jpg の派生画像が
+      同じ public_id になって、片方がもう片方を上書きしないようにするため
+    - 拡張子の無い名前（以前の MediaCloudinaryStorage が返した public_id）は、そのまま public_id として扱う
+    """
+
+    def _public_id(self, name):
+        """保存名から (public_id, 配信形式) を求める。"""
+        name = self._prepend_prefix(self._normalise_name(name))
+        stem, ext = posixpath.splitext(name)
+        if not ext:
+            return name, None
+        ext = ext[1:].lower()
+        return f'{stem}_{ext}', ext
+
+    def _upload(self, name, content):
+        public_id, _ = self._public_id(name)
+        return cloudinary.uploader.upload(
+            content, public_id=public_id, unique_filename=False, overwrite=True,
+            resource_type=self._get_resource_type(name), tags=self.TAG,
+        )
+
+    def _save(self, name, content):
+        name = self._normalise_name(name)
+        self._upload(name, UploadedFile(content, name))
+        return name
+
+    def _get_url(self, name):
+        public_id, ext = self._public_id(name)
+        resource = cloudinary.CloudinaryResource(
+            public_id, format=ext, default_resource_type=self._get_resource_type(name)
+        )
+        return resource.url
+
+    def delete(self, name):
+        public_id, _ = self._public_id(name)
+        response = cloudinary.uploader.destroy(public_id, invalidate=True, resource_type=self._get_resource_type(name))
+        return response['result'] == 'ok'
+
+
+def save_as(storage, name: str, content) -> str:
+    """name のまま保存する。content-addressed でないストレージでは、既存のファイルを消してから保存する。"""
+    if hasattr(storage, 'save_as'):
+        return storage.save_as(name, content)
+    if storage.exists(name):
+        storage.delete(name)
+    return storage.save(name, content)
+
+
+def known_derivative_widths(name: str) -> Optional[List[int]]:
+    """台帳にある画像なら、作成済みの派生画像の幅を返す（無ければ None）。"""
+    from .models import StoredFile
+    return StoredFile.objects.filter(name=name).values_list('derivative_widths', flat=True).first()
+
+
+def remember_derivative_widths(name: str, widths: List[int]):
+    from .models import StoredFile
+    StoredFile.objects.filter(name=name).update(derivative_widths=widths)
+
+
+def collapse_duplicates(storage, names: Iterable[str], delete: bool = True) -> Dict[str, str]:
+    """
+    names のファイルを内容で束ね、同じ内容のファイルを1つにまとめる（manage.py dedupe_media）。
+    - 残すのは名前が一番短いもの（cap.png と cap_8eS7fjs.png なら cap.png）
+    - 商品の画像は残したファイルに付け替え、残りのファイルは delete=True なら削除する
+    - 残したファイルは台帳（StoredFile）に登録し、以降の同じ内容のアップロードはそれを返す
+    戻り値は {消した名前: 残した名前}。
+    """
+    from .models import Product, StoredFile
+
+    by_digest: Dict[str, List[str]] = {}
+    sizes = {}
+    for name in sorted(set(names)):
+        try:
+            with storage.open(name, 'rb') as f:
+                digest = file_digest(File(f, name))
+                sizes[digest] = storage.size(name)
+        except OSError:
+            continue
+        by_digest.setdefault(digest, []).append(name)
+
+    replaced = {}
+    for digest, group in by_digest.items():
+        group.sort(key=lambda n: (len(n), n))
+        keep, duplicates = group[0], group[1:]
+        StoredFile.objects.update_or_create(
+            digest=digest, defaults={'name': keep, 'size': sizes.get(digest) or 0},
+        )
+        if not duplicates:
+            continue
+        # 付け替えた商品の派生画像は元の名前から作られているので、作り直しの対象にする
+        Product.objects.filter(image__in=duplicates).update(image=keep, image_widths=[])
+        for name in duplicates:
+            if delete:
+                storage.delete(name)
+            replaced[name] = keep
+    return replaced
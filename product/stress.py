@@ -0,0 +1,239 @@
+"""
+カート・注文の同時実行の負荷試験（manage.py stress_checkout）。
+
+ワーカー（スレッドまたはプロセス）ごとにテストクライアントとセッションを持ち、
+カート追加 → 数量を減らす → カート表示 → 注文確定 を、設定されている DB に対して繰り返す。
+ミドルウェアも含めて実際のビューを通すので、本番と同じ SQL・トランザクションで競合が起きる。
+
+終わったら次を確かめる。
+- 注文の合計金額が、その注文の明細の合計と一致する
+- 注文を確定したカートに明細が残っていない
+- 在庫を管理している商品は「減った在庫 = 売れた数」になっている
+"""
+import logging
+import random
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Dict, List, Optional, Sequence
+
+import django
+import numpy as np
+from django.conf import settings
+from django.db import connection, connections
+from django.db.models import DecimalField, F, Sum, Value
+from django.db.models.functions import Coalesce
+from django.test import Client
+from django.urls import reverse
+
+from .models import CartItem, Order, OrderItem, Product
+
+
+ORDER_DATA = {
+    'last_name': '負荷', 'first_name': '試験', 'username': 'stress', 'email': '',
+    'address': '東京都', 'card_name': 'STRESS TEST', 'card_number': '4242424242424242', 'card_expiry': '12/30',
+}
+
+ERROR_KINDS = ('deadlock', 'serialization', 'locked', 'other')
+
+
+def classify_error(exc: BaseException) -> str:
+    """DB のエラーを種類に分ける（PostgreSQL は SQLSTATE、SQLite はメッセージで判定する）。"""
+    cause = exc.__cause__ or exc
+    code = getattr(cause, 'sqlstate', None) or getattr(cause, 'pgcode', None)
+    message = str(exc).lower()
+    if code == '40P01' or 'deadlock' in message:
+        return 'deadlock'
+    if code == '40001' or 'could not serialize' in message:
+        return 'serialization'
+    if 'locked' in message:
+        # SQLite: database is locked / database table is locked
+        return 'locked'
+    return 'other'
+
+
+class _ErrorCollector(logging.Handler):
+    """
+    order_create は例外を握りつぶしてメッセージを出すだけなので、
+    views の logger.exception をスレッドごとに拾って原因を分類する。
+    """
+
+    def __init__(self):
+        super().__init__(level=logging.ERROR)
+        self.errors: Dict[int, List[BaseException]] = defaultdict(list)
+
+    def emit(self, record):
+        if record.exc_info and record.exc_info[1] is not None:
+            self.errors[record.thread].append(record.exc_info[1])
+
+    def pop(self) -> List[BaseException]:
+        return self.errors.pop(threading.get_ident(), [])
+
+
+_collector = _ErrorCollector()
+_collector_lock = threading.Lock()
+
+
+def _install_collector():
+    views_logger = logging.getLogger('product.views')
+    with _collector_lock:
+        if _collector not in views_logger.handlers:
+            views_logger.addHandler(_collector)
+
+
+def request_host() -> str:
+    """ALLOWED_HOSTS に通るホスト名（テストクライアント・ハンドラーに直接渡すリクエスト用）。"""
+    hosts = [host.lstrip('.') for host in settings.ALLOWED_HOSTS if host != '*']
+    return hosts[0] if hosts else 'testserver'
+
+
+def run_worker(worker_id: int, product_ids: Sequence[int], iterations: int, lines: int, seed: int) -> dict:
+    """
+    1ワーカー分の負荷をかける。プロセスをまたいで返せるよう、結果は dict にする。
+    1回の繰り返し: lines 行をカートに追加 → 3回に1回は1行の数量を減らす → カート表示 → 注文確定
+    """
+    _install_collector()
+    rng = random.Random(seed + worker_id)
+    client = Client(HTTP_HOST=request_host())
+    latencies: Dict[str, List[float]] = defaultdict(list)
+    errors = Counter()
+    checkouts = rejected = 0
+    checked_out_carts: List[int] = []
+
+    def call(name, method, url, data=None):
+        started = time.perf_counter()
+        try:
+            response = getattr(client, method)(url, data or {})
+        except Exception as e:
+            errors[classify_error(e)] += 1
+            response = None
+        latencies[name].append(time.perf_counter() - started)
+        for exc in _collector.pop():
+            errors[classify_error(exc)] += 1
+        return response
+
+    started = time.perf_counter()
+    try:
+        for _ in range(iterations):
+            chosen = rng.sample(list(product_ids), min(lines, len(product_ids)))
+            for pk in chosen:
+                call('add_to_cart', 'post', reverse('product:add_to_cart', args=[pk]),
+                     {'quantity': rng.randint(1, 2), 'next': 'cart_detail'})
+            if rng.random() < 1 / 3:
+                call('decrease_cart', 'post', reverse('product:decrease_cart', args=[chosen[0]]))
+            call('cart_detail', 'get', reverse('product:cart_detail'))
+
+            cart_id = client.session.get('cart_id')
+            key = uuid.uuid4().hex
+            errors_before = sum(errors.values())
+            call('order_create', 'post', reverse('product:order_create'),
+                 {**ORDER_DATA, 'username': f'stress-{worker_id}', 'idempotency_key': key})
+            if Order.objects.filter(idempotency_key=key).exists():
+                checkouts += 1
+                if cart_id:
+                    checked_out_carts.append(cart_id)
+            elif sum(errors.values()) == errors_before:
+                # 例外は起きていない（在庫切れ・カートが空など）
+                rejected += 1
+    finally:
+        connection.close()
+
+    return {
+        'latencies': dict(latencies),
+        'errors': dict(errors),
+        'checkouts': checkouts,
+        'rejected': rejected,
+        'checked_out_carts': checked_out_carts,
+        'elapsed': time.perf_counter() - started,
+    }
+
+
+def latency_percentiles(values: List[float]) -> Dict[str, float]:
+    """秒のリストから、件数と p50 / p95 / p99（ミリ秒）を求める。"""
+    p50, p95, p99 = np.percentile(values, [50, 95, 99]) * 1000
+    return {'count': len(values), 'p50_ms': round(p50, 2), 'p95_ms': round(p95, 2), 'p99_ms': round(p99, 2)}
+
+
+def check_invariants(start_order_id: int, stock_before: Dict[int, int], carts: Sequence[int]) -> List[str]:
+    """負荷試験で作られた注文（start_order_id より後）について不変条件を確かめ、破れていたものを返す。"""
+    problems = []
+    item_total = Coalesce(
+        Sum(F('items__product_price') * F('items__quantity')), Value(0),
+        output_field=DecimalField(max_digits=14, decimal_places=2),
+    )
+    mismatched = Order.objects.filter(pk__gt=start_order_id).annotate(item_total=item_total).exclude(
+        total_price=F('item_total')
+    ).values_list('pk', 'total_price', 'item_total')
+    for pk, total, items in mismatched:
+        problems.append(f'注文 {pk}: 合計金額 {total} が明細の合計 {items} と一致しません')
+
+    leaked = CartItem.objects.filter(cart_id__in=list(carts)).count()
+    if leaked:
+        problems.append(f'注文を確定したカートに明細が {leaked} 行残っています')
+
+    sold = dict(
+        OrderItem.objects.filter(order_id__gt=start_order_id, product_id__in=list(stock_before))
+        .values('product_id').annotate(total=Sum('quantity')).values_list('product_id', 'total')
+    )
+    for pk, after in Product.objects.filter(pk__in=list(stock_before)).values_list('pk', 'stock'):
+        if after is None or after < 0 or stock_before[pk] - after != sold.get(pk, 0):
+            problems.append(
+                f'商品 {pk}: 在庫 {stock_before[pk]} -> {after} に対して売れた数が {sold.get(pk, 0)} です'
+            )
+    return problems
+
+
+def run_stress(workers: int, iterations: int, lines: int = 3, products: int = 10, mode: str = 'thread',
+               seed: int = 0, stock: Optional[int] = None) -> dict:
+    """
+    workers 個のワーカーで負荷をかけ、スループット・レイテンシの分布・エラーの内訳・不変条件の結果を返す。
+    products 個の商品（新しい順）だけを使う。少ないほど同じ行の取り合いが増える。
+    stock を指定すると、開始前にそれらの商品の在庫をその数にする（在庫切れの競合を起こす）。
+    """
+    product_ids = list(Product.objects.order_by('-pk').values_list('pk', flat=True)[:products])
+    if not product_ids:
+        raise ValueError('商品がありません。先に seed_products か generate_load_data を実行してください。')
+    if stock is not None:
+        Product.objects.filter(pk__in=product_ids).update(stock=stock)
+    stock_before = dict(
+        Product.objects.filter(pk__in=product_ids, stock__isnull=False).values_list('pk', 'stock')
+    )
+    start_order_id = Order.objects.order_by('-pk').values_list('pk', flat=True).first() or 0
+
+    args = [(worker_id, product_ids, iterations, lines, seed) for worker_id in range(workers)]
+    started = time.perf_counter()
+    if mode == 'process':
+        # 子プロセスに DB 接続を引き継がせない
+        connections.close_all()
+        with ProcessPoolExecutor(max_workers=workers, initializer=django.setup) as executor:
+            results = list(executor.map(run_worker, *zip(*args)))
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(run_worker, *zip(*args)))
+    elapsed = time.perf_counter() - started
+
+    latencies = defaultdict(list)
+    errors = Counter()
+    for result in results:
+        for name, values in result['latencies'].items():
+            latencies[name].extend(values)
+        errors.update(result['errors'])
+    checkouts = sum(result['checkouts'] for result in results)
+    requests = sum(len(values) for values in latencies.values())
+    carts = [cart_id for result in results for cart_id in result['checked_out_carts']]
+
+    return {
+        'workers': workers,
+        'mode': mode,
+        'elapsed_s': round(elapsed, 3),
+        'requests': requests,
+        'requests_per_s': round(requests / elapsed, 1),
+        'checkouts': checkouts,
+        'checkouts_per_s': round(checkouts / elapsed, 1),
+        'rejected': sum(result['rejected'] for result in results),
+        'errors': {kind: errors.get(kind, 0) for kind in ERROR_KINDS},
+        'latency': {name: latency_percentiles(values) for name, values in sorted(latencies.items())},
+        'problems': check_invariants(start_order_id, stock_before, carts),
+    }
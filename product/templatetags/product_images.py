@@ -0,0 +1,42 @@
+from django import template
+from django.templatetags.static import static
+from django.utils.html import format_html
+
+from product import images
+
+
+register = template.Library()
+
+# 商品一覧のグリッド（row-cols-2 / md-3 / xl-4）で1枚が表示される幅
+CARD_SIZES = '(min-width: 1200px) 300px, (min-width: 768px) 33vw, 50vw'
+
+
+@register.simple_tag
+def product_picture(product, sizes=CARD_SIZES, css_class='card-img-top', loading='lazy', style=''):
+    """
+    商品画像の <picture> を出力する。派生画像があれば WebP と JPEG の srcset を付け、
+    ブラウザが表示幅に合った大きさを選べるようにする。無ければ元画像をそのまま使う。
+        {% product_picture product %}
+        {% product_picture product sizes="(min-width: 768px) 50vw, 100vw" loading="eager" %}
+    """
+    if not product.image:
+        return format_html('<img class="{}" src="{}" alt="NO IMAGE" style="{}">',
+                           css_class, static('product/images/no_image.jpg'), style)
+
+    widths = product.image_widths
+    if not widths:
+        return format_html(
+            '<img class="{}" src="{}" alt="{}" loading="{}" decoding="async" style="{}">',
+            css_class, product.image.url, product.name, loading, style,
+        )
+
+    name = product.image.name
+    fallback = images.storage_url(images.derivative_name(name, widths[-1], 'jpg'))
+    return format_html(
+        '<picture>'
+        '<source type="image/webp" srcset="{}" sizes="{}">'
+        '<img class="{}" src="{}" srcset="{}" sizes="{}" alt="{}" loading="{}" decoding="async" style="{}">'
+        '</picture>',
+        images.srcset(name, widths, 'webp'), sizes,
+        css_class, fallback, images.srcset(name, widths, 'jpg'), sizes, product.name, loading, style,
+    )
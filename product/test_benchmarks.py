@@ -0,0 +1,211 @@
+"""
+ビューごとのクエリ数・処理時間のベンチマーク。
+
+データ量（scale）を変えて product/urls.py のすべての URL をテストクライアントで叩き、
+- クエリ数が予算（QUERY_BUDGETS）を超えていないか
+- データ量を増やしてもクエリ数が変わらないか（N+1 が入り込んでいないか）
+を確かめる。処理時間とテンプレートの描画時間は記録するだけで、失敗にはしない。
+
+環境変数 BENCHMARK_REPORT にパスを指定すると、結果を JSON で書き出す（コミット間で diff できる）。
+    BENCHMARK_REPORT=bench.json python manage.py test product.test_benchmarks
+"""
+import json
+import os
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from datetime import datetime
+from unittest import mock
+
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.template.base import Template
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from . import recommendations, rollups, urls
+from .loadgen import LoadDataGenerator
+from .models import Order, Product
+
+
+AUTH = {'HTTP_AUTHORIZATION': 'Basic YWRtaW46cHc='}
+
+# 比べるデータ量。商品 10×scale 件、注文 20×scale 件、カートは scale 行
+SCALES = (1, 8)
+
+# URL 名ごとのクエリ数の上限（どの scale でも）。SAVEPOINT / RELEASE も1件と数える。
+# 増やすときは理由をコミットに書くこと
+QUERY_BUDGETS = {
+    'product_list': 2,
+    'product_search': 3,
+    'product_autocomplete': 1,
+    'product_detail': 3,
+    'manage_list': 1,
+    'product_create': 0,
+    'product_update': 1,
+    'product_delete': 1,
+    'cart_detail': 4,
+    'add_to_cart': 11,
+    'delete_from_cart': 9,
+    'decrease_cart': 7,
+    'order_create': 11,
+    'order_list': 4,
+    'order_export': 1,
+    'sales_dashboard': 4,
+    'metrics': 0,
+    'profile_list': 1,
+    'profile_download': 0,
+}
+
+
+@dataclass
+class Measurement:
+    name: str
+    scale: int
+    method: str
+    status: int
+    queries: int
+    wall_ms: float
+    render_ms: float
+
+
+class RenderTimer:
+    """Template.render の時間を、一番外側の呼び出しだけ合計する（include の分を二重に数えない）。"""
+
+    def __init__(self):
+        self.seconds = 0.0
+        self._depth = 0
+        self._render = Template.render
+
+    def __call__(self, template, context):
+        self._depth += 1
+        started = time.perf_counter()
+        try:
+            return self._render(template, context)
+        finally:
+            self._depth -= 1
+            if self._depth == 0:
+                self.seconds += time.perf_counter() - started
+
+
+class ViewBenchmarkTests(TestCase):
+    results = []
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        path = os.environ.get('BENCHMARK_REPORT')
+        if path and cls.results:
+            report = {
+                'generated_at': timezone.now().isoformat(),
+                'vendor': connection.vendor,
+                'budgets': QUERY_BUDGETS,
+                'results': sorted((asdict(m) for m in cls.results), key=lambda m: (m['name'], m['scale'])),
+            }
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(report, f, ensure_ascii=False, indent=2, sort_keys=True)
+
+    @contextmanager
+    def dataset(self, scale):
+        """scale に応じたデータを作り、終わったらロールバックする。"""
+        with transaction.atomic():
+            cache.clear()
+            generator = LoadDataGenerator(seed=scale, batch_size=500, end=timezone.make_aware(datetime(2026, 1, 1)))
+            generator.create_products(10 * scale)
+            # 在庫を管理している商品として測る（仮押さえの集計と在庫の減算の分も含める）
+            Product.objects.update(stock=1000)
+            generator.create_orders(20 * scale, days=7)
+            rollups.rebuild_rollups(lag_seconds=0)
+            recommendations.rebuild_recommendations(lag_seconds=0)
+            self.client = self.client_class()
+            yield list(Product.objects.order_by('pk').values_list('pk', flat=True))
+            transaction.set_rollback(True)
+
+    def fill_cart(self, product_ids, lines):
+        for pk in product_ids[:lines]:
+            self.client.post(reverse('product:add_to_cart', args=[pk]), {'quantity': 2})
+
+    def measure(self, name, scale, method, url, data=None, **extra):
+        timer = RenderTimer()
+        with mock.patch.object(Template, 'render', lambda template, context: timer(template, context)), \
+                CaptureQueriesContext(connection) as queries:
+            started = time.perf_counter()
+            response = getattr(self.client, method)(url, data or {}, **extra)
+            if hasattr(response, 'streaming_content'):
+                b''.join(response.streaming_content)
+            wall = time.perf_counter() - started
+        measurement = Measurement(
+            name=name, scale=scale, method=method.upper(), status=response.status_code,
+            queries=len(queries), wall_ms=round(wall * 1000, 2), render_ms=round(timer.seconds * 1000, 2),
+        )
+        self.results.append(measurement)
+        self.assertLess(response.status_code, 400, f'{name} (scale={scale}) が {response.status_code} を返した')
+        return measurement
+
+    def scenario(self, name, scale, products):
+        """URL 名ごとのリクエスト。カート・注文系は scale 行のカートを用意してから叩く。"""
+        pk = products[len(products) // 2]
+        if name == 'product_list':
+            return self.measure(name, scale, 'get', reverse('product:product_list'), {'sort': 'price'})
+        if name == 'product_search':
+            return self.measure(name, scale, 'get', reverse('product:product_search'), {'q': 'シャツ'})
+        if name == 'product_autocomplete':
+            return self.measure(name, scale, 'get', reverse('product:product_autocomplete'), {'q': '定番'})
+        if name == 'product_detail':
+            return self.measure(name, scale, 'get', reverse('product:product_detail', args=[pk]))
+        if name == 'manage_list':
+            return self.measure(name, scale, 'get', reverse('product:manage_list'), **AUTH)
+        if name == 'product_create':
+            return self.measure(name, scale, 'get', reverse('product:product_create'), **AUTH)
+        if name == 'product_update':
+            return self.measure(name, scale, 'get', reverse('product:product_update', args=[pk]), **AUTH)
+        if name == 'product_delete':
+            return self.measure(name, scale, 'get', reverse('product:product_delete', args=[pk]), **AUTH)
+
+        self.fill_cart(products, scale)
+        if name == 'cart_detail':
+            return self.measure(name, scale, 'get', reverse('product:cart_detail'))
+        if name == 'add_to_cart':
+            return self.measure(name, scale, 'post', reverse('product:add_to_cart', args=[products[-1]]), {'quantity': 1})
+        if name == 'delete_from_cart':
+            return self.measure(name, scale, 'post', reverse('product:delete_from_cart', args=[products[0]]))
+        if name == 'decrease_cart':
+            return self.measure(name, scale, 'post', reverse('product:decrease_cart', args=[products[0]]))
+        if name == 'order_create':
+            data = {'last_name': '山田', 'first_name': '太郎', 'username': 'yamada', 'email': '',
+                    'address': '東京都', 'card_name': 'TARO', 'card_number': '4242424242424242',
+                    'card_expiry': '12/30'}
+            measurement = self.measure(name, scale, 'post', reverse('product:order_create'), data)
+            self.assertEqual(Order.objects.latest('pk').items.count(), scale)
+            return measurement
+        if name == 'order_list':
+            return self.measure(name, scale, 'get', reverse('product:order_list'), **AUTH)
+        if name == 'order_export':
+            return self.measure(name, scale, 'get', reverse('product:order_export'), **AUTH)
+        if name == 'sales_dashboard':
+            return self.measure(name, scale, 'get', reverse('product:sales_dashboard'), {'days': 366}, **AUTH)
+        if name == 'metrics':
+            return self.measure(name, scale, 'get', reverse('product:metrics'), **AUTH)
+        if name == 'profile_list':
+            return self.measure(name, scale, 'get', reverse('product:profile_list'), **AUTH)
+        if name == 'profile_download':
+            response = self.client.get(reverse('product:product_list'), HTTP_X_PROFILE='cprofile', **AUTH)
+            url = reverse('product:profile_download', args=[response['X-Profile-Id']])
+            return self.measure(name, scale, 'get', url, **AUTH)
+        self.fail(f'{name} のシナリオがありません')
+
+    def test_every_url_has_a_budget(self):
+        names = {pattern.name for pattern in urls.urlpatterns}
+        self.assertEqual(names, set(QUERY_BUDGETS), 'URL を追加・削除したら QUERY_BUDGETS も更新すること')
+
+    def test_query_budgets_and_scale_invariance(self):
+        for name, budget in QUERY_BUDGETS.items():
+            with self.subTest(name):
+                counts = []
+                for scale in SCALES:
+                    with self.dataset(scale) as products:
+                        counts.append(self.scenario(name, scale, products).queries)
+                self.assertLessEqual(max(counts), budget, f'{name}: クエリ数 {counts} が予算 {budget} を超えた')
+                self.assertEqual(len(set(counts)), 1, f'{name}: データ量でクエリ数が変わる {dict(zip(SCALES, counts))}')
@@ -1,3 +1,1243 @@
-from django.test import TestCase
+import csv
+import gzip
+import importlib
+import io
+import json
+import logging
+import os
+import pstats
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from datetime import timedelta
+from pathlib import Path
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.sessions.models import Session
+from django.core import mail
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db import OperationalError, connection, transaction
+from django.db.models import Sum
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.http import HttpResponse
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image
+
+from .models import (Product, Cart, CartItem, Order, OrderItem, EmailOutbox,
+                     SalesHourly, ProductSalesDaily, ProductCooccurrence, ProductRecommendation,
+                     ProductSearchDocument)
+from . import export, images, inventory, metrics, outbox, profiling, recommendations, rollups, search, stress
+from .autocomplete import PrefixIndex
+from .cart import DatabaseCartStorage
+from .pagination import KeysetPaginator, encode_cursor
+from .storage import ContentAddressedCloudinaryStorage, ContentAddressedFileSystemStorage
+from .views import ProductListView
+
+
+@override_settings(PRODUCT_LIST_PAGE_SIZE=3)
+class ProductListPaginationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        for i in range(8):
+            Product.objects.create(name=f'商品{i}', price=1000 - i * 100)
+
+    def _walk(self, sort):
+        url = reverse('product:product_list')
+        params = {'sort': sort}
+        seen = []
+        while True:
+            response = self.client.get(url, params)
+            page = response.context['page_obj']
+            seen.extend(p.pk for p in page)
+            if not page.has_next:
+                return seen, page
+            params = {'sort': sort, 'after': page.next_cursor}
+
+    def test_walks_every_product_once_in_pk_order(self):
+        seen, _ = self._walk('new')
+        self.assertEqual(seen, list(Product.objects.order_by('pk').values_list('pk', flat=True)))
+
+    def test_price_ordering_and_previous_cursor(self):
+        seen, last_page = self._walk('price')
+        self.assertEqual(seen, list(Product.objects.order_by('price', 'pk').values_list('pk', flat=True)))
+
+        response = self.client.get(reverse('product:product_list'),
+                                   {'sort': 'price', 'before': last_page.previous_cursor})
+        self.assertEqual([p.pk for p in response.context['page_obj']], seen[3:6])
+
+    @skipUnless(connection.vendor == 'sqlite', 'EXPLAIN QUERY PLAN は SQLite のみ')
+    def test_deep_price_pages_seek_the_index(self):
+        paginator = KeysetPaginator(Product.objects.all(), per_page=3, ordering=ProductListView.orderings['price'])
+        for after, before in ((encode_cursor([500, 5]), None), (None, encode_cursor([500, 5]))):
+            queryset, _ = paginator._page_queryset(after, before)
+            sql, params = queryset.query.sql_with_params()
+            with connection.cursor() as cursor:
+                cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+                plan = ' '.join(row[-1] for row in cursor.fetchall())
+            self.assertIn('SEARCH product_product USING INDEX product_price_id_idx', plan)
+            self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_invalid_cursor_falls_back_to_first_page(self):
+        # 壊れた文字列と、[null] / [null, null] を JSON に詰めたもの
+        for cursor in ('!!broken!!', 'WyBudWxsXQ', 'W251bGwsbnVsbF0'):
+            for sort in ('new', 'price'):
+                with self.subTest(cursor=cursor, sort=sort):
+                    response = self.client.get(reverse('product:product_list'), {'after': cursor, 'sort': sort})
+                    self.assertEqual(response.status_code, 200)
+                    self.assertEqual(len(response.context['page_obj']), 3)
+
+
+class ProductSearchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.denim = Product.objects.create(name='デニムパンツ', price=5000, description='定番のストレートデニム。')
+        cls.shoes = Product.objects.create(name='靴', price=10000, description='NIKEの靴')
+        cls.tote = Product.objects.create(name='トートバッグ', price=2000)
+        search.rebuild_index()
+
+    def _search(self, text):
+        return [p.pk for p in search.search_products(text)]
+
+    def test_tokenize_uses_bigrams_for_japanese(self):
+        self.assertEqual(search.tokenize('デニムパンツ NIKE'), ['デニ', 'ニム', 'ムパ', 'パン', 'ンツ', 'nike'])
+
+    def test_japanese_substring_and_prefix(self):
+        self.assertEqual(self._search('ムパン'), [self.denim.pk])
+        self.assertEqual(self._search('バ'), [self.tote.pk])
+        self.assertEqual(self._search('ｎｉｋ'), [self.shoes.pk])
+        self.assertEqual(self._search('パンダ'), [])
+
+    def test_normalized_name_and_like_escaping(self):
+        Product.objects.create(name='ＮＩＫＥ　ｴｱ 100%', price=1)
+        self.assertEqual(ProductSearchDocument.objects.get(product__name='ＮＩＫＥ　ｴｱ 100%').name, 'nike エア 100%')
+        self.assertEqual(search.escape_like('100%_\\'), '100\\%\\_\\\\')
+
+    def test_index_follows_admin_and_model_writes(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'pw'))
+        self.client.post(reverse('admin:product_product_change', args=[self.denim.pk]),
+                         {'name': 'ジーンズ', 'price': 5000, 'description': ''})
+        self.assertEqual(self._search('ジーン'), [self.denim.pk])
+        self.assertEqual(self._search('デニム'), [])
+
+        shoes_pk = self.shoes.pk
+        self.shoes.delete()
+        self.assertEqual(self._search('nike'), [])
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT COUNT(*) FROM {search.FTS_TABLE} WHERE rowid = %s', [shoes_pk])
+            self.assertEqual(cursor.fetchone()[0], 0)
+
+    def test_index_follows_manage_views(self):
+        auth = {'HTTP_AUTHORIZATION': 'Basic YWRtaW46cHc='}
+        self.client.post(reverse('product:product_update', args=[self.tote.pk]),
+                         {'name': 'エコバッグ', 'price': 1500}, **auth)
+        self.assertEqual(self._search('エコ'), [self.tote.pk])
+        self.assertEqual(self._search('トート'), [])
+
+        self.client.post(reverse('product:product_delete', args=[self.tote.pk]), **auth)
+        self.assertEqual(self._search('エコ'), [])
+
+    def test_search_view(self):
+        response = self.client.get(reverse('product:product_search'), {'q': 'デニム'})
+        self.assertContains(response, 'デニムパンツ')
+
+
+class AutocompleteTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.denim = Product.objects.create(name='デニム パンツ', price=5000)
+        self.tshirt = Product.objects.create(name='Tシャツ', price=1500)
+
+    def test_prefix_index_matches_name_and_word_starts(self):
+        index = PrefixIndex([(1, 'デニム パンツ'), (2, 'Tシャツ'), (3, 'デニムジャケット')])
+        self.assertEqual([pk for pk, _ in index.lookup('デニム')], [1, 3])
+        self.assertEqual(index.lookup('パン'), [(1, 'デニム パンツ')])
+        self.assertEqual(index.lookup('ｔシ'), [(2, 'Tシャツ')])
+        self.assertEqual(index.lookup(''), [])
+
+    def test_endpoint_answers_without_sql_and_follows_catalog_version(self):
+        url = reverse('product:product_autocomplete')
+        self.client.get(url, {'q': 'デ'})
+        with self.assertNumQueries(0):
+            response = self.client.get(url, {'q': 'デ'})
+        self.assertEqual([r['id'] for r in response.json()['results']], [self.denim.pk])
+
+        self.client.post(reverse('product:product_create'), {'name': 'デッキシューズ', 'price': 3000},
+                         HTTP_AUTHORIZATION='Basic YWRtaW46cHc=')
+        response = self.client.get(url, {'q': 'デ'})
+        self.assertEqual({r['name'] for r in response.json()['results']}, {'デニム パンツ', 'デッキシューズ'})
+
+
+class ProductCardCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.product = Product.objects.create(name='キャップ', price=4000)
+
+    def test_card_is_rerendered_after_save(self):
+        url = reverse('product:product_list')
+        self.assertContains(self.client.get(url), '¥4,000')
+
+        self.product.price = 3500
+        self.product.save()
+        response = self.client.get(url)
+        self.assertContains(response, '¥3,500')
+        self.assertNotContains(response, '¥4,000')
+
+    def test_detail_page_is_rerendered_after_save(self):
+        url = reverse('product:product_detail', args=[self.product.pk])
+        self.assertContains(self.client.get(url), 'キャップ')
+
+        self.product.name = 'ニット帽'
+        self.product.save()
+        self.assertNotContains(self.client.get(url), '>キャップ<')
+        self.assertContains(self.client.get(url), 'ニット帽')
+
+
+class CartCountTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.cap = Product.objects.create(name='キャップ', price=4000)
+        cls.tote = Product.objects.create(name='トートバッグ', price=2000)
+
+    def _badge(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('product:product_list'))
+        self.assertFalse([q for q in queries.captured_queries if 'product_cartitem' in q['sql']])
+        return response.context['cart_count']
+
+    def test_badge_is_maintained_without_cart_queries(self):
+        self.client.post(reverse('product:add_to_cart', args=[self.cap.pk]), {'quantity': 2})
+        self.client.post(reverse('product:add_to_cart', args=[self.tote.pk]))
+        self.assertEqual(self._badge(), 3)
+
+        self.client.post(reverse('product:decrease_cart', args=[self.cap.pk]))
+        self.assertEqual(self._badge(), 2)
+
+        self.client.post(reverse('product:delete_from_cart', args=[self.tote.pk]))
+        self.assertEqual(self._badge(), 1)
+
+    def test_drifted_count_is_repaired_by_cart_page(self):
+        self.client.post(reverse('product:add_to_cart', args=[self.cap.pk]))
+        CartItem.objects.update(quantity=5)
+
+        self.client.get(reverse('product:cart_detail'))
+        self.assertEqual(self._badge(), 5)
+
+
+ORDER_POST = {
+    'last_name': '山田', 'first_name': '太郎', 'username': 'taro', 'email': 'taro@example.com',
+    'address': '東京都', 'card_name': 'TARO YAMADA', 'card_number': '4242424242424242', 'card_expiry': '12/30',
+}
+
+
+@override_settings(CART_STORAGE='product.cart.SessionCartStorage',
+                   SESSION_ENGINE='django.contrib.sessions.backends.signed_cookies')
+class SessionCartStorageTests(TransactionTestCase):
+    # 注文確定後のセッション更新は on_commit で行うので、実際にコミットさせて確認する
+    def setUp(self):
+        self.cap = Product.objects.create(name='キャップ', price=4000)
+        self.tote = Product.objects.create(name='トートバッグ', price=2000)
+
+    def _writes(self, queries):
+        return [q['sql'] for q in queries.captured_queries
+                if q['sql'].split()[0].upper() in ('INSERT', 'UPDATE', 'DELETE')]
+
+    def test_browsing_and_cart_edits_do_not_write(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.client.post(reverse('product:add_to_cart', args=[self.cap.pk]), {'quantity': 2})
+            self.client.post(reverse('product:add_to_cart', args=[self.tote.pk]))
+            self.client.post(reverse('product:decrease_cart', args=[self.cap.pk]))
+            response = self.client.get(reverse('product:cart_detail'))
+        self.assertEqual(self._writes(queries), [])
+        self.assertEqual(response.context['cart_count'], 2)
+        self.assertEqual(response.context['total_price'], 6000)
+        self.assertFalse(Cart.objects.exists())
+
+    def test_checkout_materializes_cart_once(self):
+        self.client.post(reverse('product:add_to_cart', args=[self.cap.pk]), {'quantity': 2})
+        self.client.post(reverse('product:order_create'), ORDER_POST)
+
+        order = Order.objects.get()
+        self.assertEqual(order.total_price, 8000)
+        self.assertEqual(order.items.get().quantity, 2)
+        self.assertFalse(Cart.objects.exists())
+        self.assertFalse(CartItem.objects.exists())
+        self.assertEqual(self.client.get(reverse('product:product_list')).context['cart_count'], 0)
+
+
+class CartUpsertTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.cap = Product.objects.create(name='キャップ', price=4000)
+
+    def _add(self, quantity=1):
+        self.client.post(reverse('product:add_to_cart', args=[self.cap.pk]), {'quantity': quantity})
+
+    def test_repeated_adds_merge_into_one_line_with_one_write(self):
+        self._add(2)
+        with CaptureQueriesContext(connection) as queries:
+            self._add(3)
+        writes = [q['sql'] for q in queries.captured_queries
+                  if q['sql'].startswith(('INSERT', 'UPDATE')) and 'django_session' not in q['sql']]
+        self.assertEqual(len(writes), 1)
+        self.assertIn('ON CONFLICT', writes[0])
+        self.assertEqual(list(CartItem.objects.values_list('quantity', flat=True)), [5])
+
+    def test_fallback_without_on_conflict(self):
+        with mock.patch('product.db.supports_upsert', return_value=False):
+            self._add(2)
+            self._add(1)
+        self.assertEqual(list(CartItem.objects.values_list('quantity', flat=True)), [3])
+
+
+class CheckoutQueryCountTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.products = [Product.objects.create(name=f'商品{i}', price=100 * (i + 1)) for i in range(10)]
+
+    def _checkout_queries(self, products):
+        self.client = self.client_class()
+        for product in products:
+            self.client.post(reverse('product:add_to_cart', args=[product.pk]), {'quantity': 2})
+        with CaptureQueriesContext(connection) as queries:
+            self.client.post(reverse('product:order_create'), ORDER_POST)
+        return len(queries)
+
+    def test_query_count_does_not_depend_on_cart_size(self):
+        small = self._checkout_queries(self.products[:1])
+        large = self._checkout_queries(self.products)
+        self.assertEqual(small, large)
+        self.assertLessEqual(large, 12)
+
+        order = Order.objects.latest('pk')
+        self.assertEqual(order.total_price, sum(p.price * 2 for p in self.products))
+        self.assertEqual(order.items.count(), 10)
+        self.assertEqual(
+            sorted(OrderItem.objects.filter(order=order).values_list('product_name', flat=True)),
+            sorted(p.name for p in self.products),
+        )
+        self.assertFalse(CartItem.objects.exists())
+
+
+class EmailOutboxTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.cap = Product.objects.create(name='キャップ', price=4000)
+
+    def _checkout(self):
+        self.client.post(reverse('product:add_to_cart', args=[self.cap.pk]))
+        self.client.post(reverse('product:order_create'), ORDER_POST)
+
+    def test_checkout_queues_mail_and_worker_sends_it(self):
+        self._checkout()
+        self.assertEqual(mail.outbox, [])
+        queued = EmailOutbox.objects.get()
+        self.assertEqual(queued.order, Order.objects.get())
+
+        call_command('send_outbox', stdout=mock.MagicMock())
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ['taro@example.com'])
+        queued.refresh_from_db()
+        self.assertEqual(queued.status, 'sent')
+
+    def test_failures_back_off_and_dead_letter(self):
+        self._checkout()
+        with mock.patch('django.core.mail.EmailMessage.send', side_effect=OSError('smtp down')):
+            call_command('send_outbox', '--max-attempts=2', stdout=mock.MagicMock())
+            queued = EmailOutbox.objects.get()
+            self.assertEqual((queued.status, queued.attempts), ('pending', 1))
+            self.assertIn('smtp down', queued.last_error)
+            self.assertGreater(queued.next_attempt_at, timezone.now())
+
+            EmailOutbox.objects.update(next_attempt_at=timezone.now())
+            call_command('send_outbox', '--max-attempts=2', stdout=mock.MagicMock())
+            queued.refresh_from_db()
+            self.assertEqual((queued.status, queued.attempts), ('dead', 2))
+        self.assertEqual(mail.outbox, [])
+
+    def test_sending_holds_a_lease_not_a_lock(self):
+        self._checkout()
+
+        def send(message):
+            # 送信中のメールは借りられていて、ほかのワーカーには取り出されない
+            self.assertEqual(outbox.claim_pending(10, 60)[0], [])
+            return 1
+
+        with mock.patch('django.core.mail.EmailMessage.send', autospec=True, side_effect=send) as sent:
+            self.assertEqual(outbox.send_pending()['sent'], 1)
+        sent.assert_called_once()
+        self.assertEqual(EmailOutbox.objects.get().status, 'sent')
+
+    def test_expired_lease_is_not_recorded(self):
+        self._checkout()
+
+        def send(message):
+            # 送信に時間がかかり、その間に期限が切れて別のワーカーが借り直した
+            EmailOutbox.objects.update(next_attempt_at=timezone.now())
+            outbox.claim_pending(10, 60)
+            return 1
+
+        with mock.patch('django.core.mail.EmailMessage.send', autospec=True, side_effect=send):
+            outbox.send_pending()
+        queued = EmailOutbox.objects.get()
+        self.assertEqual((queued.status, queued.attempts), ('pending', 0))
+
+
+class IdempotentCheckoutTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.cap = Product.objects.create(name='キャップ', price=4000)
+
+    def test_form_embeds_a_fresh_key(self):
+        self.client.post(reverse('product:add_to_cart', args=[self.cap.pk]))
+        first = self.client.get(reverse('product:cart_detail')).context['form']['idempotency_key'].value()
+        second = self.client.get(reverse('product:cart_detail')).context['form']['idempotency_key'].value()
+        self.assertTrue(first)
+        self.assertNotEqual(first, second)
+
+    def test_replayed_submission_returns_original_result(self):
+        post = dict(ORDER_POST, idempotency_key='key-1')
+        self.client.post(reverse('product:add_to_cart', args=[self.cap.pk]))
+        first = self.client.post(reverse('product:order_create'), post)
+
+        # 再送時にはカートに別の商品が入っていても触らない
+        self.client.post(reverse('product:add_to_cart', args=[self.cap.pk]))
+        with CaptureQueriesContext(connection) as queries:
+            replay = self.client.post(reverse('product:order_create'), post)
+
+        self.assertEqual(replay.url, first.url)
+        self.assertEqual(Order.objects.count(), 1)
+        self.assertEqual(OrderItem.objects.count(), 1)
+        self.assertEqual(CartItem.objects.count(), 1)
+        self.assertFalse([q for q in queries.captured_queries if 'product_cartitem' in q['sql']])
+
+
+@override_settings(ORDER_LIST_PAGE_SIZE=5, ORDER_LIST_COUNT_CAP=8)
+class OrderListViewTests(TestCase):
+    auth = {'HTTP_AUTHORIZATION': 'Basic YWRtaW46cHc='}
+
+    @classmethod
+    def setUpTestData(cls):
+        for i in range(12):
+            order = Order.objects.create(
+                last_name='山田', first_name=str(i), username='u', address='東京都',
+                total_price=1000, status='paid' if i % 2 else 'pending',
+            )
+            OrderItem.objects.bulk_create([
+                OrderItem(order=order, product_name=f'商品{j}', product_price=500, quantity=1) for j in range(2)
+            ])
+
+    def _get(self, params=None):
+        return self.client.get(reverse('product:order_list'), params or {}, **self.auth)
+
+    def test_pages_newest_first_without_n_plus_one(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self._get()
+        self.assertLessEqual(len(queries), 4)
+        pages = [[o.pk for o in response.context['page_obj']]]
+        while response.context['page_obj'].has_next:
+            response = self._get({'after': response.context['page_obj'].next_cursor})
+            pages.append([o.pk for o in response.context['page_obj']])
+        seen = [pk for page in pages for pk in page]
+        self.assertEqual(seen, list(Order.objects.order_by('-created_at', '-id').values_list('pk', flat=True)))
+        self.assertEqual((response.context['order_count'], response.context['order_count_kind']), (8, 'at_least'))
+        self.assertContains(response, '8 件以上')
+        self.assertNotContains(response, '約 8 件')
+
+    def test_status_filter(self):
+        response = self._get({'status': 'paid'})
+        orders = list(response.context['page_obj'])
+        self.assertTrue(orders)
+        self.assertTrue(all(o.status == 'paid' for o in orders))
+        self.assertEqual((response.context['order_count'], response.context['order_count_kind']), (6, 'exact'))
+
+
+class OrderExportTests(TestCase):
+    auth = {'HTTP_AUTHORIZATION': 'Basic YWRtaW46cHc='}
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.orders = []
+        for i in range(3):
+            order = Order.objects.create(
+                last_name='山田', first_name=str(i), username='u', address='東京都, 1-2',
+                total_price=1000, status='paid' if i % 2 else 'pending',
+            )
+            OrderItem.objects.bulk_create([
+                OrderItem(order=order, product_name=f'商品{j}', product_price=500, quantity=1) for j in range(2)
+            ])
+            cls.orders.append(order)
+        # コミット済みの注文として、差分出力の待ち時間（SALES_ROLLUP_LAG_SECONDS）より前に作ったことにする
+        Order.objects.update(created_at=timezone.now() - timedelta(minutes=10))
+
+    def _get(self, params=None):
+        response = self.client.get(reverse('product:order_export'), params or {}, **self.auth)
+        self.assertEqual(response.status_code, 200)
+        return b''.join(response.streaming_content)
+
+    def test_csv_streams_one_row_per_item(self):
+        rows = list(csv.reader(io.StringIO(self._get().decode('utf-8'))))
+        self.assertEqual(rows[0], export.EXPORT_COLUMNS)
+        self.assertEqual(len(rows), 1 + 6)
+        self.assertEqual(rows[1][6], '東京都, 1-2')
+
+    def test_ndjson_gzip_since_id(self):
+        body = self._get({'format': 'ndjson', 'gzip': '1', 'since_id': self.orders[0].pk})
+        records = [json.loads(line) for line in gzip.decompress(body).decode('utf-8').splitlines()]
+        self.assertEqual({r['order_id'] for r in records}, {o.pk for o in self.orders[1:]})
+
+    def test_status_filter_and_command(self):
+        rows = list(csv.reader(io.StringIO(self._get({'status': 'paid'}).decode('utf-8'))))
+        self.assertEqual({r[2] for r in rows[1:]}, {'paid'})
+
+        with tempfile.NamedTemporaryFile(suffix='.ndjson') as f:
+            call_command('export_orders', '--format=ndjson', f'--output={f.name}', stderr=io.StringIO())
+            self.assertEqual(len(f.read().splitlines()), 6)
+
+    def test_command_reports_last_written_order(self):
+        iter_csv = export.iter_csv
+
+        def iter_csv_with_late_order(rows):
+            # 書き出しの途中に注文がコミットされても、書き出していない注文IDは報告しない
+            chunks = iter_csv(rows)
+            yield next(chunks)
+            yield next(chunks)
+            late = Order.objects.create(last_name='遅', first_name='着', username='u', address='東京都', total_price=1)
+            OrderItem.objects.create(order=late, product_name='商品', product_price=1, quantity=1)
+            yield from chunks
+
+        stderr = io.StringIO()
+        with mock.patch.object(export, 'iter_csv', iter_csv_with_late_order), \
+                tempfile.NamedTemporaryFile(suffix='.csv') as f:
+            call_command('export_orders', f'--output={f.name}', stderr=stderr)
+            self.assertEqual(len(f.read().splitlines()), 1 + 6)
+        self.assertIn(f'--since-id {self.orders[-1].pk} ', stderr.getvalue())
+
+    def test_incremental_export_waits_for_uncommitted_lower_ids(self):
+        def export_ids(*args):
+            stderr = io.StringIO()
+            with tempfile.NamedTemporaryFile(suffix='.ndjson') as f:
+                call_command('export_orders', '--format=ndjson', f'--output={f.name}', *args, stderr=stderr)
+                ids = {json.loads(line)['order_id'] for line in f.read().splitlines()}
+            return ids, stderr.getvalue()
+
+        def create_order(pk):
+            order = Order.objects.create(pk=pk, last_name='差', first_name='分', username='u', address='東京都',
+                                         total_price=1)
+            OrderItem.objects.create(order=order, product_name='商品', product_price=1, quantity=1)
+            return order
+
+        last = self.orders[-1].pk
+        # last + 1 を採番したトランザクションがまだコミットされていないうちに、last + 2 がコミットされた
+        create_order(last + 2)
+        ids, report = export_ids('--lag=60')
+        self.assertEqual(ids, {o.pk for o in self.orders})
+        self.assertIn(f'--since-id {last} ', report)
+
+        create_order(last + 1)
+        Order.objects.update(created_at=timezone.now() - timedelta(minutes=10))
+        ids, report = export_ids('--lag=60', f'--since-id={last}')
+        self.assertEqual(ids, {last + 1, last + 2})
+        self.assertIn(f'--since-id {last + 2} ', report)
+
+    def test_requires_auth(self):
+        self.assertEqual(self.client.get(reverse('product:order_export')).status_code, 401)
+
+
+class SalesRollupTests(TestCase):
+    auth = {'HTTP_AUTHORIZATION': 'Basic YWRtaW46cHc='}
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.product = Product.objects.create(name='シャツ', price=1000)
+
+    def _order(self, minutes_ago, quantity=1):
+        order = Order.objects.create(last_name='山田', first_name='太郎', username='u', address='東京都',
+                                     total_price=1000 * quantity)
+        OrderItem.objects.create(order=order, product=self.product, product_name='シャツ',
+                                 product_price=1000, quantity=quantity)
+        Order.objects.filter(pk=order.pk).update(created_at=timezone.now() - timedelta(minutes=minutes_ago))
+        return order
+
+    def test_incremental_update_skips_recent_orders(self):
+        self._order(10)
+        self._order(10, quantity=2)
+        recent = self._order(0)
+
+        self.assertEqual(rollups.update_rollups(lag_seconds=60), 2)
+        self.assertEqual(rollups.update_rollups(lag_seconds=60), 0)
+        row = ProductSalesDaily.objects.get()
+        self.assertEqual((row.revenue, row.units, row.orders), (3000, 3, 2))
+
+        Order.objects.filter(pk=recent.pk).update(created_at=timezone.now() - timedelta(minutes=5))
+        self.assertEqual(rollups.update_rollups(lag_seconds=60), 1)
+        self.assertEqual(sum(SalesHourly.objects.values_list('orders', flat=True)), 3)
+        self.assertEqual(rollups.check_rollups(), [])
+
+    def test_check_detects_drift_and_rebuild_fixes_it(self):
+        self._order(10)
+        call_command('update_sales_rollups', stdout=io.StringIO())
+        SalesHourly.objects.update(revenue=1)
+        with self.assertRaises(CommandError):
+            call_command('update_sales_rollups', '--check', stdout=io.StringIO(), stderr=io.StringIO())
+
+        call_command('update_sales_rollups', '--rebuild', stdout=io.StringIO())
+        self.assertEqual(rollups.check_rollups(), [])
+
+    def test_dashboard_reads_only_rollups(self):
+        self._order(10, quantity=3)
+        rollups.update_rollups()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('product:sales_dashboard'), **self.auth)
+        self.assertFalse([q for q in queries if 'product_orderitem' in q['sql'] or 'product_order"' in q['sql']])
+        self.assertEqual(response.context['total_revenue'], 3000)
+        self.assertEqual(response.context['top_products'][0]['units'], 3)
+
+
+class PurgeCartsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.product = Product.objects.create(name='シャツ', price=1000)
+
+    def _cart(self, days_ago, items=1):
+        cart = Cart.objects.create(updated_at=timezone.now() - timedelta(days=days_ago))
+        if items:
+            CartItem.objects.create(cart=cart, product=self.product, quantity=items)
+        return cart
+
+    def test_purges_in_batches_and_keeps_active_carts(self):
+        stale = [self._cart(30) for _ in range(5)]
+        empty = self._cart(2, items=0)
+        active = self._cart(1)
+        fresh_empty = self._cart(0, items=0)
+        Session.objects.create(session_key='old', session_data='', expire_date=timezone.now() - timedelta(days=1))
+        Session.objects.create(session_key='live', session_data='', expire_date=timezone.now() + timedelta(days=1))
+
+        out = io.StringIO()
+        call_command('purge_carts', '--batch-size=2', '--sleep=0', stdout=out)
+
+        self.assertEqual(set(Cart.objects.values_list('pk', flat=True)), {active.pk, fresh_empty.pk})
+        self.assertFalse(CartItem.objects.filter(cart_id__in=[c.pk for c in stale + [empty]]).exists())
+        self.assertEqual(list(Session.objects.values_list('session_key', flat=True)), ['live'])
+        self.assertIn('放置カート: 合計 5 件', out.getvalue())
+
+    def test_cart_activity_is_touched_at_most_once_per_interval(self):
+        self.client.post(reverse('product:add_to_cart', args=[self.product.pk]), {'quantity': 1})
+        cart = Cart.objects.get()
+        Cart.objects.filter(pk=cart.pk).update(updated_at=timezone.now() - timedelta(days=20))
+        self.client.post(reverse('product:add_to_cart', args=[self.product.pk]), {'quantity': 1})
+        # セッション上はまだ触ったばかりなので UPDATE しない
+        self.assertLess(Cart.objects.get().updated_at, timezone.now() - timedelta(days=19))
+
+        session = self.client.session
+        session['cart_touched'] -= 2 * 24 * 60 * 60
+        session.save()
+        self.client.post(reverse('product:add_to_cart', args=[self.product.pk]), {'quantity': 1})
+        self.assertGreater(Cart.objects.get().updated_at, timezone.now() - timedelta(minutes=1))
+
+
+class PurgeCartsConcurrencyTests(TransactionTestCase):
+    def test_add_recovers_when_cart_is_purged_concurrently(self):
+        product = Product.objects.create(name='シャツ', price=1000)
+        self.client.post(reverse('product:add_to_cart', args=[product.pk]), {'quantity': 1})
+        old = Cart.objects.get()
+
+        real_get_cart = DatabaseCartStorage.get_cart
+
+        def get_cart_then_purge(storage, *args, **kwargs):
+            # カートを読んだ直後に purge_carts が消した状況を作る
+            cart = real_get_cart(storage, *args, **kwargs)
+            Cart.objects.filter(pk=old.pk).delete()
+            return cart
+
+        with mock.patch.object(DatabaseCartStorage, 'get_cart', get_cart_then_purge):
+            self.client.post(reverse('product:add_to_cart', args=[product.pk]), {'quantity': 2})
+
+        cart = Cart.objects.get()
+        self.assertNotEqual(cart.pk, old.pk)
+        self.assertEqual(list(cart.cart_items.values_list('quantity', flat=True)), [2])
+
+
+@override_settings(PRODUCT_IMAGE_WIDTHS=[100, 200])
+class ImageDerivativeTests(TestCase):
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        override = override_settings(MEDIA_ROOT=media.name)
+        override.enable()
+        self.addCleanup(override.disable)
+        self.media = Path(media.name)
+
+    def _product(self, width=300, mode='RGBA'):
+        buffer = io.BytesIO()
+        Image.new(mode, (width, width // 2), (200, 30, 30, 128) if mode == 'RGBA' else (200, 30, 30)).save(buffer, 'PNG')
+        product = Product(name='シャツ', price=1000)
+        product.image.save('shirt.png', ContentFile(buffer.getvalue()))
+        return product
+
+    def test_generates_webp_and_jpeg_without_upscaling(self):
+        product = self._product(width=150)
+        images.update_product_images(product)
+        product.refresh_from_db()
+        self.assertEqual(product.image_widths, [100])
+        with Image.open(self.media / images.derivative_name(product.image.name, 100, 'webp')) as webp:
+            self.assertEqual((webp.format, webp.size), ('WEBP', (100, 50)))
+        with Image.open(self.media / images.derivative_name(product.image.name, 100, 'jpg')) as jpeg:
+            self.assertEqual(jpeg.format, 'JPEG')
+
+    def test_card_uses_srcset(self):
+        product = self._product()
+        images.update_product_images(product)
+        response = self.client.get(reverse('product:product_list'))
+        url = '/media/product_image/derived/' + Path(product.image.name).stem
+        self.assertContains(response, f'type="image/webp" srcset="{url}_100w.webp 100w, {url}_200w.webp 200w"')
+        self.assertContains(response, f'src="{url}_200w.jpg"')
+
+    def test_backfill_command(self):
+        products = [self._product(), self._product(mode='RGB')]
+        call_command('build_image_derivatives', '--workers=1', stdout=io.StringIO())
+        self.assertEqual(
+            [p.image_widths for p in Product.objects.filter(pk__in=[p.pk for p in products])], [[100, 200]] * 2
+        )
+        self.assertTrue((self.media / images.derivative_name(products[1].image.name, 200, 'webp')).exists())
+
+
+class ContentAddressedStorageTests(TestCase):
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        self.storage = ContentAddressedFileSystemStorage(location=media.name)
+        self.media = Path(media.name)
+
+    def test_identical_uploads_are_stored_once_without_io(self):
+        first = self.storage.save('product_image/cap.png', ContentFile(b'same bytes'))
+        self.assertRegex(first, r'^product_image/[0-9a-f]{32}\.png$')
+
+        with mock.patch.object(FileSystemStorage, 'exists') as exists, \
+                mock.patch.object(FileSystemStorage, '_save') as save:
+            second = self.storage.save('product_image/cap_copy.png', ContentFile(b'same bytes'))
+        self.assertEqual(second, first)
+        exists.assert_not_called()
+        save.assert_not_called()
+        self.assertEqual(len(list((self.media / 'product_image').iterdir())), 1)
+
+        other = self.storage.save('product_image/cap.png', ContentFile(b'other bytes'))
+        self.assertNotEqual(other, first)
+
+    def test_cloudinary_names_and_public_ids(self):
+        storage = ContentAddressedCloudinaryStorage()
+        with mock.patch('cloudinary.uploader.upload', return_value={}) as upload, \
+                mock.patch.object(ContentAddressedCloudinaryStorage, 'exists', return_value=False):
+            first = storage.save('product_image/cap.png', ContentFile(b'same bytes'))
+            # 台帳から返す2回目も、初めてのときと同じ名前
+            self.assertEqual(storage.save('product_image/copy.png', ContentFile(b'same bytes')), first)
+            self.assertRegex(first, r'^product_image/[0-9a-f]{32}\.png$')
+            webp = storage.save_as('product_image/derived/cap_320w.webp', ContentFile(b'webp'))
+            jpg = storage.save_as('product_image/derived/cap_320w.jpg', ContentFile(b'jpg'))
+
+        public_ids = [call.kwargs['public_id'] for call in upload.call_args_list]
+        self.assertEqual(len(public_ids), 3)
+        self.assertEqual(len(set(public_ids)), 3)
+        self.assertTrue(public_ids[0].endswith(first[len('product_image/'):-len('.png')] + '_png'))
+        self.assertEqual((webp, jpg), ('product_image/derived/cap_320w.webp', 'product_image/derived/cap_320w.jpg'))
+        self.assertEqual(storage._public_id('media/product_image/cap_8eS7fjs'), ('media/product_image/cap_8eS7fjs', None))
+
+    def test_collapse_duplicates_repoints_products(self):
+        for name in ('cap.png', 'cap_8eS7fjs.png', 'tote.png'):
+            FileSystemStorage(location=self.media).save(f'product_image/{name}', ContentFile(name[:3].encode()))
+        dup = Product.objects.create(name='キャップ', price=1, image='product_image/cap_8eS7fjs.png', image_widths=[320])
+
+        with mock.patch('product.management.commands.dedupe_media.default_storage', self.storage):
+            call_command('dedupe_media', stdout=io.StringIO())
+
+        dup.refresh_from_db()
+        self.assertEqual((dup.image.name, dup.image_widths), ('product_image/cap.png', []))
+        self.assertEqual(sorted(p.name for p in (self.media / 'product_image').iterdir()), ['cap.png', 'tote.png'])
+        self.assertEqual(
+            self.storage.save('product_image/new.png', ContentFile(b'cap')), 'product_image/cap.png'
+        )
+
+
+class GenerateLoadDataTests(TestCase):
+    def _snapshot(self):
+        return (
+            list(Product.objects.order_by('pk').values_list('name', 'price')),
+            list(Order.objects.order_by('pk').values_list('created_at', 'total_price', 'status')),
+            list(OrderItem.objects.order_by('pk').values_list('product_name', 'quantity')),
+            Cart.objects.count(), CartItem.objects.count(),
+        )
+
+    def test_deterministic_and_historical(self):
+        args = ['--products=20', '--carts=30', '--orders=200', '--batch-size=64', '--seed=7', '--end=2026-01-01']
+        call_command('generate_load_data', *args, stdout=io.StringIO())
+        first = self._snapshot()
+
+        for model in (OrderItem, Order, CartItem, Cart, Product):
+            model.objects.all().delete()
+        call_command('generate_load_data', *args, stdout=io.StringIO())
+        self.assertEqual(self._snapshot(), first)
+
+        created = [row[0] for row in first[1]]
+        self.assertEqual(created, sorted(created))
+        self.assertLess(created[-1], timezone.make_aware(timezone.datetime(2026, 1, 1)))
+        self.assertGreater(created[0], timezone.make_aware(timezone.datetime(2024, 12, 31)))
+        product = Product.objects.first()
+        self.assertIn(product, search.search_products(product.name, limit=100))
+
+        # auto_now_add は元に戻っている
+        self.assertTrue(Order._meta.get_field('created_at').auto_now_add)
+        order = Order.objects.create(last_name='a', first_name='b', username='c', address='d', total_price=1)
+        self.assertGreater(order.created_at, timezone.now() - timedelta(minutes=1))
+
+
+class MetricsTests(TestCase):
+    auth = {'HTTP_AUTHORIZATION': 'Basic YWRtaW46cHc='}
+
+    def setUp(self):
+        cache.clear()
+        metrics.registry.reset()
+        Product.objects.create(name='メトリクス', price=100, description='d')
+
+    def test_server_timing_header(self):
+        # 内部の処理時間なので、匿名の利用者には返さない
+        self.assertNotIn('Server-Timing', self.client.get(reverse('product:product_list')))
+
+        response = self.client.get(reverse('product:product_list'), **self.auth)
+        timing = response['Server-Timing']
+        self.assertRegex(timing, r'db;dur=[\d.]+;desc="\d+ queries"')
+        self.assertIn('tpl;dur=', timing)
+        self.assertIn('total;dur=', timing)
+
+        with override_settings(METRICS_SERVER_TIMING=False):
+            self.assertNotIn('Server-Timing', self.client.get(reverse('product:product_list'), **self.auth))
+
+    def test_prometheus_endpoint(self):
+        # request_started で接続のクエリ記録が消えるので、数は次のリクエストの前に控えておく
+        with CaptureQueriesContext(connection) as queries:
+            for _ in range(3):
+                self.client.get(reverse('product:product_list'))
+        query_count = len(queries)
+        self.assertEqual(self.client.get(reverse('product:metrics')).status_code, 401)
+
+        body = self.client.get(reverse('product:metrics'), **self.auth).content.decode('utf-8')
+        self.assertIn('django_http_requests_total{view="product:product_list",method="GET",status="200"} 3', body)
+        self.assertIn('django_http_request_duration_seconds_bucket{view="product:product_list",le="+Inf"} 3', body)
+        self.assertIn(f'django_db_queries_total{{view="product:product_list"}} {query_count}', body)
+        self.assertIn('django_http_requests_total{view="product:metrics",method="GET",status="401"} 1', body)
+
+    def test_merges_snapshots_from_other_processes(self):
+        self.client.get(reverse('product:product_list'))
+        other = metrics.registry.snapshot()
+        cache.set('metrics:process:other:1', other)
+        cache.set(metrics.PROCESS_INDEX_KEY, [metrics.PROCESS_KEY, 'other:1'])
+
+        merged = metrics.collect()
+        self.assertEqual(merged['product:product_list']['count'], 2)
+
+
+class ProfilingTests(TestCase):
+    auth = {'HTTP_AUTHORIZATION': 'Basic YWRtaW46cHc='}
+
+    def setUp(self):
+        cache.clear()
+        Product.objects.create(name='プロファイル', price=100, description='d')
+
+    def test_header_requires_credentials(self):
+        response = self.client.get(reverse('product:product_list'), HTTP_X_PROFILE='cprofile')
+        self.assertNotIn('X-Profile-Id', response)
+        response = self.client.get(reverse('product:product_list'), HTTP_X_PROFILE='cprofile',
+                                   HTTP_AUTHORIZATION='Basic YWRtaW46d3Jvbmc=')
+        self.assertNotIn('X-Profile-Id', response)
+        self.assertEqual(profiling.list_profiles(), [])
+
+    def test_cprofile_download_is_pstats(self):
+        response = self.client.get(reverse('product:product_list'), HTTP_X_PROFILE='cprofile', **self.auth)
+        profile_id = int(response['X-Profile-Id'])
+
+        listing = self.client.get(reverse('product:profile_list'), **self.auth)
+        self.assertContains(listing, reverse('product:profile_download', args=[profile_id]))
+
+        download = self.client.get(reverse('product:profile_download', args=[profile_id]), **self.auth)
+        with tempfile.NamedTemporaryFile(suffix='.pstats') as f:
+            f.write(download.content)
+            f.flush()
+            functions = {func for _, _, func in pstats.Stats(f.name).stats}
+        self.assertIn('get_queryset', functions)
+
+    @override_settings(PROFILE_SAMPLE_RATE=1, PROFILE_SAMPLE_INTERVAL_MS=1, PROFILE_BUFFER_SIZE=3)
+    def test_sampled_requests_go_to_ring_buffer(self):
+        def slow_view(view, request, *args, **kwargs):
+            time.sleep(0.05)
+            return HttpResponse('ok')
+
+        with mock.patch('product.views.ProductSearchView.get', autospec=True, side_effect=slow_view):
+            ids = [int(self.client.get(reverse('product:product_search'))['X-Profile-Id']) for _ in range(5)]
+        self.assertEqual([p['id'] for p in profiling.list_profiles()], ids[:-4:-1])
+        self.assertIsNone(profiling.get_profile(ids[0]))
+
+        download = self.client.get(reverse('product:profile_download', args=[ids[-1]]), **self.auth)
+        stacks = download.content.decode('utf-8').splitlines()
+        self.assertTrue(any(';slow_view (tests.py:' in stack for stack in stacks))
+        self.assertEqual(
+            self.client.get(reverse('product:profile_download', args=[ids[0]]), **self.auth).status_code, 404)
+
+
+@override_settings(RECOMMENDATION_TOP_K=2)
+class RecommendationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.products = [Product.objects.create(name=f'商品{i}', price=100) for i in range(4)]
+
+    def _order(self, *indexes):
+        order = Order.objects.create(last_name='山田', first_name='太郎', username='u', address='東京都',
+                                     total_price=100)
+        OrderItem.objects.bulk_create([
+            OrderItem(order=order, product=self.products[i], product_name='x', product_price=100) for i in indexes
+        ])
+        return order
+
+    def test_counts_each_order_once(self):
+        a, b, n = recommendations.cooccurrence_counts([(1, 10), (1, 20), (1, 20), (2, 10), (2, 20), (3, 30)])
+        self.assertEqual(sorted(zip(a.tolist(), b.tolist(), n.tolist())), [(10, 20, 2), (20, 10, 2)])
+
+    def test_incremental_update_matches_rebuild(self):
+        self._order(0, 1)
+        self._order(0, 1, 2)
+        self.assertEqual(recommendations.update_recommendations(lag_seconds=0), 2)
+        self._order(0, 2, 3)
+        self._order(2, 3)
+        self._order(3, 1)
+        self.assertEqual(recommendations.update_recommendations(batch_size=2, lag_seconds=0), 3)
+
+        incremental = list(ProductRecommendation.objects.order_by('product_id', 'rank').values_list(
+            'product_id', 'recommended_id', 'score'))
+        p = [product.pk for product in self.products]
+        # 商品0: 商品1 と 商品2 が2回ずつ（同数なら新しい商品が上）、商品3 は1回で上位2件から外れる
+        self.assertEqual([row for row in incremental if row[0] == p[0]], [(p[0], p[2], 2), (p[0], p[1], 2)])
+
+        call_command('update_recommendations', '--rebuild', '--lag=0', stdout=io.StringIO())
+        self.assertEqual(list(ProductRecommendation.objects.order_by('product_id', 'rank').values_list(
+            'product_id', 'recommended_id', 'score')), incremental)
+        self.assertEqual(ProductCooccurrence.objects.get(product_a=p[2], product_b=p[0]).orders, 2)
+
+    def test_detail_page_shows_recommendations_in_one_query(self):
+        self._order(0, 3)
+        self._order(0, 1)
+        self._order(0, 1)
+        recommendations.update_recommendations(lag_seconds=0)
+
+        response = self.client.get(reverse('product:product_detail', args=[self.products[0].pk]))
+        self.assertEqual([p.pk for p in response.context['related_products']],
+                         [self.products[1].pk, self.products[3].pk])
+        self.assertContains(response, 'よく一緒に購入されている商品')
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('product:product_detail', args=[self.products[0].pk]))
+        self.assertEqual(len([q for q in queries if 'product_productrecommendation' in q['sql']]), 1)
+
+        response = self.client.get(reverse('product:product_detail', args=[self.products[2].pk]))
+        self.assertNotContains(response, 'よく一緒に購入されている商品')
+
+
+class InventoryTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.cap = Product.objects.create(name='キャップ', price=4000, stock=3)
+        cls.tote = Product.objects.create(name='トートバッグ', price=2000, stock=1)
+        cls.sticker = Product.objects.create(name='ステッカー', price=300)
+
+    def _add(self, client, product, quantity=1):
+        return client.post(reverse('product:add_to_cart', args=[product.pk]), {'quantity': quantity}, follow=True)
+
+    def test_decrement_is_all_or_nothing(self):
+        with self.assertRaises(inventory.OutOfStock) as cm, transaction.atomic():
+            inventory.decrement_stock({self.cap.pk: 2, self.tote.pk: 2, self.sticker.pk: 5})
+        self.assertEqual([p.name for p in inventory.short_products(cm.exception.lines)], ['トートバッグ'])
+        self.cap.refresh_from_db()
+        self.assertEqual(self.cap.stock, 3)
+
+        inventory.decrement_stock({self.cap.pk: 3, self.tote.pk: 1, self.sticker.pk: 5})
+        self.assertEqual(
+            list(Product.objects.order_by('pk').values_list('stock', flat=True)), [0, 0, None])
+
+    def test_reservations_limit_other_carts_until_they_expire(self):
+        self._add(self.client, self.cap, 2)
+        other = self.client_class()
+        response = self._add(other, self.cap, 2)
+        self.assertContains(response, '在庫が足りないため')
+        self.assertContains(self._add(other, self.cap, 1), 'カートに追加しました')
+
+        # 自分のカートの分は差し引かない
+        self.assertNotContains(self.client.get(reverse('product:cart_detail')), '在庫が足りません')
+        listing = self.client.get(reverse('product:product_list'))
+        self.assertEqual({p.pk: p.available for p in listing.context['object_list']},
+                         {self.cap.pk: 0, self.tote.pk: 1, self.sticker.pk: None})
+        self.assertContains(listing, '在庫切れ')
+
+        CartItem.objects.update(reserved_until=timezone.now() - timedelta(seconds=1))
+        self.assertContains(self._add(other, self.cap, 1), 'カートに追加しました')
+
+    def test_checkout_fails_when_stock_ran_out(self):
+        self._add(self.client, self.cap, 2)
+        self._add(self.client, self.sticker, 1)
+        Product.objects.filter(pk=self.cap.pk).update(stock=1)
+
+        cart = self.client.get(reverse('product:cart_detail'))
+        self.assertContains(cart, '在庫が足りません（残り1点）')
+        response = self.client.post(reverse('product:order_create'), ORDER_POST, follow=True)
+        self.assertContains(response, '在庫が足りない商品があります: キャップ')
+        self.assertFalse(Order.objects.exists())
+        self.assertEqual(CartItem.objects.count(), 2)
+
+        self.client.post(reverse('product:decrease_cart', args=[self.cap.pk]))
+        self.client.post(reverse('product:order_create'), ORDER_POST)
+        self.assertEqual(Order.objects.get().items.count(), 2)
+        self.assertEqual(Product.objects.get(pk=self.cap.pk).stock, 0)
+
+
+class InventoryConcurrencyTests(TransactionTestCase):
+    """同時に注文を確定しても売り越さないことを、スレッドごとに別の接続・セッションで確かめる。"""
+    workers = 8
+    stock = 5
+
+    def setUp(self):
+        # テーブルロックで失敗した注文のログ（order_create の logger.exception）は想定どおりなので出力しない
+        handler = logging.NullHandler()
+        views_logger = logging.getLogger('product.views')
+        views_logger.addHandler(handler)
+        self.addCleanup(views_logger.removeHandler, handler)
+
+    def _checkout(self, client, product, barrier, results):
+        # テスト用の SQLite（共有キャッシュのインメモリ DB）はテーブルロックで即座に失敗するので、
+        # 冪等性キーを付けて、注文できたか売り切れるまで再送する（同じ注文が二重に確定することはない）
+        data = {**ORDER_POST, 'idempotency_key': uuid.uuid4().hex}
+        try:
+            barrier.wait()
+            for _ in range(200):
+                try:
+                    client.post(reverse('product:order_create'), data)
+                    if Order.objects.filter(idempotency_key=data['idempotency_key']).exists():
+                        results.append(True)
+                        return
+                    if Product.objects.get(pk=product.pk).stock == 0:
+                        results.append(False)
+                        return
+                except OperationalError:
+                    pass
+                time.sleep(0.01)
+        finally:
+            connection.close()
+
+    def test_concurrent_checkouts_never_oversell(self):
+        product = Product.objects.create(name='限定品', price=1000, stock=self.stock)
+        other = Product.objects.create(name='定番品', price=500)
+        clients = []
+        for _ in range(self.workers):
+            client = self.client_class()
+            client.post(reverse('product:add_to_cart', args=[other.pk]))
+            client.post(reverse('product:add_to_cart', args=[product.pk]))
+            clients.append(client)
+        # 仮押さえはカート追加の段階の話なので、ここでは全員が1点ずつカートに入れた状態から始める
+        self.assertEqual(CartItem.objects.filter(product=product).count(), self.stock)
+        CartItem.objects.bulk_create([
+            CartItem(cart_id=client.session['cart_id'], product=product, quantity=1)
+            for client in clients[self.stock:]
+        ])
+
+        barrier = threading.Barrier(self.workers)
+        results = []
+        threads = [
+            threading.Thread(target=self._checkout, args=(client, product, barrier, results)) for client in clients
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(results), [False] * (self.workers - self.stock) + [True] * self.stock)
+        sold = OrderItem.objects.filter(product=product).aggregate(total=Sum('quantity'))['total'] or 0
+        product.refresh_from_db()
+        self.assertEqual((sold, product.stock), (self.stock, 0))
+        # 在庫切れで失敗した注文は、在庫を管理しない商品の明細も残さない
+        self.assertEqual(OrderItem.objects.filter(product=other).count(), Order.objects.count())
+        self.assertEqual(Order.objects.count(), sold)
+
+
+class StressCheckoutTests(TransactionTestCase):
+    """負荷試験ハーネス自体の確認。競合の多い本番相当の試験は PostgreSQL で stress_checkout を実行する。"""
+
+    def test_classify_error(self):
+        deadlock = OperationalError('deadlock detected')
+        # psycopg の例外は Django の例外の __cause__ に入り、SQLSTATE を持つ
+        cause = Exception('could not access')
+        cause.sqlstate = '40001'
+        serialization = OperationalError('failed')
+        serialization.__cause__ = cause
+        self.assertEqual(stress.classify_error(deadlock), 'deadlock')
+        self.assertEqual(stress.classify_error(serialization), 'serialization')
+        self.assertEqual(stress.classify_error(OperationalError('database table is locked')), 'locked')
+        self.assertEqual(stress.classify_error(ValueError('x')), 'other')
+
+    def test_run_stress_keeps_invariants(self):
+        for i in range(4):
+            Product.objects.create(name=f'商品{i}', price=100 * (i + 1))
+        report = stress.run_stress(workers=1, iterations=3, lines=2, products=4, stock=100)
+        self.assertEqual(report['problems'], [])
+        self.assertEqual(report['checkouts'], 3)
+        self.assertEqual(report['latency']['order_create']['count'], 3)
+        self.assertEqual(Order.objects.count(), 3)
+        self.assertFalse(CartItem.objects.exists())
+        sold = OrderItem.objects.aggregate(total=Sum('quantity'))['total']
+        self.assertEqual(Product.objects.aggregate(total=Sum('stock'))['total'], 400 - sold)
+
+    def test_check_invariants_reports_broken_orders(self):
+        product = Product.objects.create(name='商品', price=100, stock=10)
+        order = Order.objects.create(**{k: v for k, v in ORDER_POST.items() if not k.startswith('card')},
+                                     total_price=999)
+        OrderItem.objects.create(order=order, product=product, product_price=100, quantity=2)
+        problems = stress.check_invariants(0, {product.pk: 10}, [])
+        self.assertEqual(len(problems), 2)
+        self.assertIn(f'注文 {order.pk}', problems[0])
+        self.assertIn(f'商品 {product.pk}', problems[1])
+
+    def test_command_reports_json(self):
+        Product.objects.create(name='商品', price=100)
+        out = io.StringIO()
+        call_command('stress_checkout', workers=1, iterations=2, products=1, json=True, stdout=out)
+        report = json.loads(out.getvalue())
+        self.assertEqual((report['checkouts'], report['problems']), (2, []))
+        self.assertEqual(set(report['errors']), set(stress.ERROR_KINDS))
+
+
+@override_settings(DEBUG=True)
+class AsyncViewTests(TestCase):
+    """ASGI と同じく、ミドルウェアとビューを async のまま通す（AsyncClient）。"""
+
+    async def test_catalog_and_cart_stay_async(self):
+        product = await Product.objects.acreate(name='非同期', price=1000, stock=3)
+        # DEBUG のときは、同期のみのミドルウェアをスレッドに移すたびに django.request に記録される
+        with self.assertNoLogs('django.request', level='DEBUG'):
+            listing = await self.async_client.get(reverse('product:product_list'))
+            detail = await self.async_client.get(reverse('product:product_detail', args=[product.pk]))
+            await self.async_client.post(reverse('product:add_to_cart', args=[product.pk]), {'quantity': 2})
+            await self.async_client.post(reverse('product:decrease_cart', args=[product.pk]))
+            cart = await self.async_client.get(reverse('product:cart_detail'))
+        missing = await self.async_client.get(reverse('product:product_detail', args=[product.pk + 1]))
+
+        self.assertContains(listing, '非同期')
+        self.assertEqual(detail.context['product'].available, 3)
+        self.assertEqual(cart.context['cart_count'], 1)
+        self.assertEqual(cart.context['cart_items'][0].product.available, 3)
+        self.assertEqual(missing.status_code, 404)
+
+        await self.async_client.post(reverse('product:delete_from_cart', args=[product.pk]))
+        self.assertFalse(await CartItem.objects.aexists())
+        timed = await self.async_client.get(reverse('product:product_list'), AUTHORIZATION='Basic YWRtaW46cHc=')
+        self.assertIn('Server-Timing', timed)
+        self.assertNotIn('Server-Timing', listing)
+
+    @override_settings(CART_STORAGE='product.cart.SessionCartStorage')
+    async def test_session_cart(self):
+        product = await Product.objects.acreate(name='セッション', price=500)
+        await self.async_client.post(reverse('product:add_to_cart', args=[product.pk]), {'quantity': 3})
+        await self.async_client.post(reverse('product:decrease_cart', args=[product.pk]))
+        cart = await self.async_client.get(reverse('product:cart_detail'))
+        self.assertEqual((cart.context['cart_count'], cart.context['total_price']), (2, 1000))
+        self.assertFalse(await CartItem.objects.aexists())
+
+
+class ConditionalGetTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.product = Product.objects.create(name='条件付き', price=1000, stock=5)
+        self.list_url = reverse('product:product_list')
+        self.detail_url = reverse('product:product_detail', args=[self.product.pk])
+
+    def revalidate(self, url, response, client=None):
+        return (client or self.client).get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+
+    def test_not_modified_without_queries(self):
+        for url in (self.list_url, self.detail_url):
+            # 初めての訪問では CSRF の Cookie が発行されて ETag が変わるので、2回目から比べる
+            self.client.get(url)
+            first = self.client.get(url)
+            self.assertTrue(first['ETag'].startswith('W/"'))
+            self.assertIn('Last-Modified', first)
+            with self.assertNumQueries(0):
+                second = self.revalidate(url, first)
+            self.assertEqual(second.status_code, 304)
+            self.assertEqual(second['ETag'], first['ETag'])
+            for response in (first, second):
+                self.assertIn('private', response['Cache-Control'])
+                self.assertIn('no-cache', response['Cache-Control'])
+                self.assertIn('Cookie', response['Vary'])
+
+    def test_product_save_changes_etag(self):
+        first = self.client.get(self.list_url)
+        self.product.name = '改名'
+        self.product.save()
+        response = self.revalidate(self.list_url, first)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, '改名')
+
+    def test_checkout_changes_etag_after_commit(self):
+        first = self.client.get(self.detail_url)
+        with self.captureOnCommitCallbacks(execute=True):
+            inventory.decrement_stock({self.product.pk: 2})
+        response = self.revalidate(self.detail_url, first)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['product'].available, 3)
+
+    def test_reservations_change_etag_for_other_visitors(self):
+        first = self.client.get(self.detail_url)
+        self.client_class().post(reverse('product:add_to_cart', args=[self.product.pk]), {'quantity': 2})
+        response = self.revalidate(self.detail_url, first)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['product'].available, 3)
+
+        # 最後の仮押さえの期限が過ぎたら、在庫の表示を出し直す
+        later = time.time_ns() + (settings.STOCK_RESERVATION_MINUTES + 1) * 60 * 10 ** 9
+        with mock.patch('product.conditional.time.time_ns', return_value=later):
+            self.assertEqual(self.revalidate(self.detail_url, response).status_code, 200)
+
+    def test_cart_count_and_messages(self):
+        first = self.client.get(self.list_url)
+        self.client.post(reverse('product:add_to_cart', args=[self.product.pk]), {'quantity': 1})
+        # フラッシュメッセージを出すページには ETag を付けない
+        with_message = self.revalidate(self.list_url, first)
+        self.assertEqual(with_message.status_code, 200)
+        self.assertNotIn('ETag', with_message)
+        self.assertIn('private', with_message['Cache-Control'])
+
+        counted = self.client.get(self.list_url)
+        self.assertNotEqual(counted['ETag'], first['ETag'])
+        self.assertEqual(self.revalidate(self.list_url, counted).status_code, 304)
+
+
+class ProductionSettingsTests(SimpleTestCase):
+    def load(self, cache_url):
+        """CACHE_URL を変えて本番の設定を読み込み直す（読み込んだモジュールは元に戻す）。"""
+        names = ('config.settings.base', 'config.settings.production')
+        saved = {name: sys.modules.pop(name) for name in names if name in sys.modules}
+        try:
+            with mock.patch.dict(os.environ, {'CACHE_URL': cache_url}):
+                return importlib.import_module('config.settings.production')
+        finally:
+            for name in names:
+                sys.modules.pop(name, None)
+            sys.modules.update(saved)
+
+    def test_requires_shared_cache(self):
+        for url in ('locmemcache://', 'filecache:///tmp/cache'):
+            with self.subTest(url), self.assertRaises(ImproperlyConfigured):
+                self.load(url)
+        production = self.load('dbcache://django_cache')
+        self.assertEqual(production.CACHES['default']['LOCATION'], 'django_cache')
@@ -1,14 +1,17 @@
 from django.contrib import admin
 from django.urls import path
-from .views import (ProductListView, ProductDetailView, ProductCreateView, 
+from .views import (ProductListView, ProductSearchView, product_autocomplete, ProductDetailView, ProductCreateView, 
                     ProductUpdateView, ProductDeleteView, ProductManageListView, 
                     CartView, CartAddView, CartDeleteView, CartDecreaseView, 
-                    order_create, OrderListView)
+                    order_create, OrderListView, order_export, sales_dashboard,
+                    metrics_view, profile_list, profile_download)
 
 
 app_name = 'product'
 urlpatterns = [
     path('', ProductListView.as_view(), name='product_list'),
+    path('search/', ProductSearchView.as_view(), name='product_search'),
+    path('autocomplete/', product_autocomplete, name='product_autocomplete'),
     path('<int:pk>/', ProductDetailView.as_view(), name='product_detail'),
     path('manage/products/', ProductManageListView.as_view(), name='manage_list'),
     path('manage/products/create/', ProductCreateView.as_view(), name='product_create'),
@@ -20,4 +23,9 @@ urlpatterns = [
     path('cart/decrease/<int:pk>/', CartDecreaseView.as_view(), name='decrease_cart'),
     path('order/', order_create, name='order_create'),
     path('manage/orders/', OrderListView.as_view(), name='order_list'),
+    path('manage/orders/export/', order_export, name='order_export'),
+    path('manage/sales/', sales_dashboard, name='sales_dashboard'),
+    path('manage/metrics/', metrics_view, name='metrics'),
+    path('manage/profiles/', profile_list, name='profile_list'),
+    path('manage/profiles/<int:pk>/download/', profile_download, name='profile_download'),
 ]
@@ -1,99 +1,158 @@
-import base64
-from typing import Tuple, Optional
+import logging
+from datetime import timedelta
 
-from django.http import HttpResponse
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
 from django.utils.decorators import method_decorator
 from django.urls import reverse_lazy, reverse
-from django.views.generic import ListView, DetailView, CreateView, UpdateView, DeleteView
+from django.views.generic import ListView, CreateView, UpdateView, DeleteView
 from django.views import View
 from django.shortcuts import redirect, render
+from django.template.response import TemplateResponse
 from django.contrib import messages
 from django.utils.safestring import mark_safe
-from django.db.models import F
+from django.utils import timezone
 from django.conf import settings
-from django.core.mail import send_mail
-from django.db import transaction
+from django.db import IntegrityError, transaction
+from django.db.models import Prefetch
 
-from .models import Product, Cart, CartItem, Order, OrderItem
-from .forms import OrderForm
+from .models import Product, Order, OrderItem
+from .forms import OrderForm, OrderFilterForm, OrderExportForm
+from .pagination import KeysetPaginator, InvalidCursor, estimate_count
+from . import search
+from .autocomplete import suggest
+from .catalog import aattach_card_versions, anote_reservation, attach_card_versions
+from .cart import aget_cart_from_request, get_cart_from_request
+from .outbox import enqueue_mail
+from . import conditional, export, images, inventory, metrics, profiling, recommendations, rollups
+from .auth import basic_auth_required
 
 
-def get_cart_from_request(request, create_if_missing: bool = False) -> Tuple[Optional[Cart], bool]:
-    """
-    セッション上の cart_id から Cart を取得する補助関数。
-    - create_if_missing=True の場合、見つからなければ新規作成して返す
-    - 戻り値は (cart, is_not_found)
-      - cart: Cart または None（create_if_missing=False で見つからないとき）
-      - is_not_found: 取得できなかった（新規作成した/Noneだった）かどうかのフラグ
-    """
-    cart_id = request.session.get('cart_id')
-    cart = None
+logger = logging.getLogger(__name__)
 
-    if cart_id:
-        cart = Cart.objects.filter(pk=cart_id).first()
 
-    if cart is None:
-        if create_if_missing:
-            cart = Cart.objects.create()
-            request.session['cart_id'] = cart.pk
-        return cart, True
+class ProductListView(View):
+    """
+    商品一覧。async ビューなので、ASGI ではクエリを待つ間にほかのリクエストを処理できる。
+    描画は TemplateResponse にして、ハンドラーにスレッドで行わせる（コンテキストプロセッサーが同期の ORM を使うため）。
+    内容が変わっていなければ、クエリも描画もせずに 304 を返す（conditional.py）。
+    """
+    template_name = 'product/product_list.html'
+    # カードで使う列だけを読む（description などは一覧では不要）
+    card_fields = ('pk', 'name', 'price', 'image', 'image_widths', 'stock')
+    orderings = {
+        'new': ('pk',),
+        'price': ('price', 'pk'),
+    }
+
+    def get_queryset(self):
+        return Product.objects.only(*self.card_fields)
+
+    async def get(self, request):
+        """
+        OFFSET ページングの代わりにカーソルページングを行う。
+        不正なカーソルが渡された場合は 1ページ目を返す。
+        """
+        cart = await aget_cart_from_request(request)
+        validators = await conditional.avalidators(request, cart)
+        response = conditional.not_modified(request, validators)
+        if response is not None:
+            return response
+
+        sort = request.GET.get('sort')
+        if sort not in self.orderings:
+            sort = 'new'
+        paginator = KeysetPaginator(
+            self.get_queryset(),
+            ordering=self.orderings[sort],
+            per_page=getattr(settings, 'PRODUCT_LIST_PAGE_SIZE', 20),
+        )
+        try:
+            page = await paginator.apage(after=request.GET.get('after'), before=request.GET.get('before'))
+        except InvalidCursor:
+            page = await paginator.apage()
+
+        # 在庫の表示は描画済みカードのキャッシュの外に出すので、キャッシュに関係なく毎回求める
+        products = await inventory.aattach_availability(await aattach_card_versions(page.object_list))
+        return conditional.add_headers(TemplateResponse(request, self.template_name, {
+            'object_list': products,
+            'page_obj': page,
+            'paginator': paginator,
+            'is_paginated': page.has_next or page.has_previous,
+            'sort': sort,
+        }), validators)
+
+
+class ProductSearchView(ListView):
+    template_name = 'product/product_search.html'
+
+    def get_queryset(self):
+        self.query = self.request.GET.get('q', '').strip()[:100]
+        if not self.query:
+            return []
+        return search.search_products(
+            self.query,
+            limit=getattr(settings, 'PRODUCT_SEARCH_LIMIT', 50),
+            fields=ProductListView.card_fields,
+        )
 
-    return cart, False
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['object_list'] = inventory.attach_availability(attach_card_versions(context['object_list']))
+        context['query'] = self.query
+        return context
 
 
-def basic_auth_required(func):
-    def wrapper(request, *args, **kwargs):
-        auth_header = request.META.get('HTTP_AUTHORIZATION')
+def product_autocomplete(request):
+    """
+    商品名の入力補完。プロセス内の前方一致インデックスから返すので SQL は発行しない。
+    """
+    query = request.GET.get('q', '')[:100]
+    results = [
+        {'id': pk, 'name': name, 'url': reverse('product:product_detail', args=[pk])}
+        for pk, name in suggest(query, limit=getattr(settings, 'PRODUCT_AUTOCOMPLETE_LIMIT', 10))
+    ]
+    return JsonResponse({'query': query, 'results': results})
 
-        if auth_header:
-            auth_type, auth_string = auth_header.split(' ', 1)
-            auth_decoded = base64.b64decode(auth_string).decode('utf-8')
-            username, password = auth_decoded.split(':', 1)
 
-            if username == 'admin' and password == 'pw':
-                return func(request, *args, **kwargs)
-            
-        response = HttpResponse("Unauthorized", status=401)
-        response['WWW-Authenticate'] = 'Basic realm="Main"'
-        return response
-    
-    return wrapper
-    
+class ProductDetailView(View):
+    template_name = 'product/product_detail.html'
 
-class ProductListView(ListView):
-    model = Product
-    template_name = 'product/product_list.html'
+    async def get(self, request, pk):
+        cart = await aget_cart_from_request(request)
+        validators = await conditional.avalidators(request, cart, recommendations=True)
+        response = conditional.not_modified(request, validators)
+        if response is not None:
+            return response
+
+        try:
+            product = await Product.objects.aget(pk=pk)
+        except Product.DoesNotExist:
+            raise Http404('商品が見つかりません')
+        related_products = [
+            related async for related in recommendations.recommended_products(product, ProductListView.card_fields)
+        ]
+        products = await inventory.aattach_availability(await aattach_card_versions([product, *related_products]))
+        return conditional.add_headers(TemplateResponse(request, self.template_name, {
+            'object': product,
+            'product': product,
+            'related_products': products[1:],
+        }), validators)
 
 
-class ProductDetailView(DetailView):
-    model = Product
-    template_name = 'product/product_detail.html'
+class CartView(View):
+    async def get(self, request):
+        cart = await aget_cart_from_request(request)
 
-    def get_context_data(self, **kwargs):
-        context = super().get_context_data(**kwargs)
-        related_products = Product.objects.all().order_by('-pk')[:4]
-        context['related_products'] = related_products
-        return context
-    
+        cart_items = await cart.aget_items()
+        total_price = sum(item.subtotal for item in cart_items)
+        cart_count = sum(item.quantity for item in cart_items)
+        await inventory.aattach_availability([item.product for item in cart_items], exclude_cart_id=cart.cart_id)
 
-class CartView(View):
-    def get(self, request):
-        cart, is_not_found = get_cart_from_request(request, create_if_missing=False)
-        
-        cart_items = []
-        total_price = 0
-        cart_count = 0
-        
-        if is_not_found:
-            if request.session.get('cart_id'):
-                messages.warning(request, "長期間操作がなかったため、カートの情報が更新されました。")
-        else:
-            cart_items = cart.cart_items.select_related('product').all()
-            total_price = sum(item.subtotal for item in cart_items)
-            cart_count = sum(item.quantity for item in cart_items)
+        if cart.is_expired:
+            messages.warning(request, "長期間操作がなかったため、カートの情報が更新されました。")
 
         form = OrderForm()
-        return render(request, 'product/cart.html', {
+        return TemplateResponse(request, 'product/cart.html', {
             'cart_items': cart_items, 
             'total_price': total_price, 
             'cart_count': cart_count,
@@ -102,55 +161,46 @@ class CartView(View):
     
 
 class CartAddView(View):
-    def post(self, request, pk):
-        product = Product.objects.get(pk=pk)
-        quantity = int(request.POST.get('quantity', 1))
-
-        cart, _ = get_cart_from_request(request, create_if_missing=True)
-
-        cart_item, created = CartItem.objects.update_or_create(
-            cart=cart,
-            product=product,
-            defaults={'quantity': quantity} if not CartItem.objects.filter(cart=cart, product=product).exists() 
-                        else {'quantity': F('quantity') + quantity}
-        )
-        
-        messages.success(request, mark_safe(f'{product.name}をカートに追加しました。'))
+    async def post(self, request, pk):
+        product = await Product.objects.only('name', 'stock').aget(pk=pk)
+        quantity = max(int(request.POST.get('quantity', 1)), 1)
 
+        cart = await aget_cart_from_request(request)
         next_page = request.POST.get('next')
+        # 在庫を管理している商品だけ、ほかのカートの仮押さえを差し引いた在庫と比べる
+        if product.stock is not None and not await inventory.acan_reserve(
+                product, await cart.aget_quantity(product.pk) + quantity, cart_id=cart.cart_id):
+            messages.error(request, f'{product.name}は在庫が足りないため、カートに追加できませんでした。')
+        else:
+            await cart.aadd(product.pk, quantity)
+            if product.stock is not None and cart.cart_id:
+                # ほかの人が注文できる数が減ったので、商品一覧・詳細の ETag を変える
+                await anote_reservation(inventory.reservation_expiry())
+            messages.success(request, mark_safe(f'{product.name}をカートに追加しました。'))
+
         if next_page == 'product_detail':
             return redirect('product:product_detail', pk=pk)
         return redirect('product:cart_detail' if next_page else 'product:product_list')
 
 
 class CartDeleteView(View):
-    def post(self, request, pk):
-        cart, is_not_found = get_cart_from_request(request)
+    async def post(self, request, pk):
+        cart = await aget_cart_from_request(request)
         
-        if is_not_found:
+        if await cart.ais_empty():
             return redirect('product:cart_detail')
 
-        product = Product.objects.get(pk=pk)
-        cart.cart_items.filter(product_id=pk).delete()
+        product = await Product.objects.only('name').aget(pk=pk)
+        await cart.aremove(pk)
 
         messages.info(request, f'{product.name}をカートから削除しました')
         return redirect('product:cart_detail')
 
 
 class CartDecreaseView(View):
-    def post(self, request, pk):
-        cart, is_not_found = get_cart_from_request(request)
-        if is_not_found:
-            return redirect('product:cart_detail')
-
-        cart_item = cart.cart_items.filter(product_id=pk).first()
-        
-        if cart_item:
-            cart_item.quantity -= 1
-            if cart_item.quantity <= 0:
-                cart_item.delete()
-            else:
-                cart_item.save()
+    async def post(self, request, pk):
+        cart = await aget_cart_from_request(request)
+        await cart.adecrease(pk)
 
         return redirect('product:cart_detail')
 
@@ -158,18 +208,31 @@ class CartDecreaseView(View):
 @method_decorator(basic_auth_required, name='dispatch')
 class ProductCreateView(CreateView):
     model = Product
-    fields = ['name', 'description', 'price', 'image']
+    fields = ['name', 'description', 'price', 'stock', 'image']
     template_name = 'product/product_create.html'
     success_url = reverse_lazy('product:manage_list')
 
+    def form_valid(self, form):
+        response = super().form_valid(form)
+        if self.object.image:
+            images.update_product_images(self.object)
+        return response
+
 
 @method_decorator(basic_auth_required, name='dispatch')
 class ProductUpdateView(UpdateView):
     model = Product
-    fields = ['name', 'description', 'price', 'image']
+    fields = ['name', 'description', 'price', 'stock', 'image']
     template_name = 'product/product_update.html'
     success_url = reverse_lazy('product:manage_list')
 
+    def form_valid(self, form):
+        previous = Product.objects.only('image', 'image_widths').get(pk=self.object.pk)
+        response = super().form_valid(form)
+        if 'image' in form.changed_data:
+            images.update_product_images(self.object, previous.image.name or '', previous.image_widths)
+        return response
+
 
 @method_decorator(basic_auth_required, name='dispatch')
 class ProductDeleteView(DeleteView):
@@ -190,20 +253,153 @@ class OrderListView(ListView):
     model = Order
     template_name = 'product/order_list.html'
     context_object_name = 'orders'
-    ordering = ['-created_at']
+    ordering = ('-created_at', '-id')
+    list_fields = ('id', 'created_at', 'last_name', 'first_name', 'total_price', 'address', 'status')
+
+    def get_paginate_by(self, queryset):
+        return getattr(settings, 'ORDER_LIST_PAGE_SIZE', 50)
+
+    def get_queryset(self):
+        self.filter_form = OrderFilterForm(self.request.GET or None)
+        queryset = Order.objects.only(*self.list_fields).prefetch_related(
+            Prefetch('items', queryset=OrderItem.objects.only('id', 'order_id', 'product_name', 'quantity'))
+        )
+        return self.filter_form.filter(queryset)
+
+    def paginate_queryset(self, queryset, page_size):
+        paginator = KeysetPaginator(queryset, ordering=self.ordering, per_page=page_size)
+        try:
+            page = paginator.page(after=self.request.GET.get('after'), before=self.request.GET.get('before'))
+        except InvalidCursor:
+            page = paginator.page()
+        return paginator, page, page.object_list, page.has_next or page.has_previous
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        count, count_kind = estimate_count(
+            self.object_list, cap=getattr(settings, 'ORDER_LIST_COUNT_CAP', 1000)
+        )
+        query = self.request.GET.copy()
+        query.pop('after', None)
+        query.pop('before', None)
+        context.update({
+            'filter_form': self.filter_form,
+            'order_count': count,
+            'order_count_kind': count_kind,
+            'filter_query': query.urlencode(),
+        })
+        return context
+
+
+@basic_auth_required
+def order_export(request):
+    """
+    注文明細を CSV / NDJSON で流しながら返す。件数によらずメモリ使用量は一定。
+    クエリパラメータ: format, status, date_from, date_to, since_id, gzip
+    since_id を指定した差分出力では、export_orders と同じく作成から間もない注文を次回に回す。
+    """
+    form = OrderExportForm(request.GET)
+    if not form.is_valid():
+        return HttpResponse(form.errors.as_text(), status=400, content_type='text/plain; charset=utf-8')
+
+    fmt = form.cleaned_data.get('format') or 'csv'
+    compress = form.cleaned_data.get('gzip')
+    since_id = form.cleaned_data.get('since_id')
+    lag_seconds = settings.SALES_ROLLUP_LAG_SECONDS if since_id is not None else None
+    queryset = form.filter(export.export_queryset(since_id=since_id, lag_seconds=lag_seconds), prefix='order__')
+
+    filename = f'orders.{fmt}' + ('.gz' if compress else '')
+    response = StreamingHttpResponse(
+        export.iter_export(queryset, fmt=fmt, compress=compress),
+        content_type='application/gzip' if compress else export.CONTENT_TYPES[fmt],
+    )
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+
+@basic_auth_required
+def sales_dashboard(request):
+    """
+    売上ダッシュボード。集計テーブル（update_sales_rollups で更新）だけを読み、注文明細は集計しない。
+    """
+    try:
+        days = min(max(int(request.GET.get('days', 30)), 1), 366)
+    except ValueError:
+        days = 30
+    today = timezone.localdate()
+    start_day = today - timedelta(days=days - 1)
+
+    daily = rollups.daily_sales(start_day)
+    return render(request, 'product/sales_dashboard.html', {
+        'days': days,
+        'daily': daily,
+        'top_products': rollups.top_products(start_day),
+        'total_revenue': sum(row['revenue'] for row in daily),
+        'total_orders': sum(row['orders'] for row in daily),
+        'watermark': rollups.get_watermark(),
+    })
+
+
+@basic_auth_required
+def metrics_view(request):
+    """MetricsMiddleware の集計を Prometheus のテキスト形式で返す（全プロセスの合算）。"""
+    return HttpResponse(
+        metrics.render_prometheus(metrics.collect()),
+        content_type='text/plain; version=0.0.4; charset=utf-8',
+    )
+
+
+@basic_auth_required
+def profile_list(request):
+    """ProfilingMiddleware が計測したリクエストの一覧。"""
+    return render(request, 'product/profile_list.html', {
+        'profiles': profiling.list_profiles(),
+        'sample_rate': getattr(settings, 'PROFILE_SAMPLE_RATE', 0),
+    })
+
+
+@basic_auth_required
+def profile_download(request, pk):
+    """
+    計測結果のダウンロード。
+    - cProfile: pstats（python -m pstats や snakeviz で開く）
+    - スタックサンプラー: collapsed-stack（flamegraph.pl や speedscope で開く）
+    """
+    profile = profiling.get_profile(pk)
+    if profile is None:
+        raise Http404('計測結果が見つかりません（古いものは上書きされます）')
+
+    if profile['pstats'] is not None:
+        response = HttpResponse(profile['pstats'], content_type='application/octet-stream')
+        filename = f'profile-{pk}.pstats'
+    else:
+        response = HttpResponse(profile['collapsed'], content_type='text/plain; charset=utf-8')
+        filename = f'profile-{pk}.collapsed.txt'
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+
+def _order_completed(request):
+    messages.success(request, "ご購入ありがとうございます。")
+    return redirect('product:product_list')
 
 
 def order_create(request):
-    cart, is_not_found = get_cart_from_request(request)
+    cart = get_cart_from_request(request)
 
     if request.method == 'GET':
-        if not cart or not cart.cart_items.exists():
+        if cart.is_empty():
             return redirect('product:product_list')
         form = OrderForm()
         return render(request, 'product/cart.html', {'form': form})
 
     if request.method == 'POST':
-        if not cart or not cart.cart_items.exists():
+        # 二重送信・再送された注文は、カートや注文明細に触れずに最初の結果を返す
+        idempotency_key = request.POST.get('idempotency_key')
+        if idempotency_key and Order.objects.filter(idempotency_key=idempotency_key).exists():
+            return _order_completed(request)
+
+        if cart.is_empty():
             messages.error(request, "カートが空です。")
             return redirect('product:product_list')
         
@@ -212,44 +408,63 @@ def order_create(request):
         if form.is_valid():
             try:
                 with transaction.atomic():
+                    checkout_cart = cart.get_checkout_cart()
+
+                    # 明細は1回の SELECT と1回の INSERT で作る（カートの行数によらずクエリ数は一定）
+                    lines = list(checkout_cart.cart_items.values_list(
+                        'product_id', 'product__name', 'product__price', 'quantity'
+                    ))
+                    # 在庫は全行まとめて1文で減らす。足りなければ OutOfStock で注文ごとロールバックする
+                    inventory.decrement_stock({product_id: quantity for product_id, _, _, quantity in lines})
+
                     order = form.save(commit=False)
-                    order.total_price = cart.get_total_price()
+                    order.total_price = sum(price * quantity for _, _, price, quantity in lines)
                     order.status = 'paid'         
                     order.save()
 
-                    for item in cart.cart_items.all():
-                        OrderItem.objects.create(
+                    OrderItem.objects.bulk_create([
+                        OrderItem(
                             order=order,
-                            product=item.product,
-                            product_name=item.product.name,
-                            product_price=item.product.price,
-                            quantity=item.quantity
+                            product_id=product_id,
+                            product_name=name,
+                            product_price=price,
+                            quantity=quantity
                         )
-                        
-                    cart.cart_items.all().delete()
-
-            except Exception as e:
-                    messages.error(request, "注文処理時にエラーが発生しました。")
-                    return redirect('product:cart_detail')
-
-            subject = "ご購入ありがとうございます"
-            message = f"{order.last_name} {order.first_name} 様\n\nご購入ありがとうございます。\n合計金額: ¥{order.total_price:,.0f}\n住所: {order.address}\n\nまたのご利用をお待ちしております。"
-            from_email = settings.EMAIL_HOST_USER
-            recipient_list = [order.email]
-
-            try:
-                send_mail(subject, message, from_email, recipient_list)
-            except Exception as e:
-                print(f"メール送信エラー: {e}")
+                        for product_id, name, price, quantity in lines
+                    ])
+
+                    cart.clear()
+
+                    # 確認メールは注文と同じトランザクションで送信待ちに積み、send_outbox が送る
+                    if order.email:
+                        subject = "ご購入ありがとうございます"
+                        message = f"{order.last_name} {order.first_name} 様\n\nご購入ありがとうございます。\n合計金額: ¥{order.total_price:,.0f}\n住所: {order.address}\n\nまたのご利用をお待ちしております。"
+                        enqueue_mail(subject, message, settings.EMAIL_HOST_USER, [order.email], order=order)
+
+            except inventory.OutOfStock as e:
+                names = '、'.join(product.name for product in inventory.short_products(e.lines))
+                messages.error(request, f"在庫が足りない商品があります: {names}" if names else "在庫が足りない商品があります。")
+                return redirect('product:cart_detail')
+            except IntegrityError:
+                # 同じキーの注文が同時に確定していた場合は、そちらを結果として返す
+                if idempotency_key and Order.objects.filter(idempotency_key=idempotency_key).exists():
+                    return _order_completed(request)
+                messages.error(request, "注文処理時にエラーが発生しました。")
+                return redirect('product:cart_detail')
+            except Exception:
+                # 利用者には一般的なメッセージだけを出し、原因（デッドロックなど）はログに残す
+                logger.exception('注文処理に失敗しました')
+                messages.error(request, "注文処理時にエラーが発生しました。")
+                return redirect('product:cart_detail')
             
-            messages.success(request, "ご購入ありがとうございます。")
-            return redirect('product:product_list')
+            return _order_completed(request)
         
         messages.error(request, "入力内容に不備があります。")
+        cart_items = cart.get_items()
         return render(request, 'product/cart.html', {
             'form': form,
-            'cart_items': cart.cart_items.all(),
-            'total_price': cart.get_total_price(),
+            'cart_items': cart_items,
+            'total_price': sum(item.subtotal for item in cart_items),
         })
     form =OrderForm()
     return render(request, 'product/cart.html', {'form': form})